@@ -0,0 +1,394 @@
+""" Timing benchmarks of the route energy pipeline on the routes shipped
+    in 'data/'.
+
+    Times each pipeline stage on real routes, and the simulation stages
+    over route length and stop count, and writes the results with the
+    environment they ran in to a JSON file. Comparing two result files
+    lists the benchmarks that got slower.
+
+    Usage:
+        python benchmarks/run_benchmarks.py --routes 22 101 154 \\
+            --output results.json
+        python benchmarks/run_benchmarks.py --compare old.json new.json
+    """
+import argparse
+import copy
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import warnings
+
+from os import path
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+
+from scipy.spatial import cKDTree
+
+ROOT = path.abspath(path.join(path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+from route_dynamics.route_elevation import base_df
+from route_dynamics.route_energy import accel
+from route_dynamics.route_energy import knn
+from route_dynamics.route_energy import longi_dynam_model as ldm
+from route_dynamics.route_energy.route_state import RouteState
+
+
+DATA_DIR = path.join(ROOT, 'data')
+STOPS_SHP = path.join(
+    DATA_DIR, 'Transit_Stops_for_King_County_Metro__transitstop_point.shp'
+    )
+SIGNALS_SHP = path.join(DATA_DIR, 'traffic_signals2.shp')
+
+DEFAULT_ROUTES = [22, 101, 154]
+
+# Route length multiples and stop counts of the scaling curves
+LENGTH_FACTORS = [0.25, 0.5, 1, 2, 4]
+STOP_COUNTS = [0, 10, 40, 160]
+
+# Model parameters of every benchmark
+PARAMS = {'charging_power_max': 160000, 'aux': 7000}
+
+
+def time_call(func, setup=None, repeat=5):
+    """ Times 'func' 'repeat' times, each after calling 'setup' (not
+        timed). 'func' gets the return value of 'setup' if given.
+
+        Returns a dict of the minimum, median and mean time in seconds
+        and the number of repeats.
+        """
+
+    times = []
+    for _ in range(repeat):
+        args = () if setup is None else (setup(),)
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+
+    return {
+        'min_s': min(times),
+        'median_s': float(np.median(times)),
+        'mean_s': float(np.mean(times)),
+        'repeat': repeat,
+        }
+
+
+def route_inputs(route_num):
+    """ Shapefile, stop coordinates (transit stops within ~20 m of the
+        route) and signal coordinates of a route in 'data/'.
+        """
+
+    shp_filename = path.join(DATA_DIR, 'rt{}_pts2.shp'.format(route_num))
+    route = gpd.read_file(shp_filename)
+    route_xy = np.column_stack([route.geometry.x, route.geometry.y])
+
+    stops = gpd.read_file(STOPS_SHP)
+    stop_xy = np.column_stack([stops.geometry.x, stops.geometry.y])
+    distance, _ = cKDTree(route_xy).query(stop_xy)
+    stop_coords = [tuple(xy) for xy in stop_xy[distance < 0.0002]]
+
+    signals = gpd.read_file(SIGNALS_SHP).explode(index_parts=False)
+    signals = signals[signals['Route_Num'].astype(str) == str(route_num)]
+    signal_coords = [(g.x, g.y) for g in signals.geometry]
+
+    return shp_filename, stop_coords, signal_coords
+
+
+def bench_route(route_num, a_prof, repeat):
+    """ Times every pipeline stage on one route. """
+
+    shp_filename, stop_coords, signal_coords = route_inputs(route_num)
+
+    trajectory = ldm.RouteTrajectory(
+        route_num,
+        shp_filename,
+        a_prof,
+        stop_coords=stop_coords,
+        signal_coords=signal_coords,
+        mass_array=[],
+        **PARAMS
+        )
+    route_state = trajectory.route_state
+
+    def uncapped_state():
+        state = route_state.copy()
+        for name, values in trajectory._uncapped.items():
+            state[name] = values
+        return state
+
+    results = {
+        'base_df.create_gdf': time_call(
+            lambda: base_df.create_gdf(shp_filename, 6), repeat=repeat
+            ),
+        'base_df.wrapper': time_call(
+            lambda: base_df.wrapper(shp_filename, 6, 6), repeat=repeat
+            ),
+        'knn.find_knn': time_call(
+            lambda: knn.find_knn(1, route_state.geometry, stop_coords),
+            repeat=repeat
+            ),
+        'knn.snap_to_route': time_call(
+            lambda: knn.snap_to_route(route_state.geometry, stop_coords),
+            repeat=repeat
+            ),
+        'accel.accel_dynamics': time_call(
+            lambda: accel.accel_dynamics(
+                route_state, trajectory.a_prof,
+                trajectory.a_pos, trajectory.a_neg
+                ),
+            repeat=repeat
+            ),
+        'RouteTrajectory.__init__': time_call(
+            lambda: ldm.RouteTrajectory(
+                route_num,
+                shp_filename,
+                a_prof,
+                stop_coords=stop_coords,
+                signal_coords=signal_coords,
+                mass_array=[],
+                **PARAMS
+                ),
+            repeat=max(1, repeat // 2)
+            ),
+        'RouteTrajectory._calculate_batt_power_exert': time_call(
+            trajectory._calculate_batt_power_exert,
+            setup=uncapped_state,
+            repeat=repeat
+            ),
+        'RouteTrajectory.energy_from_route': time_call(
+            trajectory.energy_from_route, repeat=repeat
+            ),
+        }
+
+    return {
+        'num_points': len(route_state),
+        'num_stops': len(route_state.bus_stop_idx),
+        'num_signals': len(route_state.signal_idx),
+        'timings': results,
+        }
+
+
+def tiled_route_df(route_df, factor):
+    """ Route DataFrame 'factor' times as long, repeating the route
+        shifted east so the copies do not overlap (or its first part
+        for factors below 1).
+        """
+
+    num_pts = int(len(route_df) * factor)
+    reps = -(-num_pts // len(route_df))
+
+    x = route_df.geometry.x.values
+    y = route_df.geometry.y.values
+    shift = np.ptp(x) + 0.01
+
+    tiled = pd.concat([route_df.drop(columns='geometry')]*reps)
+    tiled = gpd.GeoDataFrame(
+        tiled.reset_index(drop=True),
+        geometry=gpd.points_from_xy(
+            np.concatenate([x + k*shift for k in range(reps)]),
+            np.tile(y, reps)
+            ),
+        crs=route_df.crs
+        )
+
+    return tiled.iloc[:num_pts].reset_index(drop=True)
+
+
+def bench_scaling(route_num, a_prof, repeat):
+    """ Times the simulation stages ('_add_dynamics_to_df') over route
+        length, with a stop every 40 points, and over stop count on
+        the route as shipped.
+        """
+
+    shp_filename, _, _ = route_inputs(route_num)
+    route_df = base_df.wrapper(shp_filename, 6, 6)
+
+    trajectory = ldm.RouteTrajectory(
+        route_num, shp_filename, a_prof, stop_coords=[], signal_coords=[],
+        mass_array=[], **PARAMS
+        )
+
+    def simulate(route_df, stop_coords):
+        def setup():
+            bench = copy.copy(trajectory)
+            bench.route_state = RouteState.from_dataframe(route_df)
+            return bench
+        return time_call(
+            lambda bench: bench._add_dynamics_to_df(
+                bench.route_state, bench.a_prof, stop_coords, []
+                ),
+            setup=setup,
+            repeat=repeat
+            )
+
+    length = []
+    for factor in LENGTH_FACTORS:
+        tiled = tiled_route_df(route_df, factor)
+        stop_coords = [
+            (pt.x, pt.y) for pt in tiled.geometry.values[20::40]
+            ]
+        length.append(dict(
+            factor=factor,
+            num_points=len(tiled),
+            num_stops=len(stop_coords),
+            **simulate(tiled, stop_coords)
+            ))
+
+    stops = []
+    rng = np.random.default_rng(0)
+    for num_stops in STOP_COUNTS:
+        idx = np.sort(rng.choice(len(route_df), num_stops, replace=False))
+        stop_coords = [
+            (pt.x, pt.y) for pt in route_df.geometry.values[idx]
+            ]
+        stops.append(dict(
+            num_points=len(route_df),
+            num_stops=num_stops,
+            **simulate(route_df, stop_coords)
+            ))
+
+    return {'route_num': route_num, 'length': length, 'stops': stops}
+
+
+def environment():
+    """ Versions and machine the benchmarks ran on """
+
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+            capture_output=True, text=True, check=True
+            ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'commit': commit,
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'geopandas': gpd.__version__,
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        }
+
+
+def run(routes, repeat, scaling_route):
+    """ Runs all benchmarks and returns the results dict """
+
+    a_prof = pd.read_csv(
+        path.join(DATA_DIR, 'acceleration.csv'),
+        names=['time (s)', 'accel. (g)']
+        )
+
+    results = {'environment': environment(), 'routes': {}}
+    for route_num in routes:
+        print('route {}'.format(route_num), file=sys.stderr)
+        results['routes'][str(route_num)] = bench_route(
+            route_num, a_prof, repeat
+            )
+
+    if scaling_route is not None:
+        print('scaling on route {}'.format(scaling_route), file=sys.stderr)
+        results['scaling'] = bench_scaling(scaling_route, a_prof, repeat)
+
+    return results
+
+
+def flatten(results):
+    """ Maps '<route>/<benchmark>' names to minimum times """
+
+    timings = {}
+    for route_num, route in results['routes'].items():
+        for name, timing in route['timings'].items():
+            timings['{}/{}'.format(route_num, name)] = timing['min_s']
+
+    scaling = results.get('scaling', {})
+    for curve in ('length', 'stops'):
+        for point in scaling.get(curve, []):
+            name = 'scaling/{}/points={}/stops={}'.format(
+                curve, point['num_points'], point['num_stops']
+                )
+            timings[name] = point['min_s']
+
+    return timings
+
+
+def compare(old, new, threshold=1.2):
+    """ Table of benchmarks in both results, with the ratio of new to
+        old minimum time, and whether that exceeds 'threshold'.
+        """
+
+    old_times = flatten(old)
+    new_times = flatten(new)
+
+    rows = [
+        {
+            'benchmark': name,
+            'old_s': old_times[name],
+            'new_s': new_times[name],
+            'ratio': new_times[name] / old_times[name],
+            }
+        for name in new_times if name in old_times
+        ]
+    table = pd.DataFrame(rows, columns=['benchmark', 'old_s', 'new_s', 'ratio'])
+    table['regression'] = table['ratio'] > threshold
+
+    return table
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '--routes', type=int, nargs='+', default=DEFAULT_ROUTES,
+        help='routes in data/ to benchmark'
+        )
+    parser.add_argument(
+        '--scaling-route', type=int, default=DEFAULT_ROUTES[0],
+        help='route the scaling curves are built from'
+        )
+    parser.add_argument('--no-scaling', action='store_true')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument(
+        '--compare', nargs=2, metavar=('OLD', 'NEW'),
+        help='compare two result files instead of running'
+        )
+    parser.add_argument(
+        '--threshold', type=float, default=1.2,
+        help='slowdown ratio reported as a regression'
+        )
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            old = json.load(f)
+        with open(args.compare[1]) as f:
+            new = json.load(f)
+        table = compare(old, new, args.threshold)
+        print(table.to_string(index=False))
+        return 1 if table['regression'].any() else 0
+
+    warnings.filterwarnings('ignore')
+    results = run(
+        args.routes,
+        args.repeat,
+        None if args.no_scaling else args.scaling_route
+        )
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('wrote {}'.format(args.output), file=sys.stderr)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,482 @@
+""" 'route-dynamics' command: runs RouteTrajectory over many route
+    shapefiles and streams one result row per route and parameter set
+    to CSV or Parquet as each finishes.
+
+    Exit status is 0 when every route ran, 1 when any failed and 2 for
+    bad arguments or input files that cannot be read.
+    """
+import argparse
+import glob
+import json
+import os
+import re
+import sys
+import time
+
+from os import path
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+
+from .route_energy import fleet
+from .route_energy import knn
+from .route_energy import stop_index
+
+
+DATA_DIR = path.join(path.dirname(__file__), '..', 'data')
+
+EXIT_OK = 0
+EXIT_FAILURES = 1
+EXIT_USAGE = 2
+
+
+def main(argv=None):
+    parser = _parser()
+    args = parser.parse_args(argv)
+
+    try:
+        shapefiles = route_shapefiles(args.routes)
+        route_nums = list(shapefiles)
+        param_sets = _param_sets(args)
+        if args.stop_index is not None:
+            _add_stop_index(args, shapefiles, param_sets)
+        a_prof = pd.read_csv(args.accel, names=['time (s)', 'accel. (g)'])
+
+        stop_coords = signal_coords = None
+        if args.stop_index is None:
+            stop_coords = _point_inputs(
+                args.stops, shapefiles, args.stop_radius
+                )
+            signal_coords = _point_inputs(
+                args.signals, shapefiles, args.stop_radius
+                )
+        mass_arrays = None
+        if args.ridership_period is not None:
+            _check_ridership_params(args, param_sets)
+            stop_coords, mass_arrays = _ridership_inputs(args, route_nums)
+
+        writer = ResultWriter(
+            args.output,
+            args.format,
+            args.flush_every,
+            columns=_result_columns(param_sets)
+            )
+    # Also the errors of the point and ridership file readers, e.g.
+    # a missing file or one that is not a point file
+    except (OSError, ValueError) as error:
+        parser.error(str(error))
+
+    num_tasks = len(route_nums) * len(param_sets)
+    failures = []
+    start = time.perf_counter()
+
+    with writer:
+        for count, row in enumerate(fleet.iter_fleet(
+            route_nums,
+            a_prof,
+            stop_coords=stop_coords,
+            signal_coords=signal_coords,
+            mass_arrays=mass_arrays,
+            param_sets=param_sets,
+            max_workers=args.workers,
+            cache_dir=args.cache_dir,
+            shapefiles=shapefiles
+            ), 1):
+
+            writer.write(row)
+
+            if row['error'] is not None:
+                failures.append(row)
+            if not args.quiet:
+                print(_progress(count, num_tasks, row), file=sys.stderr)
+
+    elapsed = time.perf_counter() - start
+    print(
+        _summary(route_nums, num_tasks, failures, elapsed, args.output),
+        file=sys.stderr
+        )
+
+    return EXIT_FAILURES if failures else EXIT_OK
+
+
+def _parser():
+    parser = argparse.ArgumentParser(
+        prog='route-dynamics',
+        description='Route energy for many routes and bus configurations.'
+        )
+    parser.add_argument(
+        'routes', nargs='+',
+        help="route point shapefiles or glob patterns, e.g. "
+             "'data/rt*_pts2.shp'. Routes are numbered from 'rt<num>' "
+             "in the file name, else named by the file name."
+        )
+    parser.add_argument(
+        '-o', '--output', required=True,
+        help='results file, .csv or .parquet'
+        )
+    parser.add_argument(
+        '--format', choices=['csv', 'parquet'],
+        help='output format, from the extension by default'
+        )
+    parser.add_argument(
+        '-j', '--workers', type=int, default=None,
+        help='worker processes, all CPUs by default'
+        )
+    parser.add_argument(
+        '--accel', default=path.join(DATA_DIR, 'acceleration.csv'),
+        help='acceleration profile CSV (time in s, acceleration in g)'
+        )
+    parser.add_argument(
+        '--stops',
+        help="bus stop point file. With a 'Route_Num' column stops are "
+             "given per route, otherwise points within --stop-radius "
+             "of a route are its stops."
+        )
+    parser.add_argument(
+        '--signals',
+        help='traffic signal point file, as --stops'
+        )
+    parser.add_argument(
+        '--stop-radius', type=float, default=20.,
+        help='largest distance of a stop or signal from its route line, '
+             'in metres (default %(default)s)'
+        )
+    parser.add_argument(
+        '--stop-index',
+        help='directory of a saved stop and signal index of the routes, '
+             'built or updated before the run from --stops (default: '
+             'the King County Metro stops), --signals (default: the '
+             'Traffic_Signals*.shp files) and --stop-radius'
+        )
+    parser.add_argument(
+        '--ridership-period', choices=['AM', 'MID', 'PM', 'XEV', 'XNT'],
+        help='take stops and passenger mass from KCM ridership of this '
+             'period, replacing --stops. Bus masses use '
+             '--unloaded-bus-mass, which --params cannot change'
+        )
+    parser.add_argument(
+        '--ridership-direction', choices=['I', 'O'], default='O',
+        help='inbound or outbound ridership (default %(default)s)'
+        )
+    parser.add_argument(
+        '--ridership-dataset',
+        help='partitioned ridership dataset, see '
+             'ridership_dataset.convert_ridership'
+        )
+    parser.add_argument(
+        '--ridership-stops',
+        help="stop shapefile with 'STOP_ID' for the ridership stops"
+        )
+    parser.add_argument('--charging-power-max', type=float, default=160000)
+    parser.add_argument('--aux', type=float, default=7000)
+    parser.add_argument('--unloaded-bus-mass', type=float, default=12927)
+    parser.add_argument(
+        '--snap-distance', type=float,
+        help='leave out stops and signals farther than this from the '
+             'route line, in metres (default: none)'
+        )
+    parser.add_argument(
+        '--resample-tolerance', type=float,
+        help='relative energy error allowed when merging cruising route '
+             'points, e.g. 0.01 (default: simulate every point)'
+        )
+    parser.add_argument(
+        '--params',
+        help='JSON list of parameter sets (or a file holding one), each '
+             'a dict of RouteTrajectory arguments overriding the options '
+             'above'
+        )
+    parser.add_argument(
+        '--cache-dir',
+        help='directory of cached route coordinate arrays'
+        )
+    parser.add_argument(
+        '--flush-every', type=int, default=16,
+        help='rows per Parquet part file (default %(default)s)'
+        )
+    parser.add_argument(
+        '-q', '--quiet', action='store_true',
+        help='only print the summary'
+        )
+
+    return parser
+
+
+def route_shapefiles(patterns):
+    """ Dict of route number to shapefile, in the order given, from
+        shapefile paths or glob patterns.
+        """
+
+    shapefiles = {}
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        if not matches and not glob.has_magic(pattern):
+            raise FileNotFoundError(
+                'No route shapefile {}'.format(pattern)
+                )
+        for filename in matches:
+            shapefiles.setdefault(_route_num(filename), filename)
+
+    if not shapefiles:
+        raise ValueError('No route shapefiles match {}'.format(patterns))
+
+    return shapefiles
+
+
+def _route_num(filename):
+    name = path.splitext(path.basename(filename))[0]
+    match = re.match(r'rt(\d+)', name)
+    return int(match.group(1)) if match else name
+
+
+def _param_sets(args):
+    """ Parameter sets from the options, each updated by a set in
+        '--params'.
+        """
+
+    base = {
+        'charging_power_max': args.charging_power_max,
+        'aux': args.aux,
+        'unloaded_bus_mass': args.unloaded_bus_mass,
+        }
+    if args.resample_tolerance is not None:
+        base['resample_tolerance'] = args.resample_tolerance
+    if args.snap_distance is not None:
+        base['snap_distance'] = args.snap_distance
+
+    if args.params is None:
+        return [base]
+
+    text = args.params
+    if path.isfile(text):
+        with open(text) as f:
+            text = f.read()
+    param_sets = json.loads(text)
+    if isinstance(param_sets, dict):
+        param_sets = [param_sets]
+
+    return [dict(base, **params) for params in param_sets]
+
+
+def _add_stop_index(args, shapefiles, param_sets):
+    """ Builds or updates the '--stop-index' of the routes and adds it
+        to every parameter set.
+        """
+
+    if args.ridership_period is not None:
+        raise ValueError(
+            '--stop-index cannot be combined with --ridership-period'
+            )
+
+    index_args = {'snap_distance': args.stop_radius}
+    if args.stops is not None:
+        index_args['stops_shp'] = args.stops
+    if args.signals is not None:
+        index_args['signal_shps'] = [args.signals]
+
+    index = stop_index.StopIndex(
+        args.stop_index, cache_dir=args.cache_dir, **index_args
+        )
+    index.build(list(shapefiles.values()))
+
+    for params in param_sets:
+        params['stop_index'] = index
+
+
+def _point_inputs(filename, shapefiles, radius):
+    """ Per-route point coordinates from a point file """
+
+    if filename is None:
+        return None
+
+    points = gpd.read_file(filename).explode(index_parts=False)
+
+    if 'Route_Num' in points.columns:
+        by_route = {}
+        for route_num, geom in zip(points['Route_Num'], points.geometry):
+            by_route.setdefault(str(route_num), []).append((geom.x, geom.y))
+        return {
+            route_num: by_route.get(str(route_num), [])
+            for route_num in shapefiles
+            }
+
+    point_xy = np.column_stack([points.geometry.x, points.geometry.y])
+
+    coords = {}
+    for route_num, shp_filename in shapefiles.items():
+        route = gpd.read_file(shp_filename)
+        positions, _ = knn.snap_to_route(
+            route.geometry.values, point_xy, radius, crs=route.crs
+            )
+        coords[route_num] = [
+            tuple(xy) for xy in point_xy[~np.isnan(positions)]
+            ]
+
+    return coords
+
+
+def _check_ridership_params(args, param_sets):
+    """ Ridership masses are per route, not per parameter set, so
+        they are computed once with '--unloaded-bus-mass'.
+        """
+
+    for params in param_sets:
+        if params['unloaded_bus_mass'] != args.unloaded_bus_mass:
+            raise ValueError(
+                '--ridership-period masses use --unloaded-bus-mass, '
+                'give it instead of unloaded_bus_mass in --params'
+                )
+
+
+def _ridership_inputs(args, route_nums):
+    """ Per-route stop coordinates and masses from KCM ridership, with
+        the bus mass '--unloaded-bus-mass'.
+        """
+
+    from .route_riders import route_riders
+
+    store_args = {}
+    if args.ridership_dataset is not None:
+        store_args['dataset_dir'] = args.ridership_dataset
+    if args.ridership_stops is not None:
+        store_args['stops_shp'] = args.ridership_stops
+    store = route_riders.RidershipStore(**store_args)
+
+    stop_coords = {}
+    mass_arrays = {}
+    for route_num in route_nums:
+        if not isinstance(route_num, int):
+            continue
+        riders = route_riders.route_ridership(
+            args.ridership_period,
+            route_num,
+            args.unloaded_bus_mass,
+            store=store
+            )
+        riders = riders[
+            (riders['InOut'] == args.ridership_direction)
+            & riders['geometry'].notnull()
+            ]
+        stop_coords[route_num] = [(g.x, g.y) for g in riders['geometry']]
+        mass_arrays[route_num] = riders['Total_Mass'].values
+
+    return stop_coords, mass_arrays
+
+
+def _result_columns(param_sets):
+    """ Columns of the result rows: 'fleet.RESULT_COLUMNS' and the
+        scalar parameters of any parameter set.
+        """
+
+    columns = list(fleet.RESULT_COLUMNS)
+    for params in param_sets:
+        for name, value in params.items():
+            if np.isscalar(value) and name not in columns:
+                columns.append(name)
+
+    return columns
+
+
+class ResultWriter():
+    """ Appends result rows to a CSV file, flushed after every row, or
+        to a Parquet dataset directory, one part file per
+        'flush_every' rows, so results can be read while a run goes
+        on.
+
+        The columns are 'columns', by default the keys of the first
+        row. Rows missing a column leave it empty.
+        """
+
+    def __init__(self, output, format=None, flush_every=16, columns=None):
+
+        if format is None:
+            format = path.splitext(output)[1].lstrip('.').lower()
+        if format not in ('csv', 'parquet'):
+            raise ValueError(
+                "Output must be .csv or .parquet, or give --format"
+                )
+
+        self.output = output
+        self.format = format
+        self.flush_every = flush_every
+
+        self._file = None
+        self._columns = None if columns is None else list(columns)
+        self._rows = []
+        self._parts = 0
+
+    def __enter__(self):
+        if self.format == 'csv':
+            self._file = open(self.output, 'w', newline='')
+        else:
+            os.makedirs(self.output, exist_ok=True)
+            for name in os.listdir(self.output):
+                if re.match(r'part-\d+\.parquet$', name):
+                    os.remove(path.join(self.output, name))
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.format == 'parquet':
+            self._write_part()
+        else:
+            self._file.close()
+
+    def write(self, row):
+        if self._columns is None:
+            self._columns = list(row)
+        df = pd.DataFrame([row], columns=self._columns)
+
+        if self.format == 'csv':
+            df.to_csv(self._file, header=self._file.tell() == 0, index=False)
+            self._file.flush()
+            return
+
+        self._rows.append(df)
+        if len(self._rows) >= self.flush_every:
+            self._write_part()
+
+    def _write_part(self):
+        if not self._rows:
+            return
+        df = pd.concat(self._rows, ignore_index=True)
+        df['route_num'] = df['route_num'].astype(str)
+        df['error'] = df['error'].astype('string')
+        df.to_parquet(
+            path.join(self.output, 'part-{:05d}.parquet'.format(self._parts)),
+            index=False
+            )
+        self._parts += 1
+        self._rows = []
+
+
+def _progress(count, num_tasks, row):
+    if row['error'] is not None:
+        status = 'FAILED: {}'.format(_last_line(row['error']))
+    else:
+        status = '{:.3f} kWh'.format(row['energy_kwh'])
+    return '[{}/{}] route {} set {}: {}'.format(
+        count, num_tasks, row['route_num'], row['param_set'], status
+        )
+
+
+def _summary(route_nums, num_tasks, failures, elapsed, output):
+    lines = [
+        '{} routes, {} runs in {:.1f} s, {} failed; results in {}'.format(
+            len(route_nums), num_tasks, elapsed, len(failures), output
+            )
+        ]
+    for row in failures:
+        lines.append('  route {} set {}: {}'.format(
+            row['route_num'], row['param_set'], _last_line(row['error'])
+            ))
+    return '\n'.join(lines)
+
+
+def _last_line(error):
+    lines = error.strip().splitlines()
+    return lines[-1] if lines else ''
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,15 +3,20 @@ import pandas as pd
 import geopandas as gpd
 import branca.colormap as cm
 import folium
-import rasterstats
 import matplotlib.pyplot as plt
 
+from . import dem
+
 from folium.features import GeoJson
 from shapely.geometry import mapping
 from shapely.geometry import LineString
 from shapely.geometry import Polygon
 # from rasterio.mask import mask
 from geopy.distance import geodesic
+from pyproj import Geod
+
+# WGS-84 ellipsoid, as used by geopy's 'geodesic'
+_WGS84 = Geod(ellps='WGS84')
 
 
 def read_shape(shapefile, route_num):
@@ -66,12 +71,12 @@ def extract_point_df(route_shp):
     linestring_route = []
     for i in range(len(coordinates_route)):
         linestring_route.append(coordinates_route[i][:2])
-        linestring_route_df = pd.DataFrame()
-        linestring_route_df['coordinates'] = linestring_route
+    linestring_route_df = pd.DataFrame()
+    linestring_route_df['coordinates'] = linestring_route
     return linestring_route_df
 
 
-def distance_measure(route_shp):
+def distance_measure(route_shp, method='pyproj'):
     """
         Calculates the distance between points along the route and
         calculates the cumulative distance. ASSUMES geodesic distances
@@ -81,10 +86,14 @@ def distance_measure(route_shp):
         ----------
         route_shp: GeoDataFrame for the selected route;
         output of read_shape().
+        method: 'pyproj' (default) solves every geodesic at once on
+            the WGS-84 ellipsoid with pyproj.Geod; 'geopy' calls
+            geopy's geodesic point by point and is kept as a
+            reference. Both agree to well under a millimetre.
 
         Returns
         -------
-        distance: list containing the distance between each point.
+        distance: array containing the distance between each point.
          In units = [meters].
         cum_distance: array of the total route distance at each point
         along the route (e.g. the first point will have a distance
@@ -92,6 +101,42 @@ def distance_measure(route_shp):
         distance). In units = [meters]
         """
 
+    if method == 'pyproj':
+        # (longitude, latitude) of every point on the route
+        coordinates = np.asarray(
+            mapping(route_shp.geometry.values[0])['coordinates']
+            )[:, :2]
+        _, _, distance = _WGS84.inv(
+            coordinates[:-1, 0],
+            coordinates[:-1, 1],
+            coordinates[1:, 0],
+            coordinates[1:, 1],
+            )
+
+    elif method == 'geopy':
+        distance = _geopy_distances(route_shp)
+
+    else:
+        raise ValueError(
+            "Unknown method '{}' for 'distance_measure', use 'pyproj' "
+            "or 'geopy'".format(method)
+            )
+
+    distance = np.asarray(distance, dtype=float)
+
+    # Calculate cumulative sum of distances along route with zero at
+    # the beginning of the list for first point
+    cum_distance = np.insert(np.cumsum(distance), 0, 0)
+
+    return distance, cum_distance
+
+
+def _geopy_distances(route_shp):
+    """
+        Reference implementation of the distances between consecutive
+        route points, one geopy geodesic at a time.
+        """
+
     # Convert GeoDataFrame to simple pd.DataFrame containing only
     # list of 2D coordinates along route.
     lines_gdf = extract_point_df(route_shp)
@@ -108,14 +153,10 @@ def distance_measure(route_shp):
         # Calculate geodesic distances in meters and add to list
         distance.append(geodesic(swap_coord_1,swap_coord_2).m)
 
-    # Calculate cumulative sum of distances along route with zero at
-    # the beginning of the list for first point
-    cum_distance = np.insert(np.cumsum(distance), 0, 0)
+    return distance
 
-    return distance, cum_distance
 
-
-def gradient(route_shp, rasterfile):
+def gradient(route_shp, rasterfile, interpolate='bilinear'):
     """
         Calculates the elevation and road grade at each point along the route.
 
@@ -124,6 +165,8 @@ def gradient(route_shp, rasterfile):
         route_shp: GeoDataFrame for the selected route;
         output of read_shape().
         rasterfile: elevation data file (.tif)
+        interpolate: 'bilinear' (default) or 'nearest' sampling of
+        the raster
 
         Returns
         -------
@@ -134,13 +177,32 @@ def gradient(route_shp, rasterfile):
 
         """
 
-    # from the 'rasterstats' userguide:
-        # "rasterstats, exists solely to extract information from
-        # geospatial raster data based on vector geometries"
-
     # 'point_query' returns the values defined in the 'rasterfild'
-    # at the points defined within the GeoDataFrame 'route_shp'
-    elevation = rasterstats.point_query(route_shp, rasterfile)
+    # at the points defined within the GeoDataFrame 'route_shp', as
+    # rasterstats.point_query did, reading only the raster blocks
+    # under the route.
+    elevation = dem.point_query(route_shp, rasterfile, interpolate)
+
+    return gradient_from_elevation(route_shp, elevation)
+
+
+def gradient_from_elevation(route_shp, elevation):
+    """
+        Road grade and distances along the route from elevations
+        already sampled at its points, as returned by gradient().
+
+        Parameters
+        ----------
+        route_shp: GeoDataFrame for the selected route;
+        output of read_shape().
+        elevation: raster elevations at the route points, in the layout
+        of dem.point_query() (one array per geometry)
+
+        Returns
+        -------
+        elevation_meters, route_gradient, route_cum_distance,
+        route_distance: as gradient()
+        """
 
     # Convert elevations to meters
     elevation_meters = np.asarray(elevation) * 0.3048
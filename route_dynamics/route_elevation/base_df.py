@@ -1,3 +1,9 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
 import numpy as np
 import pandas as pd
 import geopandas as gpd
@@ -102,7 +108,7 @@ def grade(y_new, distance):
     return grade_SG
 
 
-def wrapper(shapefile, pt_distance, frequency):
+def wrapper(shapefile, pt_distance, frequency, cache_dir=None):
     """
         Wrapper function: creates initial geodataframe with distance along route and filtered elevation.  
 
@@ -111,12 +117,23 @@ def wrapper(shapefile, pt_distance, frequency):
         route_df: geodataframe
         pt_distance: distance between points 
         frequency: how many points included
+        cache_dir: optional directory for cached results. Derived
+            arrays are stored per shapefile (path, and modification
+            time and size of each of its files), 'pt_distance' and
+            'frequency', and loaded memory-mapped instead of
+            re-reading the shapefile. Entries of earlier versions of
+            the shapefile are removed.
 
         Returns
         -------
         y_new: filtered elevation values
         """
 
+    if cache_dir is not None:
+        entry = _cache_entry(cache_dir, shapefile, pt_distance, frequency)
+        if os.path.isdir(entry):
+            return _load_cached(entry)
+
     route_df = create_gdf(shapefile, pt_distance)
     
     route_df, distance = metric_df(route_df, frequency)
@@ -125,5 +142,159 @@ def wrapper(shapefile, pt_distance, frequency):
 
     route_df['grade'] = grade(route_df['elevation'].values, distance)
 
+    if cache_dir is not None:
+        _save_cached(route_df, entry)
+
     return route_df
 
+
+# Bump when the cached arrays or their derivation change.
+_CACHE_VERSION = 1
+
+_CACHED_COLUMNS = ['distance', 'elevation', 'speed_limit', 'grade']
+
+
+# Files besides the .shp that a shapefile is read from
+SHAPEFILE_SIDECARS = ['.shx', '.dbf', '.prj', '.cpg']
+
+
+def shapefile_stamp(shapefile):
+    """
+        Modification times and sizes of the files of a shapefile.
+
+        Parameters
+        ----------
+        shapefile: geospatial data (.shp file)
+
+        Returns
+        -------
+        stamp: list of [extension, modification time, size] of the
+            .shp and of every sidecar file ('SHAPEFILE_SIDECARS') that
+            exists, so e.g. an edited .dbf changes the stamp
+        """
+
+    stat = os.stat(shapefile)
+    stamp = [['.shp', stat.st_mtime_ns, stat.st_size]]
+
+    base = os.path.splitext(shapefile)[0]
+    for ext in SHAPEFILE_SIDECARS:
+        try:
+            stat = os.stat(base + ext)
+        except FileNotFoundError:
+            continue
+        stamp.append([ext, stat.st_mtime_ns, stat.st_size])
+
+    return stamp
+
+
+def _cache_entry(cache_dir, shapefile, pt_distance, frequency):
+    """
+        Directory of the cache entry for a shapefile and settings.
+
+        Parameters
+        ----------
+        cache_dir: cache root directory
+        shapefile: route geospatial data (.shp file)
+        pt_distance: distance between points (in ft)
+        frequency: how many points to keep
+
+        Returns
+        -------
+        entry: path of the entry, named by a digest of the shapefile
+            path and settings followed by a digest of the shapefile's
+            file stamps, so an edit to any of its files gets a new
+            entry
+        """
+
+    settings = json.dumps([
+        _CACHE_VERSION,
+        os.path.abspath(shapefile),
+        pt_distance,
+        frequency,
+        ])
+    sources = json.dumps(shapefile_stamp(shapefile))
+
+    name = os.path.splitext(os.path.basename(shapefile))[0]
+
+    return os.path.join(cache_dir, '{}-{}-{}'.format(
+        name,
+        hashlib.sha1(settings.encode()).hexdigest()[:12],
+        hashlib.sha1(sources.encode()).hexdigest()[:12],
+        ))
+
+
+def _prune_superseded(entry):
+    """
+        Removes the entries of the same shapefile and settings as
+        'entry' built from earlier versions of the shapefile.
+        """
+
+    parent, name = os.path.split(entry)
+    prefix = name.rsplit('-', 1)[0] + '-'
+
+    for other in os.listdir(parent):
+        if other != name and other.startswith(prefix):
+            shutil.rmtree(os.path.join(parent, other), ignore_errors=True)
+
+
+def _save_cached(route_df, entry):
+    """
+        Writes the derived route arrays to a cache entry as .npy files.
+        The entry is written to a temporary directory and renamed, so
+        readers never see a partial entry.
+        """
+
+    parent = os.path.dirname(entry)
+    os.makedirs(parent, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=parent)
+
+    geometry = route_df.geometry.values
+    coords = np.column_stack([geometry.x, geometry.y])
+    if geometry.has_z.any():
+        coords = np.column_stack([coords, geometry.z])
+    np.save(os.path.join(tmp_dir, 'coordinates.npy'), coords)
+
+    for column in _CACHED_COLUMNS:
+        np.save(
+            os.path.join(tmp_dir, column + '.npy'),
+            np.asarray(route_df[column].values, dtype=float)
+            )
+
+    crs = route_df.crs.to_wkt() if route_df.crs is not None else None
+    with open(os.path.join(tmp_dir, 'crs.json'), 'w') as f:
+        json.dump({'crs': crs}, f)
+
+    try:
+        os.rename(tmp_dir, entry)
+    except OSError:
+        # Another process wrote the same entry first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    _prune_superseded(entry)
+
+
+def _load_cached(entry):
+    """
+        Rebuilds the wrapper() GeoDataFrame from a cache entry, with
+        the arrays memory-mapped from disk.
+        """
+
+    def load(name):
+        return np.load(os.path.join(entry, name + '.npy'), mmap_mode='r')
+
+    coords = load('coordinates')
+    with open(os.path.join(entry, 'crs.json')) as f:
+        crs = json.load(f)['crs']
+
+    geometry = gpd.points_from_xy(
+        coords[:, 0],
+        coords[:, 1],
+        coords[:, 2] if coords.shape[1] > 2 else None,
+        crs=crs
+        )
+
+    data = {'geometry': geometry}
+    for column in _CACHED_COLUMNS:
+        data[column] = load(column)
+
+    return gpd.GeoDataFrame(data, geometry='geometry', crs=crs)
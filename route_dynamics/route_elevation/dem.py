@@ -0,0 +1,256 @@
+""" Block-cached sampling of elevation rasters (.tif) at route points """
+import os
+from collections import OrderedDict
+
+import numpy as np
+import rasterio
+
+from rasterio.windows import Window
+
+
+class RasterSampler():
+    """
+        Samples one band of a raster at many points at once.
+
+        The raster is opened once. Only the raster blocks that contain
+        the sampled cells are read, and the most recently used decoded
+        blocks are kept in memory so that routes in the same area
+        reuse them.
+
+        Values follow rasterstats.point_query: 'bilinear' interpolates
+        between the four cell centres around a point and falls back to
+        the nearest of them when one is nodata; 'nearest' returns the
+        cell containing the point. Points on nodata or outside the
+        raster are NaN.
+        """
+
+    def __init__(self, rasterfile, band=1, max_blocks=256):
+        """
+            Parameters
+            ----------
+            rasterfile: elevation data file (.tif)
+            band: band number to sample (counting from 1)
+            max_blocks: number of decoded blocks kept in memory
+            """
+
+        self.rasterfile = rasterfile
+        self.band = band
+        self.max_blocks = max_blocks
+
+        self._src = rasterio.open(rasterfile)
+        self.affine = self._src.transform
+        self.nodata = self._src.nodatavals[band - 1]
+        self.shape = (self._src.height, self._src.width)
+        self.block_shape = self._src.block_shapes[band - 1]
+
+        self._blocks = OrderedDict()
+        self.block_reads = 0
+
+    def close(self):
+        self._src.close()
+        self._blocks.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def sample(self, x, y, interpolate='bilinear'):
+        """
+            Raster values at the points ('x', 'y').
+
+            Parameters
+            ----------
+            x, y: arrays of point coordinates in the raster CRS
+            interpolate: 'bilinear' or 'nearest'
+
+            Returns
+            -------
+            values: float array, NaN at nodata and outside the raster
+            """
+
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+
+        # Fractional column and row of every point
+        fcol, frow = ~self.affine * (x, y)
+
+        if interpolate == 'nearest':
+            return self._cell_values(
+                np.floor(frow).astype(int),
+                np.floor(fcol).astype(int)
+                )
+
+        elif interpolate != 'bilinear':
+            raise ValueError("interpolate must be 'nearest' or 'bilinear'")
+
+        # 2x2 window of cells whose centres surround each point, and
+        # the position of the point on that unit square.
+        r = np.round(frow).astype(int)
+        c = np.round(fcol).astype(int)
+        unitx = 0.5 - (c - fcol)
+        unity = 0.5 + (r - frow)
+
+        ulv = self._cell_values(r - 1, c - 1)
+        urv = self._cell_values(r - 1, c)
+        llv = self._cell_values(r, c - 1)
+        lrv = self._cell_values(r, c)
+
+        values = (
+            (llv * (1 - unitx) * (1 - unity))
+            + (lrv * unitx * (1 - unity))
+            + (ulv * (1 - unitx) * unity)
+            + (urv * unitx * unity)
+            )
+
+        # Nearest of the four where any of them is nodata
+        incomplete = np.isnan(ulv) | np.isnan(urv) | np.isnan(llv) | np.isnan(lrv)
+        if np.any(incomplete):
+            lower = np.round(1 - unity[incomplete]) == 1
+            right = np.round(unitx[incomplete]) == 1
+            values[incomplete] = np.where(
+                lower,
+                np.where(right, lrv[incomplete], llv[incomplete]),
+                np.where(right, urv[incomplete], ulv[incomplete]),
+                )
+
+        return values
+
+    def _cell_values(self, rows, cols):
+        """ Values of raster cells, read block by block """
+
+        values = np.full(rows.shape, np.nan)
+
+        inside = (
+            (rows >= 0) & (rows < self.shape[0])
+            &
+            (cols >= 0) & (cols < self.shape[1])
+            )
+        if not np.any(inside):
+            return values
+
+        block_h, block_w = self.block_shape
+        rows_in = rows[inside]
+        cols_in = cols[inside]
+        block_ids = np.stack([rows_in // block_h, cols_in // block_w])
+
+        unique_ids, block_of_cell = np.unique(
+            block_ids, axis=1, return_inverse=True
+            )
+        block_of_cell = np.ravel(block_of_cell)
+
+        cell_values = np.empty(len(rows_in))
+        for k, (block_row, block_col) in enumerate(unique_ids.T):
+            in_block = block_of_cell == k
+            block = self._block(block_row, block_col)
+            cell_values[in_block] = block[
+                rows_in[in_block] - block_row*block_h,
+                cols_in[in_block] - block_col*block_w
+                ]
+
+        values[inside] = cell_values
+
+        return values
+
+    def _block(self, block_row, block_col):
+        """ Decoded block as floats with nodata as NaN, LRU cached """
+
+        key = (block_row, block_col)
+        if key in self._blocks:
+            self._blocks.move_to_end(key)
+            return self._blocks[key]
+
+        block_h, block_w = self.block_shape
+        window = Window(
+            block_col*block_w,
+            block_row*block_h,
+            min(block_w, self.shape[1] - block_col*block_w),
+            min(block_h, self.shape[0] - block_row*block_h),
+            )
+        block = self._src.read(self.band, window=window).astype(float)
+        if self.nodata is not None:
+            block[block == self.nodata] = np.nan
+        self.block_reads += 1
+
+        self._blocks[key] = block
+        if len(self._blocks) > self.max_blocks:
+            self._blocks.popitem(last=False)
+
+        return block
+
+
+# Open samplers, one per raster file, so successive routes share the
+# open dataset and its decoded blocks.
+_SAMPLERS = OrderedDict()
+_MAX_SAMPLERS = 4
+
+
+def open_sampler(rasterfile, band=1):
+    """
+        Returns the shared RasterSampler for 'rasterfile', opening it on
+        first use. A raster rewritten since (other modification time or
+        size) gets a new sampler, and the stale one is closed.
+        """
+
+    stat = os.stat(rasterfile)
+    path = os.path.abspath(rasterfile)
+    key = (path, band, stat.st_mtime_ns, stat.st_size)
+    if key in _SAMPLERS:
+        _SAMPLERS.move_to_end(key)
+        return _SAMPLERS[key]
+
+    for stale in [k for k in _SAMPLERS if k[:2] == (path, band)]:
+        _SAMPLERS.pop(stale).close()
+
+    sampler = RasterSampler(rasterfile, band=band)
+    _SAMPLERS[key] = sampler
+    if len(_SAMPLERS) > _MAX_SAMPLERS:
+        _SAMPLERS.popitem(last=False)[1].close()
+
+    return sampler
+
+
+def point_query(route_shp, rasterfile, interpolate='bilinear'):
+    """
+        Raster values at every vertex of every geometry in a
+        GeoDataFrame, in the layout of rasterstats.point_query.
+
+        Parameters
+        ----------
+        route_shp: GeoDataFrame of route geometries
+        rasterfile: elevation data file (.tif)
+        interpolate: 'bilinear' or 'nearest'
+
+        Returns
+        -------
+        values: list with one array of vertex values per geometry (a
+            single value for Point geometries)
+        """
+
+    geoms = list(route_shp.geometry.values)
+    coords = [_geometry_xy(geom) for geom in geoms]
+    sizes = [len(xy) for xy in coords]
+
+    if not coords:
+        return []
+
+    # Sample all routes in a single pass
+    xy = np.concatenate(coords)
+    values = open_sampler(rasterfile).sample(
+        xy[:, 0], xy[:, 1], interpolate=interpolate
+        )
+
+    split = np.split(values, np.cumsum(sizes)[:-1])
+
+    return [v[0] if len(v) == 1 else v for v in split]
+
+
+def _geometry_xy(geom):
+    """ (num_vertices, 2) array of the vertices of a shapely geometry """
+
+    if hasattr(geom, 'geoms'):
+        parts = [_geometry_xy(part) for part in geom.geoms]
+        return np.concatenate(parts) if parts else np.zeros((0, 2))
+
+    return np.asarray(geom.coords)[:, :2].reshape(-1, 2)
@@ -1,9 +1,20 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 import pandas as pd
+import geopandas as gpd
 
 from . import base
+from . import dem
 
 
-def routes_analysis_ranking(route_list, shapefile, rasterfile):
+def routes_analysis_ranking(
+    route_list,
+    shapefile,
+    rasterfile,
+    plot=True,
+    max_workers=None
+    ):
     """
     Computes the four chosen metrics values for each bus routes in route_list and display them on a bar plot for
     ease of comparison
@@ -13,28 +24,112 @@ def routes_analysis_ranking(route_list, shapefile, rasterfile):
     route_list: A list of bus routes to be compared (Integers)
     shapefile: route geospatial data (.shp file)
     rasterfile: elevation data file (.tif)
+    plot: draw the bar plot (default). With False no figure is made,
+        e.g. for batch runs without a display.
+    max_workers: number of processes computing the metrics, see
+        routes_metrics()
 
     Returns
     -------
-    bar plot: showing results comparison between bus routes according to the four metrics chosen
+    bar plot: showing results comparison between bus routes according to the four metrics chosen,
+        or with plot=False the DataFrame of routes_metrics()
     """
-    num_route = len(route_list)
-    metrics_1 = [0] * num_route
-    metrics_2 = [0] * num_route
-    metrics_3 = [0] * num_route
-    metrics_4 = [0] * num_route
-    for idx, route_num in enumerate(route_list):
-        route_shp = base.read_shape(shapefile, route_num)
-
-        elevation, elevation_gradient, route_cum_distance, distance = base.gradient(route_shp, rasterfile)
 
-        _ , metrics = base.route_metrics(elevation, elevation_gradient, route_cum_distance, distance, route_num)
+    data = routes_metrics(route_list, shapefile, rasterfile, max_workers)
 
-        metrics_1[idx], metrics_2[idx], metrics_3[idx], metrics_4[idx] = metrics
+    if not plot:
+        return data
 
-    data = pd.DataFrame({'Bus Num': route_list, 'M1': metrics_1, 'M2': metrics_2, 'M3': metrics_3, 'M4': metrics_4})
     ax = data.plot.bar('Bus Num', figsize= [14, 5], fontsize= 20)
     ax.set_ylabel('Metrics', size= 20)
     ax.set_xlabel('Bus Number', size= 20)
 
     return ax
+
+
+def routes_metrics(route_list, shapefile, rasterfile, max_workers=None):
+    """
+    Computes the four metrics of base.route_metrics() for each bus
+    route in route_list.
+
+    The shapefile is read once and split by ROUTE_NUM, and the
+    elevations of all routes are sampled from the raster in one pass.
+    The per-route metrics are then computed across processes.
+
+    Parameters
+    ----------
+    route_list: A list of bus routes to be compared (Integers)
+    shapefile: route geospatial data (.shp file)
+    rasterfile: elevation data file (.tif)
+    max_workers: number of worker processes (default: one per CPU).
+        With 1 the metrics are computed in this process.
+
+    Returns
+    -------
+    data: DataFrame with columns 'Bus Num', 'M1', 'M2', 'M3', 'M4', one
+        row per route in route_list
+    """
+
+    routes_shp = gpd.read_file(shapefile)
+
+    missing = set(route_list) - set(routes_shp['ROUTE_NUM'])
+    if missing:
+        raise ValueError(
+            'Routes {} are not in {}'.format(sorted(missing), shapefile)
+            )
+
+    # Rows of each route, in the order of route_list
+    route_rows = routes_shp.groupby('ROUTE_NUM').indices
+    route_shps = [
+        routes_shp.iloc[route_rows[route_num]] for route_num in route_list
+        ]
+
+    # Sample every route in one pass, one array per geometry
+    elevations = dem.point_query(
+        pd.concat(route_shps) if route_shps else routes_shp.iloc[:0],
+        rasterfile
+        )
+
+    tasks = []
+    start = 0
+    for route_num, route_shp in zip(route_list, route_shps):
+        tasks.append(
+            (route_num, route_shp, elevations[start:start + len(route_shp)])
+            )
+        start += len(route_shp)
+
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+
+    if max_workers == 1 or len(tasks) <= 1:
+        metrics = [_route_metrics(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            metrics = list(executor.map(
+                _route_metrics,
+                tasks,
+                chunksize=max(1, len(tasks) // (4*max_workers))
+                ))
+
+    data = pd.DataFrame(
+        metrics, columns=['M1', 'M2', 'M3', 'M4'], dtype=float
+        )
+    data.insert(0, 'Bus Num', list(route_list))
+
+    return data
+
+
+def _route_metrics(task):
+    """ Metrics of one route from its sampled elevations """
+
+    route_num, route_shp, elevation = task
+
+    elevation, elevation_gradient, route_cum_distance, distance = (
+        base.gradient_from_elevation(route_shp, elevation)
+        )
+
+    _ , metrics = base.route_metrics(
+        elevation, elevation_gradient, route_cum_distance, distance, route_num
+        )
+
+    return metrics
@@ -1,120 +1,421 @@
+import hashlib
+import time
+
 import pandas as pd
 import numpy as np
 
-def accel_dynamics(route_df, a_prof, a_pos, a_neg):
-
-    data = a_prof
-
-    #rounding values
-    data['time (s)'] = data['time (s)'].round(0)
-    data['accel. (g)'] = data['accel. (g)'].round(4)
+# Distance between consecutive route points after decimation of the
+# 6 ft point shapefiles (every 6th point kept), in meters.
+POINT_SPACING = 10.972265
 
-    #Convert to SI units
-    data['accel. (m/s^2)'] = data['accel. (g)']*9.81
+# Time the bus stands at each bus stop and signal, in seconds.
+DWELL_TIME = 30
 
-    #Calculate Velocity
 
-    data['vel. (m/s)'] = np.zeros(len(data.index))
+# Compiled acceleration profiles, keyed by a hash of their contents.
+_PROFILE_CACHE = {}
 
-    for i in range(1, len(data)):
-        data['vel. (m/s)'][i] = ((data['accel. (m/s^2)'][i] + data['accel. (m/s^2)'][i-1])/2*1) + data['vel. (m/s)'][i-1]
-    
-    data['vel. (mph)'] = data['vel. (m/s)']*2.2
 
-    #Calculate Distance
+class AccelerationProfile():
+    """ Measured bus acceleration away from a stop, compiled once into
+        read-only arrays sampled on a regular distance grid.
 
-    data['dist. (m)'] = np.zeros(len(data.index))
+        Build with 'AccelerationProfile.compile' (from a DataFrame with
+        columns 'time (s)' and 'accel. (g)') or 'from_csv' so that
+        identical profiles are compiled only once and shared.
+        """
 
-    for i in range(1, len(data)):
-        data['dist. (m)'][i] = ((data['vel. (m/s)'][i] + data['vel. (m/s)'][i-1])/2*1) + data['dist. (m)'][i-1]
+    def __init__(self, time_s, accel_g, grid_step_ft=36, grid_end_ft=1260):
+        """ Args:
+                'time_s': sample times of the measured profile [s]
+                'accel_g': measured acceleration at 'time_s' [g]
+                'grid_step_ft', 'grid_end_ft': distance grid of the
+                    compiled profile [ft]
+            """
 
-    
-    data['dist.(km)'] = data['dist. (m)']/1000
-    data['dist. (ft)'] = data['dist. (m)']*3.28
+        # Round as the measured samples are ~1 s apart
+        time_s = np.round(np.asarray(time_s, dtype=float), 0)
+        accel = np.round(np.asarray(accel_g, dtype=float), 4) * 9.81
 
-    #Create new dataframe where dist. is the indep var
+        # Integrate with the trapezoid rule over 1 s steps
+        vel = np.append(0., np.cumsum((accel[1:] + accel[:-1])/2*1))
+        dist = np.append(0., np.cumsum((vel[1:] + vel[:-1])/2*1))
 
-    data2 = pd.DataFrame({'dist. (ft)': np.arange(0, 1260, 36)})
-    data2['dist. (m)'] = data2['dist. (ft)']/3.281
+        # Resample on the distance grid. Lookups convert with 3.28 ft/m
+        # while the grid itself uses 3.281 ft/m.
+        grid_ft = np.arange(0, grid_end_ft, grid_step_ft)
+        lookup_m = grid_ft[1:] / 3.28
 
-    data2['vel. (m/s)'] = np.zeros(len(data2.index))
+        self._distance = grid_ft / 3.281
+        self._velocity = np.append(0., np.interp(lookup_m, dist, vel))
+        self._acceleration = np.append(0., np.interp(lookup_m, dist, accel))
+        self._time = np.append(0., np.interp(lookup_m, dist, time_s))
+
+        for array in (
+            self._distance, self._velocity, self._acceleration, self._time
+            ):
+            array.flags.writeable = False
+
+    @classmethod
+    def compile(cls, a_prof):
+        """ Returns the compiled profile for 'a_prof', a DataFrame with
+            columns 'time (s)' and 'accel. (g)'. Profiles with identical
+            contents share one cached instance. An 'AccelerationProfile'
+            is returned unchanged.
+            """
+
+        if isinstance(a_prof, cls):
+            return a_prof
+
+        time_s = np.ascontiguousarray(a_prof['time (s)'].values, dtype=float)
+        accel_g = np.ascontiguousarray(
+            a_prof['accel. (g)'].values, dtype=float
+            )
+
+        key = hashlib.sha1(
+            time_s.tobytes() + b'|' + accel_g.tobytes()
+            ).hexdigest()
+
+        if key not in _PROFILE_CACHE:
+            _PROFILE_CACHE[key] = cls(time_s, accel_g)
+
+        return _PROFILE_CACHE[key]
+
+    @classmethod
+    def from_csv(cls, filename):
+        """ Compiles a profile from a headerless csv of time [s] and
+            acceleration [g], such as 'data/acceleration.csv'.
+            """
+
+        a_prof = pd.read_csv(filename, names=['time (s)', 'accel. (g)'])
+
+        return cls.compile(a_prof)
+
+    def __len__(self):
+        return len(self._distance)
+
+    @property
+    def distance(self):
+        """ Distance from the stop at each grid point [m] """
+        return self._distance
+
+    @property
+    def velocity(self):
+        """ Velocity at each grid point [m/s] """
+        return self._velocity
+
+    @property
+    def acceleration(self):
+        """ Acceleration at each grid point [m/s^2] """
+        return self._acceleration
+
+    @property
+    def time(self):
+        """ Time since leaving the stop at each grid point [s] """
+        return self._time
+
+    @property
+    def length(self):
+        """ Distance covered by the profile [m] """
+        return self._distance[-1]
+
+    def velocity_at(self, distance):
+        """ Velocity [m/s] at 'distance' [m] from the stop """
+        return np.interp(distance, self._distance, self._velocity)
+
+    def acceleration_at(self, distance):
+        """ Acceleration [m/s^2] at 'distance' [m] from the stop """
+        return np.interp(distance, self._distance, self._acceleration)
+
+    def time_at(self, distance):
+        """ Time [s] to cover 'distance' [m] from the stop """
+        return np.interp(distance, self._distance, self._time)
+
+
+def stop_distances(is_stop, delta_x=POINT_SPACING, steps=None):
+    """ Distance from every route point to the next and the previous
+        stop, computed from the indicies of the stops in O(N).
+
+        Parameters
+        ----------
+        is_stop: boolean array, True at route points that are stops
+        delta_x: distance between consecutive route points [m]
+        steps: optional number of 'delta_x' steps from the point
+            before to each point, for resampled routes (the first
+            value is not used)
+
+        Returns
+        -------
+        x_ns: distance to the next stop (to the last point if there
+            is no stop ahead), zero at stops [m]
+        x_ls: distance since the previous stop (since the first point
+            if there is no stop behind), zero at stops [m]
+        """
+
+    is_stop = np.asarray(is_stop, dtype=bool)
+    num_pts = len(is_stop)
+    point_idx = np.arange(num_pts)
+    stop_idx = np.flatnonzero(is_stop)
+
+    # Position of the first stop after each point
+    pos = np.searchsorted(stop_idx, point_idx, side='right')
+    has_next = pos < len(stop_idx)
+    has_prev = pos > 0
+
+    next_idx = np.full(num_pts, num_pts - 1)
+    next_idx[has_next] = stop_idx[pos[has_next]]
+    prev_idx = np.zeros(num_pts, dtype=int)
+    prev_idx[has_prev] = stop_idx[pos[has_prev] - 1]
+
+    # Position of each point in steps
+    if steps is None:
+        step_pos = point_idx
+    else:
+        step_pos = np.append(
+            0, np.cumsum(np.asarray(steps[1:], dtype=int))
+            )
+
+    # Cumulative distance after k steps, summed in the same order as a
+    # point-by-point walk so results are bit-for-bit reproducible.
+    num_steps = step_pos[-1] if num_pts else 0
+    cum_dist = np.append(0., np.cumsum(np.full(num_steps, delta_x)))
+
+    x_ns = cum_dist[step_pos[next_idx] - step_pos]
+    x_ls = cum_dist[step_pos - step_pos[prev_idx]]
+    x_ns[is_stop] = 0.
+    x_ls[is_stop] = 0.
+
+    return x_ns, x_ls
+
+
+def _stop_distances_loop(is_stop, delta_x=POINT_SPACING):
+    """ Reference O(N^2) implementation of 'stop_distances' walking
+        forward and backward from every point to the nearest stop.
+        """
+
+    is_stop = np.asarray(is_stop, dtype=bool)
+
+    x_ns = np.zeros(len(is_stop)) #next stops
+    x_ls = np.zeros(len(is_stop)) # prev. stops
 
-    data2['vel. (km/hr)'] = np.zeros(len(data2.index))
-
-    data2['vel. (mph)'] = np.zeros(len(data2.index))
+    for i in range(len(x_ns)):
+        # set values to 0 if bus stop
+        if is_stop[i]:
+            # move to next point
+            continue
+        # Calculate 'x_ns';
+        # Iterate through remaining indicies to count distance to
+        # next stop.
+        for j in range(i+1, len(x_ns)):
+            # add distance to next point to 'x_ns'
+            x_ns[i] += delta_x
+            if is_stop[j]:
+                break # done calulating 'x_ns' at this point
+
+        # Calculate 'x_ls';
+        # Iterate through previous indicies to cout distance to
+        # last stop.
+        for j in range(i, 0, -1):
+            # Inclusive start to range because distances are
+            # backward difference. Dont need to include 'j=0'
+            # because the first point has no backward difference.
+            if is_stop[j]:
+                break # done calulating x_ls at this point
+            x_ls[i] += delta_x
+
+    return x_ns, x_ls
+
+
+def time_stop_distances(is_stop, delta_x=POINT_SPACING):
+    """ Times the vectorized and reference stop distance kernels on
+        one route and checks that they agree.
+
+        Parameters
+        ----------
+        is_stop: boolean array, True at route points that are stops
+        delta_x: distance between consecutive route points [m]
+
+        Returns
+        -------
+        timings: dict with keys 'num_points', 'num_stops', 'loop_s',
+            'vectorized_s', 'speedup' and 'max_abs_diff'
+        """
+
+    start = time.perf_counter()
+    x_ns_loop, x_ls_loop = _stop_distances_loop(is_stop, delta_x)
+    loop_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    x_ns, x_ls = stop_distances(is_stop, delta_x)
+    vectorized_s = time.perf_counter() - start
+
+    max_abs_diff = max(
+        np.max(np.abs(x_ns - x_ns_loop), initial=0.),
+        np.max(np.abs(x_ls - x_ls_loop), initial=0.),
+        )
+
+    return {
+        'num_points': len(x_ns),
+        'num_stops': int(np.count_nonzero(is_stop)),
+        'loop_s': loop_s,
+        'vectorized_s': vectorized_s,
+        'speedup': loop_s / vectorized_s if vectorized_s > 0 else np.inf,
+        'max_abs_diff': max_abs_diff,
+        }
+
+
+def accel_dynamics(route_df, a_prof, a_pos, a_neg, check_stop_distances=False):
+    """ Assigns acceleration, velocity and time step to every route
+        point from the distances to the surrounding stops.
+
+        Set 'check_stop_distances' to cross-check the vectorized stop
+        distances against the reference loop; raises ValueError if
+        they differ.
+
+        A 'steps' column (see 'resample') gives the number of point
+        spacings from the point before to each point; stop distances
+        and time steps then use the actual spacing. Resampled routes
+        keep single steps where the bus speeds up or brakes.
+        """
+
+    profile = AccelerationProfile.compile(a_prof)
+
+    is_stop = np.asarray(route_df['is_stop'], dtype=bool)
+    speed_limit = np.asarray(route_df['speed_limit'])
+
+    steps = None
+    if 'steps' in route_df:
+        steps = np.asarray(route_df['steps'])
+
+    x_ns, x_ls = stop_distances(is_stop, steps=steps)
+
+    if check_stop_distances and steps is None:
+        x_ns_loop, x_ls_loop = _stop_distances_loop(is_stop)
+        if not (
+            np.array_equal(x_ns, x_ns_loop)
+            and
+            np.array_equal(x_ls, x_ls_loop)
+            ):
+            raise ValueError(
+                "Vectorized stop distances disagree with the reference "
+                "loop; max abs diff in 'x_ns' = {}, 'x_ls' = {}".format(
+                    np.max(np.abs(x_ns - x_ns_loop)),
+                    np.max(np.abs(x_ls - x_ls_loop)),
+                    )
+                )
+
+    v = np.zeros(len(route_df)) #array for vel.
+    a = np.zeros(len(route_df)) #array for accel.
+
+    _walk_points(
+        v, a, x_ns, x_ls, is_stop, speed_limit, profile, a_pos, a_neg
+        )
+
+    delta_times = _delta_times(route_df, v, steps)
 
-    data2['accel. (m/s^2)'] = np.zeros(len(data2.index))
+    return a, v, x_ls, x_ns, delta_times
 
-    data2['time (s)'] = np.zeros(len(data2.index))
 
-    for i in range(1, len(data2)):
+def point_dynamics(route_df, a_prof, a_pos, a_neg):
+    """ 'accel_dynamics' without a loop over the route points. Returns
+        the same arrays.
+
+        After each stop (and from the first point) the bus follows the
+        acceleration profile, one grid step per point from the point
+        after the stop, until it reaches the speed limit there. It
+        holds that speed until it is within braking distance of the
+        next stop, then brakes as in 'accel_dynamics'. These stretches
+        are filled for all stops at once. Stretches the rules do not
+        cover, where the limit after the stop is beyond the end of the
+        profile or the limit drops below the held speed before the
+        stop, are walked point by point as in 'accel_dynamics'.
+        Resampled routes (with a 'steps' column) are walked in full.
+        """
+
+    if 'steps' in route_df:
+        return accel_dynamics(route_df, a_prof, a_pos, a_neg)
+
+    profile = AccelerationProfile.compile(a_prof)
+
+    is_stop = np.asarray(route_df['is_stop'], dtype=bool)
+    speed_limit = np.asarray(route_df['speed_limit'], dtype=float)
+    num_pts = len(is_stop)
+
+    x_ns, x_ls = stop_distances(is_stop)
+    brake_distance = speed_limit**2. / (2*abs(a_neg))
+
+    # The stretch after each stop starts at the point after it, and
+    # ends at the next stop
+    point_idx = np.arange(num_pts)
+    stop_idx = np.flatnonzero(is_stop)
+    pos = np.searchsorted(stop_idx, point_idx, side='right')
+    entry = np.zeros(num_pts, dtype=int)
+    entry[pos > 0] = stop_idx[pos[pos > 0] - 1] + 1
+    entry = np.minimum(entry, num_pts - 1)
+    step = point_idx - entry
+
+    # Speed held after the profile, and the profile step reaching it
+    v_lim = speed_limit[entry]
+    reached = np.searchsorted(profile.velocity, v_lim)
+
+    # Points from the entry on, up to the braking distance from the
+    # held speed, follow the profile and then hold the speed. Later
+    # points brake at their own limit.
+    held = (
+        ~is_stop
+        & (x_ns > brake_distance[entry])
+        & (x_ls[entry] < profile.length)
+        )
+    braking = ~is_stop & ~held & (x_ns <= brake_distance)
+
+    covered = is_stop | held | braking
+    covered &= (v_lim > 0) & (reached < len(profile))
+
+    a = np.zeros(num_pts)
+    v = np.zeros(num_pts)
+
+    on_profile = held & (step <= np.minimum(reached, len(profile) - 1))
+    v[on_profile] = profile.velocity[step[on_profile]]
+    a[on_profile] = profile.acceleration[step[on_profile]]
+    v[held & ~on_profile] = v_lim[held & ~on_profile]
+    v[braking] = np.sqrt(2*abs(a_neg)*x_ns[braking])
+    a[braking] = a_neg
+
+    # Walk the stretches with any point the rules do not cover
+    for start in np.unique(entry[~covered]):
+        stop = np.searchsorted(stop_idx, start)
+        stop = stop_idx[stop] if stop < len(stop_idx) else num_pts
+        v[start:stop] = 0
+        a[start:stop] = 0
+        _walk_points(
+            v, a, x_ns, x_ls, is_stop, speed_limit, profile, a_pos, a_neg,
+            start,
+            stop
+            )
+
+    delta_times = _delta_times(route_df, v)
 
-        z = data2['dist. (ft)'].iloc[i]
-        params = data.iloc[(data['dist. (ft)']-z).abs().argsort()[:1]]
-        row = params.index.values
+    return a, v, x_ls, x_ns, delta_times
 
 
-        #Interpolate
-        if params['dist. (ft)'].values < z:
-            vel = ((data['vel. (m/s)'][row+1].values - data['vel. (m/s)'][row].values)/(data['dist. (m)'][row +1].values - data['dist. (m)'][row].values) * (z/3.28 - data['dist. (m)'][row].values)) + data['vel. (m/s)'][row].values
-            accel = ((data['accel. (m/s^2)'][row+1].values - data['accel. (m/s^2)'][row].values)/(data['dist. (m)'][row +1].values - data['dist. (m)'][row].values) * (z/3.28 - data['dist. (m)'][row].values)) + data['accel. (m/s^2)'][row].values
-            time = ((data['time (s)'][row+1].values - data['time (s)'][row].values)/(data['dist. (m)'][row +1].values - data['dist. (m)'][row].values) * (z/3.28 - data['dist. (m)'][row].values)) + data['time (s)'][row].values
-        else:
-            vel = ((data['vel. (m/s)'][row].values - data['vel. (m/s)'][row-1].values)/(data['dist. (m)'][row].values - data['dist. (m)'][row-1].values) * (z/3.28 - data['dist. (m)'][row-1].values)) + data['vel. (m/s)'][row-1].values
-            accel = ((data['accel. (m/s^2)'][row].values - data['accel. (m/s^2)'][row-1].values)/(data['dist. (m)'][row].values - data['dist. (m)'][row-1].values) * (z/3.28 - data['dist. (m)'][row-1].values)) + data['accel. (m/s^2)'][row-1].values
-            time = ((data['time (s)'][row].values - data['time (s)'][row-1].values)/(data['dist. (m)'][row].values - data['dist. (m)'][row-1].values) * (z/3.28 - data['dist. (m)'][row-1].values)) + data['time (s)'][row-1].values
-        
-    
-        data2['vel. (m/s)'].iloc[i] = vel
-        data2['vel. (km/hr)'].iloc[i] = vel * 3.6
-        data2['vel. (mph)'].iloc[i] = vel*2.2
-        data2['accel. (m/s^2)'].iloc[i] = accel
-        data2['time (s)'].iloc[i] = time
+def _walk_points(
+    v, a, x_ns, x_ls, is_stop, speed_limit, profile, a_pos, a_neg,
+    start=0,
+    stop=None
+    ):
+    """ Assigns acceleration and velocity point by point from 'start'
+        up to 'stop' (default: the last point), in place. The bus is at
+        rest at the point before 'start' (or at a stop there).
+        """
 
     # Distance of accel profile
+    x_p = profile.length
 
-    x_p = data2['dist. (m)'].iloc[-1]
-
-    x_ns = np.zeros(len(route_df.index)) #next stops
-    x_ls = np.zeros(len(route_df.index)) # prev. stops
-
-    for i in range(len(x_ns)):
-        # set values to Nan if bus stop
-        if route_df.at[i, 'is_stop']:
-            x_ns[i] = 0.
-            x_ls[i] = 0.
-            # move to next point
-            continue
-        else:
-            # Calculate 'x_ns';
-            # Iterate through remaining indicies to count distance to
-            # next stop.
-            for j in range(i+1, len(x_ns)):
-                # add distance to next point to 'x_ns'
-                x_ns[i] += 10.972265 
-                if route_df.at[j, 'is_stop']:
-                    break # done calulating 'x_ns' at this point
-                # elif not bus stop: move to next point, add distance
-
-            # Calculate 'x_ls';
-            # Iterate through previous indicies to cout distance to
-            # last stop.
-            for j in range(i, 0, -1):
-                # Inclusive start to range because distances are
-                # backward difference. Dont need to include 'j=0'
-                # because the first point has no backward difference.
-                if route_df.at[j, 'is_stop']:
-                    break # done calulating x_ls at this point
-                x_ls[i] += 10.972265
-
-    v = np.zeros(len(route_df.index)) #array for vel.
-    a = np.zeros(len(route_df.index)) #array for accel.
-
-    count = 0
+    count = start
 
-    for i in range(len(x_ns)):
-        x_d = route_df['speed_limit'].iloc[i]**2. / (2*a_neg)
-        v_lim = route_df['speed_limit'].iloc[i]
+    for i in range(start, len(x_ns) if stop is None else stop):
+        x_d = speed_limit[i]**2. / (2*a_neg)
+        v_lim = speed_limit[i]
 
         if count > i:
             continue
@@ -126,7 +427,7 @@ def accel_dynamics(route_df, a_prof, a_pos, a_neg):
             if (
                 x_ns[i]<=abs(x_d)
                 and
-                not route_df.at[i, 'is_stop']
+                not is_stop[i]
                 ):
 
                 a[i] = a_neg
@@ -140,7 +441,7 @@ def accel_dynamics(route_df, a_prof, a_pos, a_neg):
                 and
                 x_ls[i] >= x_p
                 and
-                not route_df.at[i, 'is_stop']
+                not is_stop[i]
                 ):
 
                 if v[i-1] < v_lim:
@@ -173,18 +474,18 @@ def accel_dynamics(route_df, a_prof, a_pos, a_neg):
                 and
                 x_ns[i] > abs(x_d)
                 and
-                not route_df.at[i, 'is_stop']
+                not is_stop[i]
                 ):
 
-                for j in range(len(data2)):
+                for j in range(len(profile)):
 
                     if count < len(x_ns):
 
                         if v[count-1] < v_lim:
 
-                            while x_ns[count]>abs(x_d) and j<len(data2) and v[count-1] < v_lim:
-                                a[count] = data2['accel. (m/s^2)'].iloc[j]
-                                v[count] = data2['vel. (m/s)'].iloc[j]
+                            while x_ns[count]>abs(x_d) and j<len(profile) and v[count-1] < v_lim:
+                                a[count] = profile.acceleration[j]
+                                v[count] = profile.velocity[j]
                                 j+=1
                                 count+=1
 
@@ -212,11 +513,19 @@ def accel_dynamics(route_df, a_prof, a_pos, a_neg):
                         break
 
 
-            elif route_df.at[i, 'is_stop']:
+            elif is_stop[i]:
 
                 count += 1
 
+
+def _delta_times(route_df, v, steps=None):
+    """ Time steps between consecutive route points from the mean of
+        their velocities, with the dwell time at bus stops and signals.
+        """
+
     back_diff_delta_x = np.full(len(route_df), 10.9728)
+    if steps is not None:
+        back_diff_delta_x *= steps
 
 
     segment_avg_velocities = (
@@ -228,20 +537,16 @@ def accel_dynamics(route_df, a_prof, a_pos, a_neg):
     delta_times = back_diff_delta_x / segment_avg_velocities
     delta_times[delta_times > 1000000] = 0
 
-    for i in range(len(route_df)):
-        if route_df.at[i, 'is_bus_stop']:
-            delta_times[i]+=30 #make variable later
-
-        elif route_df.at[i, 'is_signal']:
-            delta_times[i]+=30 #make variable later
-        else:
-            pass
+    # Dwell time at bus stops and signals
+    dwell = (
+        np.asarray(route_df['is_bus_stop'], dtype=bool)
+        |
+        np.asarray(route_df['is_signal'], dtype=bool)
+        )
+    delta_times[dwell] += DWELL_TIME
 
     #time_on_route = np.append(0, np.cumsum(delta_times[1:]))
 
     #t = time_on_route
 
-    
-
-
-    return a, v, x_ls, x_ns, delta_times
+    return delta_times
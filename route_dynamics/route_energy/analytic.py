@@ -0,0 +1,469 @@
+""" Closed-form stop-to-stop kinematics and energy of a route.
+    """
+import numpy as np
+import pandas as pd
+
+from . import longi_dynam_model as ldm
+from . import accel as ca
+from .route_state import RouteState
+
+
+# Phases of a stop-to-stop segment, in order
+PHASES = ('accelerate', 'cruise', 'brake')
+
+# Speed limit of routes without any, 25 mph in m/s
+DEFAULT_SPEED_LIMIT = 25/2.237
+
+
+class AnalyticRouteTrajectory(ldm.RouteTrajectory):
+    """ RouteTrajectory solved segment by segment in closed form
+        instead of point by point.
+
+        Between consecutive stops (bus stops and signals, and the
+        route ends) the bus follows the rules of
+        'accel.accel_dynamics': from the point after the stop it takes
+        one step of the acceleration profile per point until it
+        reaches the speed limit there (beyond the end of the profile
+        the steps start over, as in the point model), holds that
+        speed, then the limit before the next stop if that is lower,
+        and brakes at 'a_neg' to rest at the stop. In a segment too
+        short to reach the speed the bus accelerates until it is
+        within braking distance of that speed, then brakes. Missing
+        (zero) speed limits take the limit of the point before.
+
+        Time and traction energy of each phase are summed as the point
+        model sums them, power times the time step from the mean speed
+        since the point before, from prefix sums: over the profile
+        steps and the braking speeds for inertia and drag, and over
+        the route points for the held speeds and for grade and rolling
+        resistance (its mean over the phase when accelerating and
+        braking). Work is converted to battery energy with the motor or
+        regenerative efficiency by its sign: per point on the cruise,
+        where it follows the grade, and per phase when accelerating
+        and braking. Phases of all segments are solved at once,
+        without a loop over points.
+
+        With 'charging_power_max' set, 'summary' applies the traction
+        power cap as RouteTrajectory does: '_cap_traction_power' on the
+        columns of 'point_columns', from 'accel.point_dynamics'.
+        'phases' and the summary without a cap are uncapped.
+
+        Takes the arguments of RouteTrajectory. 'resample_tolerance'
+        has no effect, as every route point is kept.
+        """
+
+    def __init__(self,
+        route_num,
+        shp_filename,
+        a_prof,
+        stop_coords=None,
+        signal_coords=None,
+        mass_array=None,
+        unloaded_bus_mass=12927,
+        charging_power_max=None,
+        aux=None,
+        a_pos=0.4,
+        a_neg=-1.5,
+        cache_dir=None,
+        profile=False,
+        profile_hook=None,
+        resample_tolerance=None,
+        stop_pattern=(3, 3),
+        snap_distance=None,
+        stop_index=None
+        ):
+
+        self._initialize_instance_args(
+            route_num,
+            shp_filename,
+            a_prof,
+            stop_coords,
+            signal_coords,
+            mass_array,
+            unloaded_bus_mass,
+            charging_power_max,
+            aux,
+            a_pos,
+            a_neg,
+            cache_dir,
+            profile,
+            profile_hook,
+            resample_tolerance,
+            stop_pattern,
+            snap_distance,
+            stop_index
+            )
+
+        self.route_state = RouteState.from_dataframe(
+            self.build_route_coordinate_df(
+                shp_filename = shp_filename
+                )
+            )
+        self._add_stops_to_df(stop_coords, signal_coords, self.route_state)
+        self._add_mass_to_df(self.route_state)
+
+        self._phases = self._solve_phases()
+
+    def _solve_phases(self):
+        """ Dict of per-segment arrays: point bounds, length, mass, the
+            speeds held on the cruise and before the next stop, the
+            number of route points of each phase, and the length, time,
+            traction work and battery energy in J of each phase
+            (segments x phases). 'peak_traction' is the largest
+            traction power of each segment in W.
+            """
+
+        route_state = self.route_state
+        num_pts = len(route_state)
+        profile = self.a_prof
+        brake = -self.a_neg
+        spacing = ca.POINT_SPACING
+
+        bounds = np.union1d([0, num_pts - 1], route_state.stop_idx)
+        start = bounds[:-1]
+        end = bounds[1:]
+
+        # The bus sets off from the point after a stop (from the first
+        # point at the start of the route), holds the speed limit there
+        # and, if the limit before the next stop is lower, that limit
+        is_stop = np.asarray(route_state['is_stop'], dtype=bool)
+        entry = np.minimum(start + is_stop[start], end)
+        num_free = end - entry
+
+        mass = np.asarray(route_state['mass'])[np.minimum(start + 1, end)]
+
+        speed_limit = _fill_speed_limits(route_state['speed_limit'])
+        v_cruise = speed_limit[entry]
+        v_approach = np.minimum(
+            speed_limit[np.maximum(end - 1, entry)], v_cruise
+            )
+
+        # Points within braking distance of each speed from the stop
+        def num_braking(v):
+            return np.floor(v**2/(2*brake)/spacing).astype(int)
+
+        num_held = np.clip(num_free - num_braking(v_cruise), 0, num_free)
+        num_brake = np.minimum(num_braking(v_approach), num_free - num_held)
+        num_approach = num_free - num_held - num_brake
+
+        # Profile step of each point from the entry on. Below the end of
+        # the profile the bus leaves it at the step reaching the held
+        # speed; above it the point model starts the profile over from
+        # its next step each time it runs out.
+        steps = np.concatenate(
+            [np.arange(k, len(profile)) for k in range(len(profile))]
+            )
+        reached = np.searchsorted(profile.velocity, v_cruise)
+        num_accel = np.minimum(
+            np.where(reached < len(profile), reached + 1, len(steps)),
+            num_held
+            )
+        num_cruise = num_held - num_accel
+
+        # Grade and rolling resistance per unit mass at each route
+        # point, and its prefix sum
+        grad_angle = np.arctan(np.asarray(route_state['grade'], dtype=float))
+        resistance = ldm.GRAVI_ACCEL * (
+            np.sin(grad_angle) + ldm.FRIC_COEFF*np.cos(grad_angle)
+            )
+        cum_resistance = np.append(0., np.cumsum(resistance))
+
+        def mean_resistance(first, stop):
+            with np.errstate(divide='ignore', invalid='ignore'):
+                return np.where(
+                    stop > first,
+                    (cum_resistance[stop] - cum_resistance[first])
+                    / (stop - first),
+                    0
+                    )
+
+        # The point model sums power times time step over the points,
+        # with the time step from the mean speed since the point
+        # before. Sums over the profile steps:
+        step_v = profile.velocity[steps]
+        step_dt = _step_times(step_v, np.append(0., step_v[:-1]))
+        (
+            accel_time,
+            accel_distance,
+            accel_v3,
+            accel_av
+            ) = _prefix_sums(
+            step_dt,
+            step_v*step_dt,
+            step_v**3*step_dt,
+            profile.acceleration[steps]*step_v*step_dt
+            )[:, num_accel]
+        accel_resistance = mean_resistance(entry + 1, entry + num_accel)
+        v_accel = np.where(num_accel > 0, step_v[num_accel - 1], 0)
+
+        accel_work = mass*(
+            ldm.INERTIA_FACTOR*accel_av + accel_resistance*accel_distance
+            ) + ldm.DRAG*accel_v3
+
+        # Points holding a speed, from prefix sums of the traction force
+        # and its battery energy at each point. The first point of a
+        # stretch takes its time step from the speed before it.
+        segment = np.minimum(
+            np.searchsorted(end, np.arange(num_pts)), len(end) - 1
+            )
+        cruise_first = entry + num_accel
+        approach_first = entry + num_held
+        approach_stop = approach_first + num_approach
+        held_speed = np.where(
+            np.arange(num_pts) < approach_first[segment],
+            v_cruise[segment],
+            v_approach[segment]
+            )
+        held_force = (
+            np.asarray(route_state['mass'])*resistance + ldm.DRAG*held_speed**2
+            )
+        cum_force = np.append(0., np.cumsum(held_force))
+        cum_energy = np.append(0., np.cumsum(_battery_energy(held_force)))
+
+        def hold(first, num, v, v_before):
+            first_dt = _step_times(v, v_before)
+            point = np.minimum(first, num_pts - 1)
+            scale = np.where(num > 0, v*first_dt/spacing - 1, 0)
+            work = spacing*(
+                cum_force[first + num] - cum_force[first]
+                + scale*held_force[point]
+                )
+            energy = spacing*(
+                cum_energy[first + num] - cum_energy[first]
+                + scale*_battery_energy(held_force[point])
+                )
+            time = np.where(
+                num > 0, np.maximum(num - 1, 0)*spacing/v + first_dt, 0
+                )
+            return work, energy, time
+
+        v_held = np.where(num_cruise > 0, v_cruise, v_accel)
+        cruise_work, cruise_energy, cruise_time = hold(
+            cruise_first, num_cruise, v_cruise, v_accel
+            )
+        approach_work, approach_energy, approach_time = hold(
+            approach_first, num_approach, v_approach, v_held
+            )
+        v_held = np.where(num_approach > 0, v_approach, v_held)
+
+        # Braking 'k' points before the stop at the speed reached 'k'
+        # point spacings from rest, and the stop (or route end) at rest.
+        # The first braking point follows the speed held before it.
+        k = np.arange(np.max(num_brake, initial=0) + 2)
+        brake_v = np.sqrt(2*brake*spacing*k)
+        brake_dt = _step_times(brake_v, np.append(brake_v[1:], 0.))
+        v_first = brake_v[num_brake]
+        first_dt = _step_times(v_first, v_held)
+        (
+            brake_time,
+            brake_distance,
+            brake_v3
+            ) = _prefix_sums(
+            brake_dt, brake_v*brake_dt, brake_v**3*brake_dt
+            )[:, num_brake] + np.stack([
+                first_dt, v_first*first_dt, v_first**3*first_dt
+                ])
+        brake_resistance = mean_resistance(approach_stop, end)
+
+        brake_work = mass*(
+            (ldm.INERTIA_FACTOR*self.a_neg + brake_resistance)*brake_distance
+            ) + ldm.DRAG*brake_v3
+
+        accel_points = np.maximum(entry + num_accel - start - 1, 0)
+        phase_points = np.column_stack([
+            accel_points,
+            num_cruise + num_approach,
+            end - start - accel_points - num_cruise - num_approach
+            ])
+        phase_time = np.column_stack([
+            accel_time, cruise_time + approach_time, brake_time
+            ])
+        work = np.column_stack([
+            accel_work, cruise_work + approach_work, brake_work
+            ])
+
+        # Battery energy of each phase from its net work, except on
+        # the cruise, where the sign of the traction force follows the
+        # grade: there the force at each point is converted.
+        energy = _battery_energy(work)
+        energy[:, 1] = cruise_energy + approach_energy
+
+        # Largest traction power on the profile, at the grade of each
+        # step's point, and on the cruise
+        profile_idx = entry[:, None] + np.arange(len(profile))
+        on_profile = profile_idx < entry[:, None] + num_accel[:, None]
+        profile_power = profile.velocity*(
+            mass[:, None]*(
+                ldm.INERTIA_FACTOR*profile.acceleration
+                + resistance[np.minimum(profile_idx, num_pts - 1)]
+                )
+            + ldm.DRAG*profile.velocity**2
+            )
+        holding = (
+            (np.arange(num_pts) >= cruise_first[segment])
+            & (np.arange(num_pts) < approach_stop[segment])
+            )
+        peak_traction = np.maximum(
+            np.max(profile_power, axis=1, initial=0., where=on_profile),
+            np.maximum.reduceat(
+                np.where(holding, held_force*held_speed, 0), start
+                )
+            )
+
+        return {
+            'start': start,
+            'end': end,
+            'length': (end - start)*spacing,
+            'mass': mass,
+            'cruise_speed': v_cruise,
+            'approach_speed': v_approach,
+            'phase_points': phase_points,
+            'phase_length': phase_points*spacing,
+            'phase_time': phase_time,
+            'phase_work': work,
+            'phase_energy': energy,
+            'peak_traction': peak_traction,
+            }
+
+    def phases(self):
+        """ DataFrame with one row per segment phase: the segment's
+            route point bounds, phase, length in m, time in s, traction
+            work in J and battery energy in kWh (without auxiliary
+            load, dwell or power cap).
+            """
+
+        phases = self._phases
+        num_segments = len(phases['start'])
+
+        return pd.DataFrame({
+            'segment': np.repeat(np.arange(num_segments), len(PHASES)),
+            'start': np.repeat(phases['start'], len(PHASES)),
+            'end': np.repeat(phases['end'], len(PHASES)),
+            'phase': np.tile(PHASES, num_segments),
+            'length_m': phases['phase_length'].ravel(),
+            'time_s': phases['phase_time'].ravel(),
+            'work_j': phases['phase_work'].ravel(),
+            'energy_kwh': phases['phase_energy'].ravel()/3.6e6,
+            })
+
+    def summary(self):
+        """ Energy used in kWh, time on route in seconds and peak
+            battery power in W.
+            """
+
+        if self.charging_power_max is not None:
+            return self._capped_summary()
+
+        phases = self._phases
+
+        time_on_route = (
+            np.sum(phases['phase_time'])
+            # The point model leaves out the time step of the first
+            # point, so also a stop there
+            + ca.DWELL_TIME * np.count_nonzero(self.route_state.stop_idx)
+            )
+        energy = (
+            np.sum(phases['phase_energy'])
+            + self.aux/ldm.EFF_AUX * time_on_route
+            ) / 3.6e6
+
+        peak_power = (
+            np.max(phases['peak_traction'], initial=0.)
+            / (ldm.EFF_MOTOR*ldm.EFF_INV)
+            + self.aux/ldm.EFF_AUX
+            )
+
+        return {
+            'energy_kwh': energy,
+            'time_on_route_s': time_on_route,
+            'peak_power_w': peak_power,
+            }
+
+    def _capped_summary(self):
+        """ 'summary' with the traction power cap applied to the
+            per-point columns, as in 'RouteTrajectory.mass_scenarios'.
+            """
+
+        columns = self.point_columns()
+        columns['grade'] = self.route_state['grade']
+        columns['mass'] = self.route_state['mass']
+
+        (
+            columns['grav_force'],
+            columns['roll_fric']
+            ) = self.calculate_const_forces(columns)
+
+        (
+            columns['aero_drag'],
+            columns['inertia']
+            ) = self.calculate_forces(
+            columns['mass'],
+            columns['acceleration'],
+            columns['velocity']
+            )
+
+        columns['power_output'] = self._calculate_batt_power_exert(columns)
+
+        energy, time_on_route = self.energy_from_route(columns)
+
+        return {
+            'energy_kwh': energy,
+            'time_on_route_s': time_on_route[-1],
+            'peak_power_w': np.max(columns['power_output']),
+            }
+
+    def point_columns(self):
+        """ Acceleration, velocity and time step at every route point,
+            as the columns of 'accel.accel_dynamics' (before the power
+            cap), from 'accel.point_dynamics'.
+            """
+
+        (
+            acceleration,
+            velocity,
+            _,
+            _,
+            delta_times
+            ) = ca.point_dynamics(
+            self.route_state, self.a_prof, self.a_pos, self.a_neg
+            )
+
+        return {
+            'acceleration': acceleration,
+            'velocity': velocity,
+            'delta_times': delta_times,
+            }
+
+
+def _step_times(velocity, velocity_before):
+    """ Time steps over one point spacing from the mean of the speeds,
+        zero from rest to rest, as in 'accel.accel_dynamics'.
+        """
+    with np.errstate(divide='ignore'):
+        delta_times = ca.POINT_SPACING / ((velocity + velocity_before)/2)
+    return np.where(np.isfinite(delta_times), delta_times, 0)
+
+
+def _prefix_sums(*values):
+    """ (len(values), n + 1) sums of the first 0 to n entries of each
+        of 'values'.
+        """
+    return np.stack([np.append(0., np.cumsum(v)) for v in values])
+
+
+def _fill_speed_limits(speed_limit):
+    """ Speed limits with missing (zero or NaN) values taken from the
+        point before, or after at the start of the route.
+        """
+    speed_limit = pd.Series(np.array(speed_limit, dtype=float))
+    speed_limit[~(speed_limit > 0)] = np.nan
+    return speed_limit.ffill().bfill().fillna(DEFAULT_SPEED_LIMIT).values
+
+
+def _battery_energy(work):
+    """ Battery energy in J of traction work in J """
+    return np.where(
+        work >= 0,
+        work/(ldm.EFF_MOTOR*ldm.EFF_INV),
+        ldm.REGEN*ldm.EFF_MOTOR*ldm.EFF_INV*work
+        )
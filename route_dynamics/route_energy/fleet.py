@@ -0,0 +1,376 @@
+""" Run RouteTrajectory over many routes and bus configurations in
+    parallel and collect the results in one table.
+    """
+import os
+import traceback
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+
+from . import longi_dynam_model as ldm
+from . import accel as ca
+from . import streaming
+
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), '..', '..', 'data')
+
+# Result columns, in table order, besides the scalar parameters
+RESULT_COLUMNS = [
+    'route_num',
+    'param_set',
+    'num_points',
+    'energy_kwh',
+    'time_on_route_s',
+    'peak_power_w',
+    'error',
+    ]
+
+# Process pools tried with all unfinished tasks before a crashing
+# worker is tracked down by running the rest one pool per task
+_POOL_ATTEMPTS = 2
+
+
+def route_shapefile(route_num, data_dir):
+    """ Path of the point shapefile of 'route_num' in 'data_dir' """
+    return os.path.join(data_dir, 'rt{}_pts2.shp'.format(route_num))
+
+
+def signal_coords_by_route(shapefile):
+    """ Reads a signal shapefile with a 'Route_Num' column, such as
+        'data/traffic_signals2.shp', into a dict mapping route number
+        to a list of signal coordinate tuples.
+        """
+
+    signals = gpd.read_file(shapefile).explode(index_parts=False)
+    route_nums = signals['Route_Num'].astype(int).values
+
+    coords = {}
+    for route_num, geom in zip(route_nums, signals.geometry.values):
+        coords.setdefault(route_num, []).append((geom.x, geom.y))
+
+    return coords
+
+
+def run_fleet(
+    route_nums,
+    a_prof,
+    stop_coords=None,
+    signal_coords=None,
+    mass_arrays=None,
+    param_sets=None,
+    data_dir=DATA_DIR,
+    max_workers=None,
+    cache_dir=None,
+    segment_cache=None,
+    profile_hook=None,
+    shapefiles=None
+    ):
+    """ Simulates every route in 'route_nums' with every parameter set
+        in 'param_sets' across a process pool.
+
+        Tasks are submitted longest route first (by shapefile size) so
+        the long routes do not finish last on a single worker. The
+        returned table is ordered by route (as given) then parameter
+        set, whatever order the tasks finish in. A task that raises
+        gets its traceback in the 'error' column and NaN results; the
+        other tasks are unaffected, also when a task crashes its worker
+        process.
+
+        Parameters
+        ----------
+        route_nums: route numbers, read from 'rt<num>_pts2.shp' in
+            'data_dir'
+        a_prof: acceleration profile DataFrame or AccelerationProfile
+        stop_coords, signal_coords, mass_arrays: per-route stop
+            coordinates, signal coordinates and mass at each stop.
+            Either a dict keyed by route number or a function of the
+            route number. Routes without an entry get no stops, no
+            signals, or an empty bus respectively.
+        param_sets: list of dicts of keyword arguments for
+            RouteTrajectory, e.g. 'charging_power_max', 'aux',
+            'unloaded_bus_mass', 'a_pos', 'a_neg'. Defaults to one
+            empty set.
+        data_dir: directory holding the route shapefiles, by default
+            'data/' in the repository
+        max_workers: number of worker processes. With 1 the tasks run
+            in this process.
+        cache_dir: optional directory of cached route coordinate
+            arrays shared by all workers, see 'base_df.wrapper'
+        segment_cache: optional 'streaming.SegmentCache'. Routes are
+            then simulated segment by segment, reusing segments shared
+            with routes run before, in this process.
+        profile_hook: optional function of a route number and a
+            'profiling.StageRecord', called in this process for every
+            stage run of every task, e.g. a 'profiling.StageCosts'.
+            Routes are then profiled (see RouteTrajectory).
+        shapefiles: optional per-route shapefile paths, as a dict or a
+            function of the route number, instead of 'data_dir'
+
+        Returns
+        -------
+        results: DataFrame with one row per (route, parameter set)
+        """
+
+    if param_sets is None:
+        param_sets = [{}]
+
+    tasks = _fleet_tasks(
+        route_nums, a_prof, stop_coords, signal_coords, mass_arrays,
+        param_sets, data_dir, cache_dir, segment_cache, profile_hook,
+        shapefiles
+        )
+
+    rows = [None] * len(tasks)
+    for i, row in _run_tasks(tasks, max_workers, profile_hook):
+        rows[i] = row
+
+    return _results_table(rows, param_sets)
+
+
+def iter_fleet(
+    route_nums,
+    a_prof,
+    stop_coords=None,
+    signal_coords=None,
+    mass_arrays=None,
+    param_sets=None,
+    data_dir=DATA_DIR,
+    max_workers=None,
+    cache_dir=None,
+    segment_cache=None,
+    profile_hook=None,
+    shapefiles=None
+    ):
+    """ Generator of the result rows of 'run_fleet', each yielded as
+        soon as its task finishes. Takes the arguments of 'run_fleet'.
+
+        Yields
+        ------
+        row: dict of the 'RESULT_COLUMNS' and the scalar parameters of
+            the row's parameter set
+        """
+
+    if param_sets is None:
+        param_sets = [{}]
+
+    tasks = _fleet_tasks(
+        route_nums, a_prof, stop_coords, signal_coords, mass_arrays,
+        param_sets, data_dir, cache_dir, segment_cache, profile_hook,
+        shapefiles
+        )
+
+    for _, row in _run_tasks(tasks, max_workers, profile_hook):
+        row = {name: row[name] for name in RESULT_COLUMNS}
+        row.update(
+            (name, value)
+            for name, value in param_sets[row['param_set']].items()
+            if np.isscalar(value)
+            )
+        yield row
+
+
+def _fleet_tasks(
+    route_nums,
+    a_prof,
+    stop_coords,
+    signal_coords,
+    mass_arrays,
+    param_sets,
+    data_dir,
+    cache_dir,
+    segment_cache,
+    profile_hook,
+    shapefiles
+    ):
+    """ One task per (route, parameter set), in route then set order """
+
+    profile = ca.AccelerationProfile.compile(a_prof)
+
+    tasks = []
+    for route_num in route_nums:
+        shp_filename = _lookup(shapefiles, route_num, None)
+        if shp_filename is None:
+            shp_filename = route_shapefile(route_num, data_dir)
+        for set_idx, params in enumerate(param_sets):
+            tasks.append({
+                'route_num': route_num,
+                'param_set': set_idx,
+                'shp_filename': shp_filename,
+                'a_prof': profile,
+                'stop_coords': _lookup(stop_coords, route_num, []),
+                'signal_coords': _lookup(signal_coords, route_num, []),
+                'mass_array': _lookup(mass_arrays, route_num, []),
+                'params': params,
+                'cache_dir': cache_dir,
+                'segment_cache': segment_cache,
+                'profile': profile_hook is not None,
+                })
+
+    return tasks
+
+
+def _run_tasks(tasks, max_workers, profile_hook):
+    """ Runs 'tasks' longest route first and yields (task index, result
+        row) as each finishes.
+        """
+
+    if any(task['segment_cache'] is not None for task in tasks):
+        max_workers = 1
+
+    # Longest routes first
+    schedule = sorted(
+        range(len(tasks)),
+        key=lambda i: -_file_size(tasks[i]['shp_filename'])
+        )
+
+    if max_workers == 1:
+        finished = ((i, _simulate_route(tasks[i])) for i in schedule)
+    else:
+        finished = _run_in_pool(tasks, schedule, max_workers)
+
+    for i, row in finished:
+        # Stage records come back from the workers with the results
+        for record in row.pop('profile', []):
+            profile_hook(tasks[i]['route_num'], record)
+        yield i, row
+
+
+def _run_in_pool(tasks, schedule, max_workers):
+    """ Runs the tasks in 'schedule' in a process pool and yields (task
+        index, result row) as each finishes.
+
+        A worker that dies (e.g. a segfault) breaks the whole pool and
+        every unfinished task with it. The unfinished tasks are then
+        submitted again to a new pool, and if that breaks too, each in
+        a pool of its own so only the tasks that crash a worker fail.
+        """
+
+    pending = list(schedule)
+    for _ in range(_POOL_ATTEMPTS):
+        unfinished = yield from _run_pool(tasks, pending, max_workers)
+        if not unfinished:
+            return
+        pending = [i for i, _ in unfinished]
+
+    for i in pending:
+        unfinished = yield from _run_pool(tasks, [i], 1)
+        for i, error in unfinished:
+            yield i, _failed_row(tasks[i], error)
+
+
+def _run_pool(tasks, schedule, max_workers):
+    """ Runs the tasks in one process pool, yielding (task index,
+        result row) as each finishes. Returns the (task index,
+        traceback) of the tasks left unfinished by a broken pool.
+        """
+
+    unfinished = []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(_simulate_route, tasks[i]): i for i in schedule
+            }
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                row = future.result()
+            except BrokenProcessPool:
+                unfinished.append((i, traceback.format_exc()))
+                continue
+            except Exception:
+                # The task could not be sent to or from a worker
+                row = _failed_row(tasks[i], traceback.format_exc())
+            yield i, row
+
+    # Keep the longest-first order for the next pool
+    order = {i: n for n, i in enumerate(schedule)}
+    return sorted(unfinished, key=lambda item: order[item[0]])
+
+
+def _lookup(source, route_num, default):
+    """ Value of a per-route input given as a dict or a function """
+    if source is None:
+        return default
+    if callable(source):
+        return source(route_num)
+    return source.get(route_num, default)
+
+
+def _file_size(filename):
+    try:
+        return os.path.getsize(filename)
+    except OSError:
+        return 0
+
+
+def _simulate_route(task):
+    """ Worker: builds one RouteTrajectory and summarizes it. """
+
+    if task['segment_cache'] is None:
+        trajectory_class = ldm.RouteTrajectory
+        extra_args = {}
+    else:
+        trajectory_class = streaming.StreamingRouteTrajectory
+        extra_args = {'segment_cache': task['segment_cache']}
+
+    try:
+        trajectory = trajectory_class(
+            task['route_num'],
+            task['shp_filename'],
+            task['a_prof'],
+            stop_coords=task['stop_coords'],
+            signal_coords=task['signal_coords'],
+            mass_array=task['mass_array'],
+            cache_dir=task['cache_dir'],
+            profile=task['profile'],
+            **extra_args,
+            **task['params']
+            )
+        summary = trajectory.summary()
+    except Exception:
+        return _failed_row(task, traceback.format_exc())
+
+    return dict(
+        summary,
+        route_num=task['route_num'],
+        param_set=task['param_set'],
+        num_points=len(trajectory.route_state),
+        error=None,
+        profile=trajectory.profile.records if task['profile'] else [],
+        )
+
+
+def _failed_row(task, error):
+    return {
+        'route_num': task['route_num'],
+        'param_set': task['param_set'],
+        'num_points': 0,
+        'energy_kwh': np.nan,
+        'time_on_route_s': np.nan,
+        'peak_power_w': np.nan,
+        'error': error,
+        }
+
+
+def _results_table(rows, param_sets):
+    """ Joins the result rows with the scalar parameters of their set """
+
+    results = pd.DataFrame(rows, columns=RESULT_COLUMNS)
+
+    params = pd.DataFrame([
+        {
+            name: value for name, value in params.items()
+            if np.isscalar(value)
+            }
+        for params in param_sets
+        ])
+
+    if len(params.columns):
+        params.index.name = 'param_set'
+        results = results.join(params, on='param_set')
+
+    return results
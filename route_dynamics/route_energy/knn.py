@@ -1,65 +1,227 @@
 """ Knn Classifier for SEDS hw 4 """
+import functools
+
 import numpy as np
-import pandas as pd
+import pyproj
+import shapely
+
+from scipy.spatial import cKDTree
+from shapely import STRtree
 
 
 def find_knn(
     k,
     candidate_pts,
     test_pts,
-    weight=None
+    weight=None,
+    max_distance=None
     ):
     """ Takes list of points as candidate neighbors (route points) and
         returns one for reach test point (stops) which is the nearest
         route point to the stop.
+
+        All test points are queried at once against a KD-tree built on
+        the candidate coordinates, so memory grows with the number of
+        candidate plus test points rather than their product.
+
+        Args:
+            'k': number of neighbors returned for each test point.
+            'candidate_pts': shapely Points, coordinate tuples or
+                scalars to search.
+            'test_pts': points to find neighbors for, same forms as
+                'candidate_pts'.
+            'max_distance': optional cutoff. Neighbors farther than
+                this from a test point are reported with index -1 and
+                neighbor None.
+
+        Returns:
+            'k_nearest_indicies': (num_test, k) indicies into
+                'candidate_pts', nearest first.
+            'k_nearest_neighbors': (num_test, k) matching elements of
+                'candidate_pts'.
         """
 
-    num_train_pts = len(candidate_pts)
     num_test_pts = len(test_pts)
-    # Find the k nearest neighbors.
-
-    # Initialize array to store distances between data points
-    distance_array = np.zeros((num_test_pts, num_train_pts))
-
-    # Loop through rows in test data
-    for test_idx in range(num_test_pts):
-        test_coord = test_pts[test_idx]
-
-        # Loop through rows in training data
-        for train_idx in range(num_train_pts):
-            train_coord = candidate_pts[train_idx]
-
-            # Calc distance between training_data and data
-            dist = euclidean_distance(
-                train_coord,
-                test_coord
-                )
-
-            # Store distance in array
-            distance_array[test_idx, train_idx] = dist
-
-    # print('distance_array = ',distance_array)
-    # sort rows corresponding to each unclassified data point
-    sorting_idicies = np.argsort(distance_array)
-
-    # Keep only first k columns, corresponding to k nearest neighbors
-    # for each unclassified data point
-    k_nearest_indicies = sorting_idicies[:,:k]
-    # print(k_nearest_indicies.shape)
-    # print('k_nearest_indicies = ',k_nearest_indicies)
-    k_nearest_distances = distance_array[
-        np.arange(num_test_pts)[:,None], k_nearest_indicies
-        ]
 
-    # Build array to hold class of each training data point
-    points_array = np.asarray([candidate_pts]*num_test_pts)
-    k_nearest_neighbors = points_array[
-        np.arange(num_test_pts)[:,None], k_nearest_indicies
-        ]
+    candidate_coords = coordinate_array(candidate_pts)
+    test_coords = coordinate_array(test_pts)
+
+    if max_distance is None:
+        max_distance = np.inf
+
+    k_nearest_indicies = np.full((num_test_pts, k), -1, dtype=int)
+
+    if num_test_pts and len(candidate_coords):
+        tree = cKDTree(candidate_coords)
+        _, indicies = tree.query(
+            test_coords,
+            k=k,
+            distance_upper_bound=max_distance
+            )
+        indicies = np.reshape(indicies, (num_test_pts, k))
+
+        # cKDTree flags missing neighbors with index len(candidates)
+        found = indicies < len(candidate_coords)
+        k_nearest_indicies[found] = indicies[found]
+
+    # Store candidates in a 1D array so neighbors are selected by
+    # index without copying the candidates per test point.
+    candidates = np.empty(len(candidate_coords), dtype=object)
+    candidates[:] = list(candidate_pts)
+
+    k_nearest_neighbors = np.empty((num_test_pts, k), dtype=object)
+    found = k_nearest_indicies >= 0
+    k_nearest_neighbors[found] = candidates[k_nearest_indicies[found]]
 
     return k_nearest_indicies, k_nearest_neighbors
 
 
+def snap_to_route(route_pts, test_pts, max_distance=None, crs=None):
+    """ Projects points (stops) onto the route line through the route
+        points, i.e. linear referencing along the route.
+
+        The route segments between consecutive route points are held
+        in an STRtree, and all test points are queried at once, so the
+        run time grows as (N + M) log N for N route points and M test
+        points.
+
+        Args:
+            'route_pts': route points, same forms as in 'find_knn'.
+            'test_pts': points to snap, in the coordinates of the
+                route.
+            'max_distance': optional cutoff. Points farther than this
+                from the route are not snapped.
+            'crs': coordinate reference system of the points, by
+                default the 'crs' of 'route_pts' if it has one.
+                Geographic coordinates (e.g. EPSG:4326) are projected
+                to the UTM zone of the route first, so 'max_distance'
+                and 'distances' are in metres. Without a CRS they are
+                in the units of the coordinates.
+
+        Returns:
+            'positions': (num_test,) position of each projected point
+                along the route, as a fractional route point index
+                (2.5 is halfway between route points 2 and 3), NaN if
+                not snapped.
+            'distances': (num_test,) distance from each point to the
+                route, NaN if not snapped.
+        """
+
+    if crs is None:
+        crs = getattr(route_pts, 'crs', None)
+
+    route_coords = coordinate_array(route_pts)
+    test_coords = coordinate_array(test_pts)
+
+    positions = np.full(len(test_coords), np.nan)
+    distances = np.full(len(test_coords), np.nan)
+
+    if not len(test_coords) or not len(route_coords):
+        return positions, distances
+
+    route_coords, test_coords = metric_coordinates(
+        crs, route_coords, test_coords
+        )
+
+    # A route of one point is one segment of length zero
+    if len(route_coords) == 1:
+        route_coords = np.repeat(route_coords, 2, axis=0)
+
+    starts = route_coords[:-1]
+    ends = route_coords[1:]
+    tree = STRtree(shapely.linestrings(np.stack([starts, ends], axis=1)))
+
+    (test_idx, segment_idx), found_distances = tree.query_nearest(
+        shapely.points(test_coords),
+        max_distance=max_distance,
+        return_distance=True,
+        all_matches=False
+        )
+
+    # Fraction of the segment before the projected point
+    segment = ends[segment_idx] - starts[segment_idx]
+    length2 = np.sum(segment**2, axis=1)
+    along = np.sum((test_coords[test_idx] - starts[segment_idx]) * segment, 1)
+    fraction = np.divide(
+        along, length2, out=np.zeros_like(along), where=length2 > 0
+        )
+
+    positions[test_idx] = segment_idx + np.clip(fraction, 0, 1)
+    distances[test_idx] = found_distances
+
+    return positions, distances
+
+
+def route_order(positions):
+    """ Indicies of the snapped points, from 'snap_to_route'
+        'positions', in order along the route. Points at the same
+        position keep their given order.
+        """
+
+    snapped = np.flatnonzero(~np.isnan(positions))
+    return snapped[np.argsort(positions[snapped], kind='stable')]
+
+
+def metric_coordinates(crs, route_coords, *other_coords):
+    """ Projects (num_pts, 2+) coordinate arrays in geographic 'crs' to
+        the UTM zone of 'route_coords', in metres. Only x and y are
+        kept. Arrays in a projected or unknown CRS are returned as
+        they are.
+        """
+
+    coords = (route_coords,) + other_coords
+
+    if crs is None:
+        return coords
+
+    crs = pyproj.CRS.from_user_input(crs)
+    if not crs.is_geographic:
+        return coords
+
+    # WGS 84 UTM zone of the middle of the route
+    lon, lat = (
+        np.min(route_coords[:, :2], axis=0)
+        + np.max(route_coords[:, :2], axis=0)
+        ) / 2
+    zone = int((lon + 180) // 6) % 60 + 1
+    transformer = _transformer(crs, (32600 if lat >= 0 else 32700) + zone)
+
+    return tuple(
+        np.column_stack(transformer.transform(c[:, 0], c[:, 1]))
+        for c in coords
+        )
+
+
+@functools.lru_cache(maxsize=16)
+def _transformer(crs, epsg):
+    return pyproj.Transformer.from_crs(crs, epsg, always_xy=True)
+
+
+def coordinate_array(pts):
+    """ Stacks shapely Points, coordinate tuples or scalars into a
+        (num_pts, num_dims) float array.
+        """
+
+    pts = list(pts)
+
+    # Shapely Points are read in one call rather than one by one
+    if pts and all(isinstance(pt, shapely.Geometry) for pt in pts):
+        return shapely.get_coordinates(np.asarray(pts, dtype=object))
+
+    coords = [
+        np.atleast_1d(np.asarray(
+            pt.coords[0] if hasattr(pt, 'coords') else pt,
+            dtype=float
+            ))
+        for pt in pts
+        ]
+
+    if not coords:
+        return np.zeros((0, 2))
+
+    return np.asarray(coords)
+
+
 # def extract_numeric_columns_from_df(df):
 #     numerics = ['int16', 'int32', 'int64', 'float16', 'float32', 'float64']
 #     newdf = test_df.select_dtypes(include=numerics)
@@ -71,7 +233,9 @@ def euclidean_distance(pt_1, pt_2):
         intput data to be classified.
         """
     # make sure input are np arrays
-    pt_1 = np.asarray(pt_1.coords)
+    if hasattr(pt_1, 'coords'):
+        pt_1 = pt_1.coords
+    pt_1 = np.asarray(pt_1)
     pt_2 = np.asarray(pt_2)
 
     eucl_dist = np.linalg.norm(pt_2 - pt_1)
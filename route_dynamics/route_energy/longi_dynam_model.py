@@ -1,10 +1,37 @@
 from ..route_elevation import base_df as re_base
 from . import knn
 from . import accel as ca
+from . import resample
+from .route_state import RouteState
+from .profiling import RouteProfile, profiled
+
+import copy
+import itertools
 
 import numpy as np
+import pandas as pd
 import geopandas as gpd
 
+
+# Drive train efficiencies: motor, inverter, share of braking power
+# recovered and auxiliary load
+EFF_MOTOR = 0.916
+EFF_INV = 0.971
+REGEN = 0.6
+EFF_AUX = 0.89
+
+# Vehicle constants of a 40 foot bus
+GRAVI_ACCEL = 9.81 # in m/s2
+FRIC_COEFF = 0.01 # rolling friction
+INERTIA_FACTOR = 1.1 # rotating mass
+DRAG_COEFF = 0.6
+BUS_FRONT_AREA = 2.6 * 3.3 # width by height in m2
+AIR_DENSITY = 1.2 # in kg/m3; consant for now,
+    # eventaully input from weather API
+
+# Aerodynamic drag per squared speed [kg/m]
+DRAG = DRAG_COEFF * BUS_FRONT_AREA * (AIR_DENSITY/2)
+
 class IllegalArgumentError(ValueError):
     """ """
     pass
@@ -13,8 +40,79 @@ class RouteTrajectory():
     """ Takes 2d route coordinates extracted from shapefile and
         combines the information with elevation to create a route
         trajectory dataframe.
+
+        The simulation stages ('_add_*_to_df') read and write columns
+        of a 'RouteState', stored as 'route_state'. The 'route_df'
+        GeoDataFrame is built from it on first access.
+
+        'with_params' and 'sweep' change instance arguments and rerun
+        only the stages that read them, see 'STAGE_PARAMS'.
+
+        With 'profile=True' the wall time, CPU time, peak memory and
+        row count of 'build_route_coordinate_df' and each stage are
+        recorded in 'profile', a 'profiling.RouteProfile'.
+        'profile_hook' is called with the route number and each stage
+        record, e.g. a 'profiling.StageCosts' shared between routes.
+
+        With 'resample_tolerance' set, cruising stretches are simulated
+        with fewer points, see 'resample.resample_points', within that
+        relative energy error. 'resample_report' gives the points kept
+        and the estimated error.
+
+        'stop_pattern' is a pair (n, m): every n-th snapped bus stop
+        and every m-th signal, in order along the route, is served,
+        and 0 serves none. 'stop_patterns' compares patterns in one pass.
+
+        Stops and signals are projected onto the route line, see
+        'knn.snap_to_route', and placed at the nearest route point.
+        Those farther than 'snap_distance' metres from the route are
+        left out. 'stop_offsets' and
+        'signal_offsets' give their distance along the route, and
+        'stop_order' and 'signal_order' the snapped ones in route
+        order. With a 'stop_index.StopIndex' as 'stop_index', the
+        stops and signals it holds for the route are used instead of
+        'stop_coords' and 'signal_coords', and 'mass_array' needs a
+        mass for each of its stops.
         """
 
+    # Simulation stages in run order, with the instance arguments each
+    # one reads and the earlier stages whose columns it reads.
+    STAGE_PARAMS = {
+        'stops': (
+            'stop_coords', 'signal_coords', 'snap_distance', 'stop_index'
+            ),
+        'pattern': ('stop_pattern', 'resample_tolerance'),
+        'mass': ('mass_array', 'unloaded_bus_mass'),
+        'const_forces': (),
+        'kinematics': ('a_prof', 'a_pos', 'a_neg'),
+        'forces': (),
+        'power': ('charging_power_max', 'aux', 'a_neg'),
+        }
+    STAGE_INPUTS = {
+        'stops': (),
+        'pattern': ('stops',),
+        'mass': ('pattern',),
+        'const_forces': ('mass',),
+        'kinematics': ('pattern',),
+        'forces': ('mass', 'kinematics'),
+        'power': ('const_forces', 'forces'),
+        }
+
+    # Instance arguments the 'pattern' stage also reads when
+    # 'resample_tolerance' is set, see '_resample_route'
+    RESAMPLE_PARAMS = (
+        'a_prof', 'a_neg', 'mass_array', 'unloaded_bus_mass', 'aux'
+        )
+
+    # Columns overwritten by the traction power cap
+    CAPPED_COLUMNS = (
+        'acceleration',
+        'velocity',
+        'delta_times',
+        'aero_drag',
+        'inertia',
+        )
+
     def __init__(self,
         route_num,
         shp_filename,
@@ -26,7 +124,14 @@ class RouteTrajectory():
         charging_power_max=None,
         aux=None,
         a_pos=0.4,
-        a_neg=-1.5
+        a_neg=-1.5,
+        cache_dir=None,
+        profile=False,
+        profile_hook=None,
+        resample_tolerance=None,
+        stop_pattern=(3, 3),
+        snap_distance=None,
+        stop_index=None
         ):
 
         self._initialize_instance_args(
@@ -40,7 +145,14 @@ class RouteTrajectory():
             charging_power_max,
             aux,
             a_pos,
-            a_neg
+            a_neg,
+            cache_dir,
+            profile,
+            profile_hook,
+            resample_tolerance,
+            stop_pattern,
+            snap_distance,
+            stop_index
             )
 
         # Build Route DataFrame, starting with columns:
@@ -49,18 +161,263 @@ class RouteTrajectory():
         #     - 'length' (cumulative distance)
         #     - 'grade' 
         #     - 'is_bus_stop'
-        self.route_df = self.build_route_coordinate_df(
-            shp_filename = shp_filename
+        # and run the simulation on its columnar RouteState. The
+        # GeoDataFrame 'route_df' is only rebuilt when it is accessed.
+        self.route_state = RouteState.from_dataframe(
+            self.build_route_coordinate_df(
+                shp_filename = shp_filename
+                )
             )
 
-        self.route_df = self._add_dynamics_to_df(
-            route_df=self.route_df,
-            a_prof=a_prof,
+        self.route_state = self._add_dynamics_to_df(
+            route_df=self.route_state,
+            a_prof=self.a_prof,
             stop_coords=stop_coords,
             signal_coords=signal_coords
             )
 
 
+    @property
+    def route_df(self):
+        """ GeoDataFrame of the route, built from 'route_state' on
+            first access.
+            """
+        if getattr(self, '_route_df', None) is None:
+            self._route_df = self.route_state.to_geodataframe()
+        return self._route_df
+
+    @route_df.setter
+    def route_df(self, route_df):
+        self.route_state = RouteState.from_dataframe(route_df)
+        self._route_df = route_df
+
+
+    def with_params(self, **params):
+        """ Returns a copy of the trajectory with some instance
+            arguments changed, e.g. 'aux', 'charging_power_max',
+            'unloaded_bus_mass', 'mass_array', 'a_prof', 'a_pos' or
+            'a_neg'.
+
+            Only the stages reading a changed argument, and the stages
+            after them that read their columns, are rerun. The route
+            is not read again and this trajectory is unchanged.
+            """
+
+        trajectory = copy.copy(self)
+        trajectory.route_state = self.route_state.copy()
+        trajectory._route_df = None
+        if self.profile is not None:
+            trajectory.profile = RouteProfile(
+                self.profile.route_num,
+                self.profile.hook,
+                self.profile.trace_memory
+                )
+
+        trajectory._update_params(params)
+
+        return trajectory
+
+
+    def sweep(self, grid):
+        """ Simulates the route for every parameter set in 'grid'.
+
+            Args:
+                'grid': list of dicts of instance arguments, or a dict
+                    mapping argument names to lists of values to run
+                    every combination of.
+
+            A dict grid is ordered so that arguments read by early
+            stages change least often. Each parameter set is applied
+            to the trajectory of the one before, so e.g. sweeping
+            'aux' at fixed 'a_pos' only reruns the power stage.
+
+            Returns:
+                'results': DataFrame with one row per parameter set,
+                    its scalar arguments, and the columns of 'summary'.
+            """
+
+        if isinstance(grid, dict):
+            names = sorted(grid, key=self._first_stage_reading)
+            grid = [
+                dict(zip(names, values))
+                for values in itertools.product(*(grid[n] for n in names))
+                ]
+
+        trajectory = self.with_params()
+
+        rows = []
+        for params in grid:
+            trajectory._update_params(params)
+            row = {
+                name: value for name, value in params.items()
+                if np.isscalar(value)
+                }
+            row.update(trajectory.summary())
+            rows.append(row)
+
+        return pd.DataFrame(rows)
+
+
+    def stop_patterns(self, patterns):
+        """ Simulates the route for several stop patterns in one pass.
+
+            The route, its grade and the snapped stops are shared, and
+            only the stages from serving the stops on, i.e. mass,
+            kinematics, forces and power, are rerun per pattern.
+
+            Args:
+                'patterns': list of 'stop_pattern' pairs, e.g.
+                    [(1, 1), (2, 1), (3, 0)], or a dict of pattern
+                    names to pairs.
+
+            Returns:
+                'results': DataFrame with one row per pattern (indexed
+                    by name for a dict), its steps, the number of bus
+                    stops and signals served, and the columns of
+                    'summary'.
+            """
+
+        names = None
+        if isinstance(patterns, dict):
+            names = list(patterns)
+            patterns = list(patterns.values())
+
+        trajectory = self.with_params()
+
+        rows = []
+        for pattern in patterns:
+            stop_step, signal_step = pattern
+            trajectory._update_params({
+                'stop_pattern': (stop_step, signal_step)
+                })
+            row = {
+                'stop_step': stop_step,
+                'signal_step': signal_step,
+                'bus_stops': len(trajectory.route_state.bus_stop_idx),
+                'signals': len(trajectory.route_state.signal_idx),
+                }
+            row.update(trajectory.summary())
+            rows.append(row)
+
+        return pd.DataFrame(rows, index=names)
+
+
+    def summary(self):
+        """ Energy used in kWh, time on route in seconds and peak
+            battery power in W.
+            """
+
+        energy, time_on_route = self.energy_from_route()
+
+        return {
+            'energy_kwh': energy,
+            'time_on_route_s': time_on_route[-1],
+            'peak_power_w': np.max(self.route_state['power_output']),
+            }
+
+
+    def _first_stage_reading(self, name):
+        """ Position of the first stage reading instance argument
+            'name'.
+            """
+
+        for i, params in enumerate(self._stage_params().values()):
+            if name in params:
+                return i
+
+        raise IllegalArgumentError(
+            "'{}' is not an argument of a simulation stage".format(name)
+            )
+
+
+    def _stage_params(self):
+        """ 'STAGE_PARAMS', with 'RESAMPLE_PARAMS' read by the
+            'pattern' stage on resampled routes.
+            """
+
+        if self.resample_tolerance is None:
+            return self.STAGE_PARAMS
+
+        stage_params = dict(self.STAGE_PARAMS)
+        stage_params['pattern'] += self.RESAMPLE_PARAMS
+        return stage_params
+
+
+    def _update_params(self, params):
+        """ Sets instance arguments and reruns the stages reading any
+            that changed.
+            """
+
+        for name in params:
+            self._first_stage_reading(name)
+
+        if 'a_prof' in params:
+            params = dict(params, a_prof=ca.AccelerationProfile.compile(
+                params['a_prof']
+                ))
+
+        changed = set(
+            name for name, value in params.items()
+            if not _same_value(getattr(self, name), value)
+            )
+        if not changed:
+            return
+
+        for name in changed:
+            setattr(self, name, params[name])
+
+        stale = set()
+        for stage, stage_params in self._stage_params().items():
+            if (
+                changed.intersection(stage_params)
+                or
+                stale.intersection(self.STAGE_INPUTS[stage])
+                ):
+                stale.add(stage)
+
+        self._rerun_stages(stale)
+        self._route_df = None
+
+
+    def _rerun_stages(self, stages):
+        """ Reruns 'stages' on 'route_state', starting from the columns
+            before the traction power cap.
+            """
+
+        route_df = self.route_state
+
+        for name in self.CAPPED_COLUMNS:
+            route_df[name] = self._uncapped[name]
+
+        if 'pattern' in stages:
+            # Stops are found on the route before resampling
+            if self._full_route_state is not None:
+                route_df = self._full_route_state.copy()
+                self.stop_nn_indicies = self._full_stop_nn_indicies
+            if 'stops' in stages:
+                self._add_stops_to_df(
+                    self.stop_coords,
+                    self.signal_coords,
+                    route_df
+                    )
+            else:
+                self._serve_stops(route_df)
+            route_df = self._resample_route(route_df)
+            self.route_state = route_df
+        if 'mass' in stages:
+            self._add_mass_to_df(route_df)
+        if 'const_forces' in stages:
+            self._add_const_forces_to_df(route_df)
+        if 'kinematics' in stages:
+            self._add_accelerations_to_df(route_df, self.a_prof)
+            self._add_velocities_to_df(route_df)
+            self._add_delta_times_to_df(route_df)
+        if 'forces' in stages:
+            self._add_forces_to_df(route_df)
+        if 'power' in stages:
+            self._add_power_to_df(route_df)
+
+
     def _initialize_instance_args(self,
         route_num,
         shp_filename,
@@ -72,13 +429,22 @@ class RouteTrajectory():
         charging_power_max,
         aux,
         a_pos,
-        a_neg
+        a_neg,
+        cache_dir=None,
+        profile=False,
+        profile_hook=None,
+        resample_tolerance=None,
+        stop_pattern=(3, 3),
+        snap_distance=None,
+        stop_index=None
         ):
 
         # default speed limit and acceleration constant
         self.a_neg = a_neg
         self.a_pos = a_pos
-        self.a_prof = a_prof
+        # Compiled once and shared between trajectories with the same
+        # acceleration profile.
+        self.a_prof = ca.AccelerationProfile.compile(a_prof)
 
 
         self.stop_coords = stop_coords
@@ -100,6 +466,29 @@ class RouteTrajectory():
         self.charging_power_max = charging_power_max
         self.aux = aux
 
+        # Directory for cached route coordinate arrays, see
+        # 'base_df.wrapper'
+        self.cache_dir = cache_dir
+
+        # Relative energy error allowed when merging route points
+        self.resample_tolerance = resample_tolerance
+        self._full_route_state = None
+        self._full_stop_nn_indicies = None
+
+        # Bus stops and signals served, see '_serve_stops'
+        self.stop_pattern = stop_pattern
+        # Farthest stop or signal snapped to the route [m]
+        self.snap_distance = snap_distance
+        # Stops and signals on the route, read from a prebuilt index
+        self.shp_filename = shp_filename
+        self.stop_index = stop_index
+        self._resample_report = None
+
+        # Stage costs, recorded when profiling is on
+        self.profile = None
+        if profile or profile_hook is not None:
+            self.profile = RouteProfile(route_num, profile_hook)
+
 
     def _add_dynamics_to_df(self,
         route_df,
@@ -111,6 +500,8 @@ class RouteTrajectory():
         # Try to determine bus stops from list of coordinates
         route_df = self._add_stops_to_df(stop_coords, signal_coords, route_df)
 
+        route_df = self._resample_route(route_df)
+
         # Add passenger mass column to route_df
         route_df = self._add_mass_to_df(route_df)
 
@@ -135,6 +526,7 @@ class RouteTrajectory():
         return route_df
 
 
+    @profiled
     def build_route_coordinate_df(self,
         shp_filename
         ):
@@ -151,80 +543,208 @@ class RouteTrajectory():
                     assign points along bus route based on these values
                     .
 
+            Reuses cached arrays from 'cache_dir' when it is set.
             """
 
         # Build the df of 2D route coordinates and
-        route_df = re_base.wrapper(shp_filename, 6, 6)
+        route_df = re_base.wrapper(
+            shp_filename, 6, 6, cache_dir=getattr(self, 'cache_dir', None)
+            )
 
         return route_df
 
 
+    @profiled
     def _add_stops_to_df(self, stop_coords, signal_coords, route_df):
         """ Find rows in route_df matching the stop_coordinates and
             mark as bus stop under new column.
             """
 
-        self.stop_nn_indicies, self.stop_coord_nn = knn.find_knn(
-        1,
-        route_df.geometry.values,
-        stop_coords
-        )
-
+        if self.stop_index is not None:
+            return self._add_indexed_stops_to_df(route_df)
 
-        signal_nn_indicies, singal_coord_nn = knn.find_knn(
-        1,
-        route_df.geometry.values,
-        signal_coords)
-
-        route_df = route_df.assign(
-        is_bus_stop = ([False] * len(route_df.index))
-        )
+        stop_positions, _ = knn.snap_to_route(
+            route_df.geometry,
+            stop_coords,
+            self.snap_distance,
+            crs=route_df.crs
+            )
+        signal_positions, _ = knn.snap_to_route(
+            route_df.geometry,
+            signal_coords,
+            self.snap_distance,
+            crs=route_df.crs
+            )
 
-        route_df = route_df.assign(
-        is_signal = ([False] * len(route_df.index))
-        )
+        # Distance along the route of each stop and signal
+        point_idx = np.arange(len(route_df))
+        self.stop_offsets = np.interp(
+            stop_positions, point_idx, route_df['distance']
+            )
+        self.signal_offsets = np.interp(
+            signal_positions, point_idx, route_df['distance']
+            )
 
-        route_df = route_df.assign(
-        is_stop = ([False] * len(route_df.index))
-        )
- 
-        for i in self.stop_nn_indicies.ravel()[::3]:
-            route_df.at[i, 'is_bus_stop'] = True
-            route_df.at[i, 'is_stop'] = True
-            
-        for i in signal_nn_indicies.ravel()[::3]:
-            route_df.at[i, 'is_stop'] = True
-            route_df.at[i, 'is_signal'] = True
+        # Snapped stops and signals, in route order as in a
+        # 'stop_index.StopIndex', at the route point nearest their
+        # projection
+        self.stop_snapped = ~np.isnan(stop_positions)
+        self.stop_order = knn.route_order(stop_positions)
+        self.signal_order = knn.route_order(signal_positions)
+        self.stop_nn_indicies = np.rint(
+            stop_positions[self.stop_order]
+            ).astype(int)[:, np.newaxis]
+        self.signal_nn_indicies = np.rint(
+            signal_positions[self.signal_order]
+            ).astype(int)[:, np.newaxis]
+        self.stop_coord_nn = np.asarray(route_df.geometry)[
+            self.stop_nn_indicies
+            ]
+
+        # Coordinates, as given, of the snapped stops and signals
+        self.snapped_stop_coords = knn.coordinate_array(
+            stop_coords
+            )[self.stop_order]
+        self.snapped_signal_coords = knn.coordinate_array(
+            signal_coords
+            )[self.signal_order]
 
         # route_df.at[0, 'is_bus_stop'] = True
         # route_df.at[-1, 'is_bus_stop'] = True
 
+        return self._serve_stops(route_df)
+
+
+    def _add_indexed_stops_to_df(self, route_df):
+        """ Marks the stops and signals 'stop_index' holds for the
+            route.
+            """
+
+        indexed = self.stop_index.lookup(self.shp_filename)
+
+        self.stop_offsets = indexed['stop_offsets']
+        self.signal_offsets = indexed['signal_offsets']
+        self.stop_snapped = np.ones(len(indexed['stop_idx']), dtype=bool)
+        self.stop_order = np.arange(len(indexed['stop_idx']))
+        self.signal_order = np.arange(len(indexed['signal_idx']))
+        self.stop_nn_indicies = indexed['stop_idx'][:, np.newaxis]
+        self.signal_nn_indicies = indexed['signal_idx'][:, np.newaxis]
+        self.stop_coord_nn = np.asarray(route_df.geometry)[
+            self.stop_nn_indicies
+            ]
+        self.snapped_stop_coords = indexed['stop_coords']
+        self.snapped_signal_coords = indexed['signal_coords']
+
+        return self._serve_stops(route_df)
+
+
+    def _serve_stops(self, route_df):
+        """ Marks the snapped bus stops and signals served by
+            'stop_pattern' in route_df.
+            """
+
+        stop_step, signal_step = self.stop_pattern
+        if stop_step < 0 or signal_step < 0:
+            raise IllegalArgumentError(
+                "'stop_pattern' steps must be >= 0, got {}".format(
+                    self.stop_pattern
+                    )
+                )
+
+        route_df.set_stops(
+            _every(self.stop_nn_indicies, stop_step),
+            _every(self.signal_nn_indicies, signal_step)
+            )
+
         return route_df
 
 
-    def _add_velocities_to_df(self, route_df):
-        
+    @profiled
+    def _resample_route(self, route_df):
+        """ Returns a RouteState of fewer route points when
+            'resample_tolerance' is set, else 'route_df'. Mass changes
+            are kept, and the error is estimated at the heaviest mass.
+            """
+
+        self._full_route_state = None
+        self._resample_report = None
 
-        bus_speed_array = self.const_a_velocities
+        if self.resample_tolerance is None:
+            return route_df
 
-        route_df = route_df.assign(
-            velocity=bus_speed_array
+        mass_array = np.asarray(
+            [] if self.mass_array is None else self.mass_array, dtype=float
+            ).ravel()
+        mass_idx = np.sort(self.stop_nn_indicies.ravel())[:len(mass_array)]
+
+        idx, steps, grade, error = resample.resample_points(
+            route_df,
+            self.resample_tolerance,
+            self.a_prof,
+            self.a_neg,
+            np.max(mass_array, initial=self.unloaded_bus_mass),
+            0. if self.aux is None else self.aux,
+            keep=mass_idx
             )
 
+        resampled = route_df.take(idx)
+        resampled['steps'] = steps
+        resampled['grade'] = grade
+
+        # Later stages size their columns from the route state
+        self._full_stop_nn_indicies = self.stop_nn_indicies
+        self.stop_nn_indicies = np.searchsorted(idx, self.stop_nn_indicies)
+        self._full_route_state = route_df
+        self.route_state = resampled
+        self._resample_report = {
+            'num_points': len(route_df),
+            'num_resampled': len(idx),
+            'tolerance': self.resample_tolerance,
+            'estimated_error_kwh': error,
+            }
+
+        return resampled
+
+    @property
+    def resample_report(self):
+        """ Dict of the number of route points before and after
+            resampling, the tolerance, and the estimated absolute and
+            relative (to the route energy) energy error, or None if
+            the route was not resampled.
+            """
+
+        if self._resample_report is None:
+            return None
+
+        energy, _ = self.energy_from_route()
+        report = dict(self._resample_report)
+        report['estimated_relative_error'] = (
+            report['estimated_error_kwh'] / abs(energy)
+            )
+
+        return report
+
+    @profiled
+    def _add_velocities_to_df(self, route_df):
+        
+
+        route_df['velocity'] = self.const_a_velocities
+
         return route_df
 
 
+    @profiled
     def _add_delta_times_to_df(self, route_df):
         """ Add delta_times for finite_difference calculation of acceleration """
 
         
 
-        route_df = route_df.assign(delta_times = self.delta_times)
-        #route_df = route_df.assign(total_time = self.route_time)
+        route_df['delta_times'] = self.delta_times
 
 
         return route_df
 
+    @profiled
     def _add_accelerations_to_df(self, route_df, a_prof):
         """ For now just adds a acceleration velocity as a placeholder.
             """
@@ -232,9 +752,7 @@ class RouteTrajectory():
         accelerations = self._calculate_acceleration(route_df, a_prof)
 
         #Assign acceleration values to new row in route DataFrame.
-        route_df = route_df.assign(
-            acceleration=accelerations
-            )
+        route_df['acceleration'] = accelerations
 
         return route_df
 
@@ -266,6 +784,7 @@ class RouteTrajectory():
         return accelerations
 
 
+    @profiled
     def _add_mass_to_df(self,
         route_df,
         ):
@@ -278,46 +797,76 @@ class RouteTrajectory():
         full_mass_column = self.calculate_mass()
 
 
-        route_df = route_df.assign(
-            mass = full_mass_column
-            )
+        route_df['mass'] = full_mass_column
 
         return route_df
 
 
-    def calculate_mass(self
-        ):
+    def calculate_mass(self, mass_array=None):
         """ Take mass array that is length of bus stop array and store
             as df column with interpolated values in between stops
             (value from last stop). If no mass array was input as class
             arg, then default bus mass is stored in every df row.
+
+            'mass_array' defaults to the instance argument. A (S, stops)
+            matrix of S mass scenarios gives a (S, num_pts) result.
             """
 
+        if mass_array is None:
+            mass_array = self.mass_array
+        mass_array = self._snapped_masses(mass_array)
 
         # Initialize array of Nan's for mass column of route_df
-        full_mass_column = np.zeros(len(self.route_df.index))
+        full_mass_column = np.zeros(
+            mass_array.shape[:-1] + (len(self.route_state),)
+            )
         full_mass_column[:] = np.nan
 
         order = np.sort(self.stop_nn_indicies.ravel())
 
-
-        for i in range(len(self.mass_array)):  
-            full_mass_column[order[i]] = self.mass_array[i]
-        
+        num_stops = mass_array.shape[-1]
+        full_mass_column[..., order[:num_stops]] = mass_array
         
         # Set initial and value to unloaded bus mass.
-        full_mass_column[0] = self.unloaded_bus_mass
-        full_mass_column[-1] = self.unloaded_bus_mass
+        full_mass_column[..., 0] = self.unloaded_bus_mass
+        full_mass_column[..., -1] = self.unloaded_bus_mass
 
 
-        for i in range(len(full_mass_column)-1):
-            if np.isnan(full_mass_column[i]):
-                full_mass_column[i] = full_mass_column[i-1]
-            else:
-                continue
+        # Fill points between stops with the mass at the last stop
+        last_set = np.where(
+            np.isnan(full_mass_column),
+            0,
+            np.arange(full_mass_column.shape[-1])
+            )
+        np.maximum.accumulate(last_set, axis=-1, out=last_set)
+
+        return np.take_along_axis(full_mass_column, last_set, axis=-1)
 
-        return full_mass_column
+    def _snapped_masses(self, mass_array):
+        """ 'mass_array' at the stops snapped to the route, in route
+            order, if it has a mass for every stop coordinate.
+            """
 
+        mass_array = np.asarray(mass_array, dtype=float)
+        if (
+            self.stop_index is not None
+            and mass_array.size
+            and mass_array.shape[-1:] != self.stop_snapped.shape
+            ):
+            raise IllegalArgumentError(
+                "'mass_array' has {} masses, the stop index {} stops "
+                "for {}".format(
+                    mass_array.shape[-1],
+                    len(self.stop_snapped),
+                    self.shp_filename
+                    )
+                )
+        if mass_array.shape[-1:] == self.stop_snapped.shape:
+            mass_array = mass_array[..., self.stop_order]
+
+        return mass_array
+
+    @profiled
     def _add_const_forces_to_df(self, route_df):
 
         (
@@ -325,61 +874,61 @@ class RouteTrajectory():
             roll_fric,
             ) = self.calculate_const_forces(route_df)
 
-        route_df = route_df.assign(
-            grav_force = grav_force,
-            roll_fric = roll_fric,
-            )
+        route_df['grav_force'] = grav_force
+        route_df['roll_fric'] = roll_fric
 
         return route_df
 
 
+    @profiled
     def _add_forces_to_df(self, route_df):
         """ Calculate forces on bus relevant to the Longitudinate
             dynamics model.
             """
-        vels = route_df.velocity.values
-        acce = route_df.acceleration.values
-        loaded_bus_mass = route_df.mass.values
+        vels = route_df['velocity']
+        acce = route_df['acceleration']
+        loaded_bus_mass = route_df['mass']
 
         (
             aero_drag,
             inertia
             ) = self.calculate_forces(loaded_bus_mass, acce, vels)
 
-        route_df = route_df.assign(
-            aero_drag = aero_drag,
-            inertia = inertia,
-            )
+        route_df['aero_drag'] = aero_drag
+        route_df['inertia'] = inertia
 
         return route_df
 
-    def calculate_const_forces(self, route_df):
-        grad = route_df.grade.values
+    def calculate_const_forces(self, route_df, loaded_bus_mass=None):
+        """ Gravitational force and rolling friction at each point.
+            'loaded_bus_mass' defaults to the 'mass' column and may
+            have leading scenario dimensions.
+            """
+        grad = route_df['grade']
         grad_angle = np.arctan(grad)
-        gravi_accel = 9.81
-        fric_coeff = 0.01
 
-        loaded_bus_mass = route_df.mass.values
+        if loaded_bus_mass is None:
+            loaded_bus_mass = route_df['mass']
 
         # Calculate the gravitational force
         grav_force = (
-            loaded_bus_mass * gravi_accel * np.sin(grad_angle)
+            loaded_bus_mass * GRAVI_ACCEL * np.sin(grad_angle)
             )
 
         # Calculate the rolling friction
         roll_fric = (
-            fric_coeff * loaded_bus_mass * gravi_accel * np.cos(grad_angle)
+            FRIC_COEFF * loaded_bus_mass * GRAVI_ACCEL * np.cos(grad_angle)
             )
 
         return grav_force, roll_fric
 
     def calculate_forces(self, loaded_bus_mass, acce, vels):
-        """ Requires GeoDataFrame input with mass column """  
+        """ Requires GeoDataFrame input with mass column. Arguments
+            broadcast, so masses may have leading scenario dimensions.
+            """  
 
 
         # Physical parameters
-        air_density = 1.2 # air density in kg/m3; consant for now,
-            # eventaully input from weather API
         v_wind = 0.0 # wind speed in km per hour; figure out component,
             # and also will come from weather API
     
@@ -389,130 +938,315 @@ class RouteTrajectory():
         #     loaded_bus_mass = self.unloaded_bus_mass # Mass of bus in kg
         # else:
         
-        width = 2.6 # in m
-        height = 3.3 # in m
-        bus_front_area = width * height
-        drag_coeff = 0.6
         #rw = 0.5 # radius of wheel in m
-        factor = 1.1
-    
+
 
         # Calculate the aerodynamic drag
-        aero_drag = (
-            drag_coeff
-            *
-            bus_front_area
-            *
-            (air_density/2)
-            *
-            (vels-v_wind)**2
-            )
+        aero_drag = DRAG * (vels-v_wind)**2
 
         # Calculate the inertial force
-        inertia = factor*loaded_bus_mass * acce
+        inertia = INERTIA_FACTOR*loaded_bus_mass * acce
 
         return (aero_drag, inertia)
 
 
     def _calculate_batt_power_exert(self, route_df):
+        """ Power drawn from the battery at each route point after
+            capping traction power at 'charging_power_max'.
 
-        eff_motor = 0.916
-        eff_inv = 0.971
-        regen = 0.6
-        eff_aux = 0.89
+            Points whose traction power exceeds the cap hold the speed
+            of the point before them (zero acceleration), or brake at
+            'a_neg' if holding speed still exceeds the cap. The
+            'acceleration', 'velocity', 'delta_times', 'aero_drag' and
+            'inertia' columns of 'route_df' are updated in place.
 
-        f_resist = (
-            route_df.grav_force.values
-            +
-            route_df.roll_fric.values
-            +
-            route_df.aero_drag.values
-            )
+            Columns may have leading scenario dimensions, e.g. (S, N)
+            masses and forces with shared (N,) kinematics.
+            """
+
+        (
+            acceleration,
+            velocity,
+            delta_times,
+            aero_drag,
+            inertia,
+            f_traction,
+            p_traction
+            ) = self._cap_traction_power(route_df)
+
+        route_df['acceleration'] = acceleration
+        route_df['velocity'] = velocity
+        route_df['delta_times'] = delta_times
+        route_df['aero_drag'] = aero_drag
+        route_df['inertia'] = inertia
+
+        P_ESS = np.where(
+            f_traction >= 0,
+            p_traction/(EFF_MOTOR*EFF_INV),
+            REGEN*EFF_MOTOR*EFF_INV*p_traction
+            ) + (self.aux/EFF_AUX)
+
+        #self.raw_batt_power_exert = np.copy(P_ESS)
+
+        return P_ESS
+
+
+    def _cap_traction_power(self, route_df):
+        """ Applies the traction power cap to every route point at
+            once. Returns the capped acceleration, velocity,
+            delta_times, aero_drag, inertia, traction force and
+            traction power arrays, broadcast to the shape of all
+            columns. Route points run along the last axis.
+            """
 
-        f_traction = route_df.inertia.values + f_resist
+        p_max = self.charging_power_max
+
+        names = (
+            'grav_force',
+            'roll_fric',
+            'mass',
+            'acceleration',
+            'velocity',
+            'delta_times',
+            'aero_drag',
+            'inertia',
+            )
+        columns = [np.asarray(route_df[name], dtype=float) for name in names]
+        shape = np.broadcast_shapes(*(c.shape for c in columns))
+        (
+            grav_force,
+            roll_fric,
+            loaded_bus_mass,
+            acceleration,
+            velocity,
+            delta_times,
+            aero_drag,
+            inertia
+            ) = [
+            np.array(np.broadcast_to(c, shape), order='C') for c in columns
+            ]
 
-        velocity = route_df.velocity.values
-        Pout_max = self.charging_power_max
+        f_traction = inertia + (grav_force + roll_fric + aero_drag)
 
         # calculate raw power before capping charging ability of bus
         p_traction = f_traction * velocity
 
-        for i in range(len(p_traction)):
-            if p_traction[i] < -self.charging_power_max:
-                p_traction[i] = -self.charging_power_max
+        over_cap = p_traction > p_max
+        p_traction[p_traction < -p_max] = -p_max
+
+        if not np.any(over_cap):
+            return (
+                acceleration,
+                velocity,
+                delta_times,
+                aero_drag,
+                inertia,
+                f_traction,
+                p_traction
+                )
+
+        # Points over the cap hold the speed and time step of the last
+        # point before them that was under the cap. Quantities of
+        # points over the cap are computed for those points only.
+        point_idx = np.arange(shape[-1])
+        last_under_cap = np.maximum.accumulate(
+            np.where(over_cap, -1, point_idx), axis=-1
+            )
+        last_under_cap = np.maximum(last_under_cap, 0)
+
+        # Flat indicies of the points over the cap (all arrays are
+        # C-contiguous) and of the points they hold the speed of.
+        capped = np.flatnonzero(over_cap)
+        capped_point = capped % shape[-1]
+        held_from = capped - capped_point + last_under_cap.ravel()[capped]
+
+        hold_velocity = velocity.ravel()[held_from]
+        hold_delta_times = delta_times.ravel()[held_from]
+        grav_force = grav_force.ravel()[capped]
+        roll_fric = roll_fric.ravel()[capped]
+        loaded_bus_mass = loaded_bus_mass.ravel()[capped]
+
+        # Power needed to hold that speed
+        hold_aero_drag, _ = self.calculate_forces(
+            loaded_bus_mass, 0., hold_velocity
+            )
+        hold_f_traction = grav_force + roll_fric + hold_aero_drag
+        hold_p_traction = hold_f_traction * hold_velocity
+
+        # If holding speed is still over the cap the bus brakes at
+        # 'a_neg' to the speed reached one point spacing from rest.
+        # Every later point in the same run over the cap then holds
+        # that braking speed instead.
+        brake_velocity = np.sqrt(-2*ca.POINT_SPACING*self.a_neg)
+        brake_delta_time = ca.POINT_SPACING/brake_velocity
+
+        can_brake = np.zeros(shape, dtype=bool)
+        can_brake.ravel()[capped] = hold_p_traction > p_max
+        last_brake = np.maximum.accumulate(
+            np.where(can_brake, point_idx, -1), axis=-1
+            )
+        braked_before = np.concatenate(
+            [np.full(shape[:-1] + (1,), -1), last_brake[..., :-1]], axis=-1
+            ) >= last_under_cap
+        braked_before = braked_before.ravel()[capped] & (
+            capped_point > last_under_cap.ravel()[capped]
+            )
+        first_brakes = can_brake.ravel()[capped] & ~braked_before
+
+        at_brake_speed = first_brakes | braked_before
+        holding = ~at_brake_speed
 
-            elif p_traction[i] > self.charging_power_max:
-                route_df.acceleration[i] = 0
-                route_df.velocity[i] = route_df.velocity[i-1]
-                route_df.delta_times[i] = route_df.delta_times[i-1]
-                loaded_bus_mass = route_df.mass[i]
+        brake_aero_drag, brake_inertia = self.calculate_forces(
+            loaded_bus_mass, self.a_neg, brake_velocity
+            )
+        coast_f_traction = grav_force + roll_fric + brake_aero_drag
+        coast_p_traction = coast_f_traction * brake_velocity
 
-                (
-                route_df.aero_drag[i],
-                route_df.inertia[i]
-                ) = self.calculate_forces(loaded_bus_mass, route_df.acceleration[i], route_df.velocity[i])
+        # After braking once, points hold the braking speed and only
+        # brake again if that is over the cap.
+        braking = first_brakes | (
+            braked_before & (coast_p_traction > p_max)
+            )
+        coasting = at_brake_speed & ~braking
 
-                f_resist[i] = route_df.grav_force[i] + route_df.roll_fric[i] + route_df.aero_drag[i]
-                f_traction[i] = route_df.inertia[i] + f_resist[i]
+        velocity_capped = np.where(holding, hold_velocity, brake_velocity)
 
-                p_traction[i] = f_traction[i] * route_df.velocity[i]
+        acceleration.ravel()[capped] = np.where(braking, self.a_neg, 0)
+        velocity.ravel()[capped] = velocity_capped
+        delta_times.ravel()[capped] = np.where(
+            holding, hold_delta_times, brake_delta_time
+            )
+        aero_drag.ravel()[capped] = np.where(
+            holding, hold_aero_drag, brake_aero_drag
+            )
+        inertia.ravel()[capped] = np.where(braking, brake_inertia, 0)
+
+        f_traction_capped = np.where(
+            holding,
+            hold_f_traction,
+            np.where(
+                coasting,
+                coast_f_traction,
+                brake_inertia + (grav_force + roll_fric + brake_aero_drag)
+                )
+            )
+
+        f_traction.ravel()[capped] = f_traction_capped
+        p_traction.ravel()[capped] = f_traction_capped * velocity_capped
+
+        return (
+            acceleration,
+            velocity,
+            delta_times,
+            aero_drag,
+            inertia,
+            f_traction,
+            p_traction
+            )
 
-                while p_traction[i] > self.charging_power_max:
-                    route_df.acceleration[i] = self.a_neg
-                    route_df.velocity[i] = np.sqrt(-2*10.972265*self.a_neg)
-                    route_df.delta_times[i] = 10.972265/route_df.velocity[i]
-                    loaded_bus_mass = route_df.mass[i]
 
-                    (
-                    route_df.aero_drag[i],
-                    route_df.inertia[i]
-                    ) = self.calculate_forces(loaded_bus_mass, route_df.acceleration[i], route_df.velocity[i])
+    @profiled
+    def _add_power_to_df(self, route_df):
 
-                    f_resist[i] = route_df.grav_force[i] + route_df.roll_fric[i] + route_df.aero_drag[i]
-                    f_traction[i] = route_df.inertia[i] + f_resist[i]
+        # Keep the columns before the power cap so it can be applied
+        # again by 'with_params' and 'mass_scenarios'.
+        self._uncapped = {
+            name: np.copy(route_df[name]) for name in self.CAPPED_COLUMNS
+            }
 
-                    p_traction[i] = f_traction[i] * route_df.velocity[i]
+        batt_power_exert = self._calculate_batt_power_exert(route_df)
 
-                else:
-                    continue
 
-                 #p_traction[i] = self.charging_power_max
+        route_df['power_output'] = batt_power_exert
 
-        P_ESS = np.zeros(len(p_traction))
+        return route_df
 
-        for i in range(len(p_traction)):
-            if f_traction[i] >= 0:
-                P_ESS[i] = (p_traction[i]/(eff_motor*eff_inv)) + (self.aux/eff_aux)
-            else:
-                P_ESS[i] = (regen*eff_motor*eff_inv*p_traction[i]) + (self.aux/eff_aux)
-            
-        #self.raw_batt_power_exert = np.copy(P_ESS)
 
-        return P_ESS
+    def energy_from_route(self, route_df=None):
+        """ Energy used in kWh and time on route at each point in
+            seconds. 'route_df' defaults to 'route_state'; columns
+            with leading scenario dimensions give one result per
+            scenario.
+            """
 
+        if route_df is None:
+            route_df = self.route_state
 
-    def _add_power_to_df(self, route_df):
+        delta_t = np.asarray(route_df['delta_times'])[..., 1:]
 
-        batt_power_exert = self._calculate_batt_power_exert(route_df)
+        power = np.asarray(route_df['power_output'])[..., 1:]
 
+        energy = np.sum(power/1000 * delta_t/3600, axis=-1)
 
-        new_df = route_df.assign(
-            power_output = batt_power_exert
+        time_on_route = np.cumsum(delta_t, axis=-1)
+        time_on_route = np.concatenate(
+            [np.zeros(time_on_route.shape[:-1] + (1,)), time_on_route],
+            axis=-1
             )
 
-        return new_df
+        return energy, time_on_route
+
 
+    def mass_scenarios(self, mass_matrix):
+        """ Runs the mass, force and power stages for S mass scenarios
+            at once, sharing the route geometry and the kinematics
+            before the power cap.
 
-    def energy_from_route(self, route_df):
+            Args:
+                'mass_matrix': (S, stops) masses at each stop, as
+                    'mass_array', e.g. one row per ridership period or
+                    load factor.
+
+            Returns:
+                'energy': (S,) energy used in kWh.
+                'time_on_route': (S, num_pts) time at each point.
+                'power_output': (S, num_pts) battery power.
+            """
+
+        mass = self.calculate_mass(np.atleast_2d(mass_matrix))
+
+        columns = dict(self._uncapped)
+        columns['grade'] = self.route_state['grade']
+        columns['mass'] = mass
+
+        (
+            columns['grav_force'],
+            columns['roll_fric']
+            ) = self.calculate_const_forces(columns)
+
+        (
+            columns['aero_drag'],
+            columns['inertia']
+            ) = self.calculate_forces(
+            mass,
+            columns['acceleration'],
+            columns['velocity']
+            )
+
+        columns['power_output'] = self._calculate_batt_power_exert(columns)
+
+        # Columns the power cap left at their shared (N,) values
+        columns['delta_times'] = np.broadcast_to(
+            columns['delta_times'], mass.shape
+            )
 
-        route_df = self.route_df
+        energy, time_on_route = self.energy_from_route(columns)
 
-        delta_t = route_df.delta_times.values[1:]
+        return energy, time_on_route, columns['power_output'] 
 
-        power = route_df.power_output.values[1:]
 
-        energy = np.sum(power/1000 * delta_t/3600)
+def _same_value(old, new):
+    """ Whether an instance argument is unchanged by a new value """
+    if old is new:
+        return True
+    try:
+        return bool(np.array_equal(old, new))
+    except Exception:
+        return False
 
-        time_on_route = np.append(0, np.cumsum(delta_t))
 
-        return energy, time_on_route 
+def _every(indicies, step):
+    """ Every 'step'-th of the snapped 'indicies', none for step 0 """
+    if step == 0:
+        return np.zeros(0, dtype=int)
+    return indicies.ravel()[::step]
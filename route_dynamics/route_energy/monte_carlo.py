@@ -0,0 +1,171 @@
+""" Monte Carlo ridership uncertainty: route energy and peak power
+    distributions from sampled per-stop passenger loads.
+    """
+import copy
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+
+# Passenger mass in kg, as used by 'route_riders.route_ridership'
+PASSENGER_MASS = 80
+
+# Sample statistics, in table order
+SAMPLE_COLUMNS = ['energy_kwh', 'peak_power_w']
+
+
+def sample_loads(ave_load, obs, num_samples, rng):
+    """ Samples passenger loads at each stop.
+
+        The load of one trip is Poisson distributed about the stop's
+        mean load, and the mean itself is uncertain: it is drawn from
+        a Gamma distribution with the observed average 'AveLd' as its
+        mean and a spread shrinking with the number of observed trips
+        'Obs'. Stops are sampled independently.
+
+        Args:
+            'ave_load': average load at each stop, 'AveLd'.
+            'obs': number of trips observed at each stop, 'Obs'.
+            'num_samples': number of load realizations.
+            'rng': numpy Generator.
+
+        Returns:
+            'loads': (num_samples, stops) integer passenger loads.
+        """
+
+    ave_load = np.asarray(ave_load, dtype=float)
+    obs = np.maximum(np.asarray(obs, dtype=float), 1)
+
+    size = (num_samples, len(ave_load))
+    mean_load = rng.gamma(np.maximum(ave_load*obs, 1e-12), 1/obs, size=size)
+
+    return rng.poisson(mean_load)
+
+
+def sample_energy(
+    trajectory,
+    ave_load,
+    obs,
+    num_samples=1000,
+    seed=None,
+    passenger_mass=PASSENGER_MASS,
+    batch_size=250,
+    max_workers=None
+    ):
+    """ Route energy and peak battery power for sampled ridership.
+
+        Samples are drawn in batches of 'batch_size', each from its own
+        random stream spawned from 'seed'. Each batch is evaluated as
+        one (batch_size, stops) mass matrix with
+        'RouteTrajectory.mass_scenarios', sharing the route geometry
+        and kinematics of 'trajectory'. Batches run across a process
+        pool. Results only depend on 'seed' and 'batch_size', not on
+        the number of workers.
+
+        Args:
+            'trajectory': RouteTrajectory of the route.
+            'ave_load', 'obs': per-stop 'AveLd' and 'Obs', e.g. from
+                'route_riders.route_ridership', in the order of the
+                route's stops.
+            'num_samples': number of ridership realizations.
+            'seed': seed of the random streams.
+            'passenger_mass': mass of one passenger in kg.
+            'batch_size': samples evaluated at once by a worker.
+            'max_workers': number of worker processes. With 1 the
+                batches run in this process.
+
+        Returns:
+            'samples': DataFrame with 'energy_kwh' and 'peak_power_w'
+                of each sample.
+        """
+
+    streams = np.random.SeedSequence(seed).spawn(
+        -(-num_samples // batch_size)
+        )
+    batches = [
+        (
+            stream,
+            min(batch_size, num_samples - i*batch_size),
+            ave_load,
+            obs,
+            passenger_mass,
+            )
+        for i, stream in enumerate(streams)
+        ]
+
+    # Workers get the trajectory once, without its cached GeoDataFrame
+    # or profile
+    trajectory = copy.copy(trajectory)
+    trajectory._route_df = None
+    trajectory.profile = None
+
+    if max_workers == 1:
+        _init_worker(trajectory)
+        results = [_simulate_batch(batch) for batch in batches]
+    else:
+        with ProcessPoolExecutor(
+            max_workers=max_workers,
+            initializer=_init_worker,
+            initargs=(trajectory,)
+            ) as executor:
+            results = list(executor.map(_simulate_batch, batches))
+
+    return pd.DataFrame(
+        np.concatenate(results) if results else np.zeros((0, 2)),
+        columns=SAMPLE_COLUMNS
+        )
+
+
+def run_monte_carlo(
+    trajectory,
+    ave_load,
+    obs,
+    num_samples=1000,
+    percentiles=(5, 25, 50, 75, 95),
+    **kwargs
+    ):
+    """ Percentiles of route energy and peak battery power over
+        'num_samples' sampled ridership realizations. Arguments are as
+        for 'sample_energy'.
+
+        Returns:
+            'summary': DataFrame indexed by percentile with columns
+                'energy_kwh' and 'peak_power_w'.
+        """
+
+    samples = sample_energy(
+        trajectory, ave_load, obs, num_samples=num_samples, **kwargs
+        )
+
+    summary = pd.DataFrame(
+        np.percentile(samples.values, percentiles, axis=0),
+        index=pd.Index(percentiles, name='percentile'),
+        columns=SAMPLE_COLUMNS
+        )
+
+    return summary
+
+
+# Trajectory shared by the batches run in a worker process
+_worker_trajectory = None
+
+
+def _init_worker(trajectory):
+    global _worker_trajectory
+    _worker_trajectory = trajectory
+
+
+def _simulate_batch(batch):
+    """ Worker: energy and peak power of one batch of samples """
+
+    stream, num_samples, ave_load, obs, passenger_mass = batch
+    rng = np.random.default_rng(stream)
+
+    loads = sample_loads(ave_load, obs, num_samples, rng)
+    mass_matrix = _worker_trajectory.unloaded_bus_mass + passenger_mass*loads
+
+    energy, _, power = _worker_trajectory.mass_scenarios(mass_matrix)
+
+    return np.column_stack([energy, np.max(power, axis=-1)])
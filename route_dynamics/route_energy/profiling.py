@@ -0,0 +1,180 @@
+""" Opt-in per-stage timing and memory profiling of RouteTrajectory.
+    """
+import functools
+import json
+import time
+import tracemalloc
+
+from collections import namedtuple
+
+import pandas as pd
+
+
+# Cost of one run of a stage: wall and CPU time in seconds, peak memory
+# allocated by the stage above what was allocated before it in bytes
+# (None if not measured), and the number of route points it returned.
+StageRecord = namedtuple(
+    'StageRecord',
+    ['stage', 'wall_s', 'cpu_s', 'peak_memory_bytes', 'rows']
+    )
+
+
+class RouteProfile():
+    """ Records the cost of each simulation stage of one trajectory.
+
+        Memory is traced with 'tracemalloc', which slows allocation
+        down; pass 'trace_memory=False' to time stages only. When the
+        caller is already tracing, its tracer's peak is left alone: a
+        stage's peak is then only known, and recorded, when the stage
+        raises the tracer's peak.
+
+        'hook', if given, is called with the route number and each
+        StageRecord as it is recorded.
+        """
+
+    def __init__(self, route_num=None, hook=None, trace_memory=True):
+
+        self.route_num = route_num
+        self.hook = hook
+        self.trace_memory = trace_memory
+        self.records = []
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def run(self, stage, func, *args, **kwargs):
+        """ Calls 'func' and records its cost as 'stage'. """
+
+        started_tracing = False
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                started_tracing = True
+            baseline, peak_before = tracemalloc.get_traced_memory()
+
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            wall = time.perf_counter() - wall_start
+            cpu = time.process_time() - cpu_start
+            peak_memory = None
+            if self.trace_memory:
+                _, peak = tracemalloc.get_traced_memory()
+                if started_tracing or peak > peak_before:
+                    peak_memory = peak - baseline
+                if started_tracing:
+                    tracemalloc.stop()
+
+        record = StageRecord(
+            stage,
+            wall,
+            cpu,
+            peak_memory,
+            len(result) if hasattr(result, '__len__') else None
+            )
+        self.records.append(record)
+        if self.hook is not None:
+            self.hook(self.route_num, record)
+
+        return result
+
+    def to_dataframe(self):
+        """ DataFrame with one row per stage run, in run order """
+        return pd.DataFrame(self.records, columns=StageRecord._fields)
+
+    def totals(self):
+        """ DataFrame of the summed cost of each stage, indexed by
+            stage, in first run order.
+            """
+        df = self.to_dataframe()
+        return df.groupby('stage', sort=False).agg(
+            runs=('wall_s', 'size'),
+            wall_s=('wall_s', 'sum'),
+            cpu_s=('cpu_s', 'sum'),
+            peak_memory_bytes=('peak_memory_bytes', 'max'),
+            rows=('rows', 'max'),
+            )
+
+    def to_dict(self):
+        return {
+            'route_num': self.route_num,
+            'stages': [record._asdict() for record in self.records],
+            }
+
+    def to_json(self, filename=None, **kwargs):
+        """ JSON of 'to_dict', also written to 'filename' if given """
+
+        text = json.dumps(self.to_dict(), default=_to_builtin, **kwargs)
+        if filename is not None:
+            with open(filename, 'w') as f:
+                f.write(text)
+
+        return text
+
+
+class StageCosts():
+    """ Hook aggregating stage costs over many trajectories.
+
+        Pass an instance as 'profile_hook' to RouteTrajectory or
+        'fleet.run_fleet'; 'table' then gives the cost of each stage
+        over all routes.
+        """
+
+    def __init__(self):
+        self.records = []
+
+    def __call__(self, route_num, record):
+        self.records.append((route_num,) + tuple(record))
+
+    def to_dataframe(self):
+        """ DataFrame with one row per stage run of every route """
+        return pd.DataFrame(
+            self.records, columns=('route_num',) + StageRecord._fields
+            )
+
+    def table(self):
+        """ DataFrame indexed by stage with the number of runs, total
+            and mean wall and CPU time, largest peak memory, and the
+            share of all wall time.
+            """
+
+        df = self.to_dataframe()
+        table = df.groupby('stage', sort=False).agg(
+            runs=('wall_s', 'size'),
+            routes=('route_num', 'nunique'),
+            wall_s=('wall_s', 'sum'),
+            mean_wall_s=('wall_s', 'mean'),
+            cpu_s=('cpu_s', 'sum'),
+            peak_memory_bytes=('peak_memory_bytes', 'max'),
+            rows=('rows', 'sum'),
+            )
+        table['wall_share'] = table['wall_s'] / table['wall_s'].sum()
+
+        return table
+
+
+def profiled(method):
+    """ Decorates a RouteTrajectory stage method to be recorded in the
+        trajectory's 'profile', when profiling is on.
+        """
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        profile = getattr(self, 'profile', None)
+        if profile is None:
+            return method(self, *args, **kwargs)
+        return profile.run(method.__name__, method, self, *args, **kwargs)
+
+    return wrapper
+
+
+def _to_builtin(value):
+    # numpy scalars in records
+    if hasattr(value, 'item'):
+        return value.item()
+    raise TypeError(repr(value))
@@ -0,0 +1,207 @@
+""" Error-bounded adaptive resampling of route points.
+
+    The simulation steps along the route every 'accel.POINT_SPACING'.
+    Where the bus cruises at a constant speed on a steady grade every
+    point gives nearly the same power, so runs of such points
+    can be merged into one point that stands for the whole stretch.
+    """
+import numpy as np
+
+from . import accel as ca
+from . import longi_dynam_model as ldm
+
+
+def resample_points(
+    route_state,
+    tolerance,
+    a_prof,
+    a_neg,
+    mass,
+    aux=0.,
+    keep=()
+    ):
+    """ Chooses route points to simulate so that cruising stretches
+        are merged within an energy error tolerance.
+
+        Where the bus cruises follows from the stop distances and the
+        acceleration profile, without simulating the route (see
+        'cruising_points'). Each run of cruising points after its first
+        is split into groups, halving every group whose merged energy
+        is off by more than 'tolerance' times the group's absolute
+        energy until all are within it. A group becomes its last
+        point, with the mean grade of the group. All other points,
+        i.e. where the bus speeds up or brakes, the first point of
+        each cruise, the stops, the route ends and 'keep', are kept.
+
+        Args:
+            'route_state': RouteState with 'grade', 'speed_limit' and
+                stops set.
+            'tolerance': relative energy error allowed per group, e.g.
+                0.01.
+            'a_prof': acceleration profile, see 'accel_dynamics'.
+            'a_neg': braking deceleration [m/s^2].
+            'mass': bus mass used for the error estimate [kg].
+            'aux': auxiliary load [W].
+            'keep': more point indicies to keep, e.g. where the mass
+                changes.
+
+        Returns:
+            'idx': sorted indicies of the kept points.
+            'steps': number of point spacings from the kept point
+                before to each kept point (1 for the first).
+            'grade': grade of each kept point.
+            'error_kwh': estimated absolute energy error of the merged
+                groups [kWh].
+        """
+
+    grade = np.asarray(route_state['grade'], dtype=float)
+
+    cruising, velocities = cruising_points(route_state, a_prof, a_neg)
+    cruising[np.asarray(keep, dtype=int)] = False
+
+    # The first point of a cruise comes from a faster point
+    mergeable = cruising.copy()
+    mergeable[1:] &= cruising[:-1]
+    mergeable[0] = False
+
+    # Runs of consecutive mergeable points as [start, end) groups
+    edges = np.diff(np.concatenate([[0], mergeable.view(np.int8), [0]]))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+
+    # Prefix sums give the totals of any group at once
+    point_energy = np.where(
+        mergeable, _cruise_energy(grade, velocities, mass, aux), 0.
+        )
+    grade_sums = np.append(0., np.cumsum(grade))
+    energy_sums = np.append(0., np.cumsum(point_energy))
+    abs_sums = np.append(0., np.cumsum(np.abs(point_energy)))
+
+    done_ends = []
+    done_error = 0.
+    while len(starts):
+        size = ends - starts
+        merged = size * _cruise_energy(
+            (grade_sums[ends] - grade_sums[starts]) / size,
+            velocities[starts],
+            mass,
+            aux
+            )
+        energy = energy_sums[ends] - energy_sums[starts]
+        error = np.abs(merged - energy)
+        within = (size == 1) | (
+            error <= tolerance * (abs_sums[ends] - abs_sums[starts])
+            )
+
+        done_ends.append(ends[within])
+        done_error += np.sum(error[within])
+
+        # Split the others in halves
+        starts, ends = starts[~within], ends[~within]
+        middle = (starts + ends) // 2
+        starts, ends = (
+            np.concatenate([starts, middle]),
+            np.concatenate([middle, ends])
+            )
+
+    group_ends = np.concatenate([np.zeros(0, dtype=int)] + done_ends)
+
+    # Merged points are dropped up to the last of each group
+    keep_mask = ~mergeable
+    keep_mask[group_ends - 1] = True
+
+    idx = np.flatnonzero(keep_mask)
+    steps = np.diff(idx, prepend=idx[0] - 1)
+
+    # Mean grade of each group, at its last point
+    merged_grade = grade[idx]
+    merged = steps > 1
+    merged_grade[merged] = (
+        grade_sums[idx[merged] + 1] - grade_sums[idx[merged] + 1 - steps[merged]]
+        ) / steps[merged]
+
+    return idx, steps, merged_grade, done_error/3.6e6
+
+
+def cruising_points(route_state, a_prof, a_neg):
+    """ Route points where 'accel.accel_dynamics' holds the bus at a
+        constant speed, found from the stop distances alone.
+
+        After a stop the bus follows the acceleration profile until it
+        reaches the speed limit at the first point after the stop, and
+        holds that speed until it is within braking distance of the
+        next stop. The points from two profile steps after that speed
+        is reached to the braking point cruise. Stretches whose speed
+        limit is above the end of the profile are not cruising.
+
+        Args:
+            'route_state': RouteState with 'speed_limit' and stops set.
+            'a_prof': acceleration profile, see 'accel_dynamics'.
+            'a_neg': braking deceleration [m/s^2].
+
+        Returns:
+            'cruising': boolean array, True at cruising points.
+            'velocity': cruise speed of each point's stretch [m/s].
+        """
+
+    profile = ca.AccelerationProfile.compile(a_prof)
+
+    num_pts = len(route_state)
+    is_stop = np.asarray(route_state['is_stop'], dtype=bool)
+    speed_limit = np.asarray(route_state['speed_limit'], dtype=float)
+
+    x_ns, x_ls = ca.stop_distances(is_stop)
+
+    # The stretch after each stop starts at the point after it
+    stop_idx = np.flatnonzero(is_stop)
+    pos = np.searchsorted(stop_idx, np.arange(num_pts), side='right')
+    entry = np.zeros(num_pts, dtype=int)
+    entry[pos > 0] = stop_idx[pos[pos > 0] - 1] + 1
+    velocity = speed_limit[np.minimum(entry, num_pts - 1)]
+
+    # Profile distance at which the speed limit is reached, and the
+    # braking distance from it
+    reached = np.minimum(
+        np.searchsorted(profile.velocity, velocity), len(profile) - 1
+        )
+    reach_distance = profile.distance[reached]
+    brake_distance = velocity**2 / (2*abs(a_neg))
+
+    cruising = (
+        ~is_stop
+        & (velocity > 0)
+        & (velocity <= profile.velocity[-1])
+        & (x_ls > reach_distance + 1.5*ca.POINT_SPACING)
+        & (x_ns > brake_distance)
+        )
+    cruising[[0, num_pts - 1]] = False
+
+    return cruising, velocity
+
+
+def _cruise_energy(grade, velocity, mass, aux):
+    """ Battery energy [J] at each point cruising at 'velocity' over
+        one point spacing.
+        """
+    force = _traction_force(grade, velocity, mass)
+    power = _battery_power(force * velocity) + aux/ldm.EFF_AUX
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return power * ca.POINT_SPACING / velocity
+
+
+def _traction_force(grade, velocity, mass):
+    grad_angle = np.arctan(grade)
+    return (
+        mass * ldm.GRAVI_ACCEL
+        * (np.sin(grad_angle) + ldm.FRIC_COEFF*np.cos(grad_angle))
+        + ldm.DRAG * velocity**2
+        )
+
+
+def _battery_power(p_traction):
+    eff_drive = ldm.EFF_MOTOR * ldm.EFF_INV
+    return np.where(
+        p_traction >= 0,
+        p_traction/eff_drive,
+        ldm.REGEN*eff_drive*p_traction
+        )
@@ -0,0 +1,216 @@
+""" Columnar container for the per-point state of a route simulation """
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+
+
+class RouteState():
+    """ Struct-of-arrays stand-in for the route GeoDataFrame used by
+        the simulation stages of 'RouteTrajectory'.
+
+        Every column is a contiguous float64 array. The columns written
+        by the simulation stages are preallocated in one block when the
+        state is created, so stages fill memory in place instead of
+        copying the whole table. Bus stops and signals are stored as
+        sorted arrays of route point indicies.
+
+        The GeoDataFrame is only built by 'to_geodataframe'.
+        """
+
+    # Columns written by the simulation stages, in the order they are
+    # computed.
+    COLUMNS = (
+        'mass',
+        'grav_force',
+        'roll_fric',
+        'acceleration',
+        'velocity',
+        'delta_times',
+        'aero_drag',
+        'inertia',
+        'power_output',
+        )
+
+    STOP_COLUMNS = ('is_bus_stop', 'is_signal', 'is_stop')
+
+    def __init__(self, num_pts, geometry=None, crs=None, stage_columns=True):
+        """ Args:
+                'num_pts': number of route points.
+                'geometry': optional point geometries of the route,
+                    kept by reference until a GeoDataFrame is built.
+                'crs': coordinate reference system of 'geometry'.
+                'stage_columns': preallocate the stage columns. Without
+                    them the state only holds the route inputs, and a
+                    stage column is allocated when it is written.
+            """
+
+        self._num_pts = num_pts
+        self.geometry = geometry
+        self.crs = crs
+
+        self._block = None
+        self._buffers = {}
+        if stage_columns:
+            self._block = np.zeros((len(self.COLUMNS), num_pts))
+            self._buffers = dict(zip(self.COLUMNS, self._block))
+        self._columns = {}
+        self._order = []
+
+        self.bus_stop_idx = np.zeros(0, dtype=int)
+        self.signal_idx = np.zeros(0, dtype=int)
+
+    @classmethod
+    def from_dataframe(cls, route_df, stage_columns=True):
+        """ Builds a state from a route (Geo)DataFrame. Boolean
+            'is_bus_stop' and 'is_signal' columns become index arrays.
+            See '__init__' for 'stage_columns'.
+            """
+
+        geometry = None
+        crs = None
+        if isinstance(route_df, gpd.GeoDataFrame):
+            geometry = route_df.geometry.values
+            crs = route_df.crs
+
+        state = cls(
+            len(route_df.index), geometry=geometry, crs=crs,
+            stage_columns=stage_columns
+            )
+
+        for name in route_df.columns:
+            if name == 'geometry' or name in cls.STOP_COLUMNS:
+                continue
+            state[name] = route_df[name].values
+
+        if 'is_bus_stop' in route_df.columns:
+            state.set_stops(
+                np.flatnonzero(route_df['is_bus_stop'].values),
+                np.flatnonzero(route_df['is_signal'].values)
+                )
+
+        return state
+
+    def copy(self):
+        """ Copy of the state whose stage columns can be rewritten
+            without changing this one. Geometry and input columns,
+            which are replaced rather than written in place, are
+            shared.
+            """
+
+        state = RouteState(
+            self._num_pts, geometry=self.geometry, crs=self.crs,
+            stage_columns=self._block is not None
+            )
+        if self._block is not None:
+            state._block[:] = self._block
+        state._columns = {
+            name: (
+                state._buffers[name] if name in state._buffers
+                else column.copy() if name in self.COLUMNS
+                else column
+                )
+            for name, column in self._columns.items()
+            }
+        state._order = list(self._order)
+        state.bus_stop_idx = self.bus_stop_idx
+        state.signal_idx = self.signal_idx
+
+        return state
+
+    def take(self, idx):
+        """ State of the route points 'idx' (sorted, including every
+            bus stop and signal), with the input columns of those
+            points. Stage columns are left to be computed again.
+            """
+
+        idx = np.asarray(idx, dtype=int)
+        geometry = None if self.geometry is None else self.geometry[idx]
+
+        state = RouteState(
+            len(idx), geometry=geometry, crs=self.crs,
+            stage_columns=self._block is not None
+            )
+        for name in self._order:
+            if name in self.COLUMNS or name in self.STOP_COLUMNS:
+                continue
+            state[name] = self._columns[name][idx]
+
+        state.set_stops(
+            np.searchsorted(idx, self.bus_stop_idx),
+            np.searchsorted(idx, self.signal_idx)
+            )
+
+        return state
+
+    def __len__(self):
+        return self._num_pts
+
+    def __contains__(self, name):
+        return name in self._columns or name in self._order
+
+    def __getitem__(self, name):
+
+        if name == 'is_bus_stop':
+            return self._mask(self.bus_stop_idx)
+        elif name == 'is_signal':
+            return self._mask(self.signal_idx)
+        elif name == 'is_stop':
+            return self._mask(self.stop_idx)
+
+        return self._columns[name]
+
+    def __setitem__(self, name, values):
+
+        if name in self._buffers:
+            column = self._buffers[name]
+            column[:] = values
+        else:
+            column = np.asarray(values)
+            if column.dtype.kind in 'biuf':
+                column = np.ascontiguousarray(column, dtype=np.float64)
+            if len(column) != self._num_pts:
+                raise ValueError(
+                    "Column '{}' has {} values for {} route points".format(
+                        name, len(column), self._num_pts
+                        )
+                    )
+
+        self._columns[name] = column
+        if name not in self._order:
+            self._order.append(name)
+
+    def set_stops(self, bus_stop_idx, signal_idx):
+        """ Marks route points as bus stops and signals by index. """
+
+        self.bus_stop_idx = np.unique(np.asarray(bus_stop_idx, dtype=int))
+        self.signal_idx = np.unique(np.asarray(signal_idx, dtype=int))
+
+        for name in self.STOP_COLUMNS:
+            if name not in self._order:
+                self._order.append(name)
+
+    @property
+    def stop_idx(self):
+        """ Sorted indicies of route points that are bus stops or
+            signals.
+            """
+        return np.union1d(self.bus_stop_idx, self.signal_idx)
+
+    def _mask(self, idx):
+        mask = np.zeros(self._num_pts, dtype=bool)
+        mask[idx] = True
+        return mask
+
+    def to_geodataframe(self):
+        """ Builds the route GeoDataFrame with one column per state
+            column, in the order they were computed.
+            """
+
+        data = {name: self[name] for name in self._order}
+
+        if self.geometry is None:
+            return pd.DataFrame(data)
+
+        data = dict(geometry=self.geometry, **data)
+
+        return gpd.GeoDataFrame(data, geometry='geometry', crs=self.crs)
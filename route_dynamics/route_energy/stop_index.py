@@ -0,0 +1,252 @@
+""" Network-wide index of the bus stops and signals on each route """
+import glob
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+import geopandas as gpd
+import shapely
+
+from ..route_elevation import base_df
+from . import knn
+
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), '..', '..', 'data')
+STOPS_SHP = os.path.join(
+    DATA_DIR, 'Transit_Stops_for_King_County_Metro__transitstop_point.shp'
+    )
+SIGNAL_SHPS = tuple(sorted(
+    glob.glob(os.path.join(DATA_DIR, 'Traffic_Signals*.shp'))
+    ))
+
+# Bump when the stored arrays or their derivation change.
+_INDEX_VERSION = 3
+
+
+class StopIndex():
+    """ Route point indicies and route offsets of the stops and signals
+        on every route, snapped once and saved in 'index_dir'.
+
+        Stops and signals within 'snap_distance' of a route line are
+        projected onto it (see 'knn.snap_to_route') and stored per
+        route, sorted along the route, in a .npz file. 'manifest.json'
+        records the modification time and size of every file (.shp,
+        .dbf, ...) of the source shapefiles. A route is snapped again
+        when its shapefile changes, and every route when the stop or
+        signal shapefiles or the index settings change.
+
+        Routes are indexed by 'build', or on their first 'lookup'.
+        Pass the index as 'stop_index' to 'RouteTrajectory' to use it
+        instead of snapping stop coordinates.
+        """
+
+    def __init__(self,
+        index_dir,
+        stops_shp=STOPS_SHP,
+        signal_shps=SIGNAL_SHPS,
+        snap_distance=20.,
+        cache_dir=None
+        ):
+        """ Args:
+                'index_dir': directory the index is saved in.
+                'stops_shp': bus stop point shapefile.
+                'signal_shps': traffic signal point shapefiles.
+                'snap_distance': farthest stop or signal from a route
+                    line [m].
+                'cache_dir': optional route coordinate cache, see
+                    'base_df.wrapper'.
+            """
+
+        self.index_dir = index_dir
+        self.stops_shp = stops_shp
+        self.signal_shps = tuple(signal_shps)
+        self.snap_distance = snap_distance
+        self.cache_dir = cache_dir
+
+        self._manifest = None
+        self._points = None
+
+    def __getstate__(self):
+        # Lookups of indexed routes, e.g. in worker processes, do not
+        # need the stop and signal points
+        state = dict(self.__dict__)
+        state['_points'] = None
+        return state
+
+    def build(self, route_shapefiles=None):
+        """ Indexes every route in 'route_shapefiles' (default: the
+            'rt*_pts2.shp' routes in 'data/') that is missing or stale.
+            Returns the number of routes snapped.
+            """
+
+        if route_shapefiles is None:
+            route_shapefiles = sorted(
+                glob.glob(os.path.join(DATA_DIR, 'rt*_pts2.shp'))
+                )
+
+        stale = [shp for shp in route_shapefiles if not self.is_current(shp)]
+        for shp in stale:
+            self._index_route(shp, save=False)
+        if stale:
+            self._save_manifest()
+
+        return len(stale)
+
+    def is_current(self, shp_filename):
+        """ Whether the route is indexed from its current shapefile """
+
+        entry = self.manifest['routes'].get(_route_key(shp_filename))
+        return entry is not None and entry['stamp'] == _stamp(shp_filename)
+
+    def lookup(self, shp_filename):
+        """ Dict of the stops and signals on the route, indexing it
+            first if it is missing or stale:
+                'stop_idx', 'signal_idx': sorted route point indicies.
+                'stop_offsets', 'signal_offsets': distance along the
+                    route [m].
+                'stop_coords', 'signal_coords': coordinates of the
+                    stops and signals in their shapefiles.
+            """
+
+        if not self.is_current(shp_filename):
+            self._index_route(shp_filename)
+
+        entry = self.manifest['routes'][_route_key(shp_filename)]
+        with np.load(os.path.join(self.index_dir, entry['file'])) as arrays:
+            return {name: arrays[name] for name in arrays.files}
+
+    @property
+    def manifest(self):
+        """ Index contents, read from 'manifest.json'. Empty if the
+            index is missing or was built from other sources or
+            settings.
+            """
+
+        if self._manifest is None:
+            sources = self._sources()
+            self._manifest = {'sources': sources, 'routes': {}}
+
+            filename = os.path.join(self.index_dir, 'manifest.json')
+            if os.path.isfile(filename):
+                with open(filename) as f:
+                    manifest = json.load(f)
+                if manifest['sources'] == sources:
+                    self._manifest = manifest
+
+        return self._manifest
+
+    def _sources(self):
+        """ Settings and stop and signal shapefile stamps the index is
+            built from.
+            """
+
+        return {
+            'version': _INDEX_VERSION,
+            'snap_distance': self.snap_distance,
+            'stops': [os.path.abspath(self.stops_shp), _stamp(self.stops_shp)],
+            'signals': [
+                [os.path.abspath(shp), _stamp(shp)]
+                for shp in self.signal_shps
+                ],
+            }
+
+    def _read_points(self):
+        """ Stop and signal coordinate arrays, read once """
+
+        if self._points is None:
+            stops = _point_coords([self.stops_shp])
+            signals = _point_coords(self.signal_shps)
+            self._points = (stops, signals)
+
+        return self._points
+
+    def _index_route(self, shp_filename, save=True):
+        """ Snaps the stops and signals onto the route and writes its
+            arrays.
+            """
+
+        route_df = base_df.wrapper(
+            shp_filename, 6, 6, cache_dir=self.cache_dir
+            )
+        distance = np.asarray(route_df['distance'], dtype=float)
+
+        arrays = {}
+        for name, coords in zip(('stop', 'signal'), self._read_points()):
+            positions, _ = knn.snap_to_route(
+                route_df.geometry.values,
+                coords,
+                self.snap_distance,
+                crs=route_df.crs
+                )
+            snapped = knn.route_order(positions)
+            positions = positions[snapped]
+
+            arrays[name + '_idx'] = np.rint(positions).astype(int)
+            arrays[name + '_coords'] = coords[snapped, :2]
+            arrays[name + '_offsets'] = np.interp(
+                positions, np.arange(len(distance)), distance
+                )
+
+        key = _route_key(shp_filename)
+        name = '{}-{}.npz'.format(
+            os.path.splitext(os.path.basename(shp_filename))[0],
+            hashlib.sha1(key.encode()).hexdigest()[:8]
+            )
+
+        os.makedirs(self.index_dir, exist_ok=True)
+        _atomic_write(
+            os.path.join(self.index_dir, name),
+            lambda f: np.savez(f, **arrays)
+            )
+
+        self.manifest['routes'][key] = {
+            'file': name,
+            'stamp': _stamp(shp_filename),
+            }
+        if save:
+            self._save_manifest()
+
+    def _save_manifest(self):
+        os.makedirs(self.index_dir, exist_ok=True)
+        _atomic_write(
+            os.path.join(self.index_dir, 'manifest.json'),
+            lambda f: f.write(json.dumps(self.manifest, indent=1).encode())
+            )
+
+
+def _route_key(shp_filename):
+    return os.path.abspath(shp_filename)
+
+
+def _stamp(shp_filename):
+    """ Modification times and sizes of the files of a shapefile """
+    return base_df.shapefile_stamp(shp_filename)
+
+
+def _point_coords(shapefiles):
+    """ (num_pts, 2) coordinates of the points (and multipoint parts) in
+        'shapefiles'.
+        """
+
+    geometry = [gpd.read_file(shp).geometry.values for shp in shapefiles]
+    if not geometry:
+        return np.zeros((0, 2))
+
+    return shapely.get_coordinates(np.concatenate(geometry))
+
+
+def _atomic_write(filename, write):
+    """ Writes a file through a temporary file and renames it, so
+        readers never see a partial file.
+        """
+
+    handle, tmp_name = tempfile.mkstemp(dir=os.path.dirname(filename))
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            write(f)
+        os.replace(tmp_name, filename)
+    except BaseException:
+        os.remove(tmp_name)
+        raise
@@ -0,0 +1,408 @@
+""" Stop-to-stop streaming of the RouteTrajectory simulation for very
+    long routes.
+    """
+import hashlib
+
+from collections import OrderedDict
+from collections import namedtuple
+
+import numpy as np
+import shapely
+
+from . import longi_dynam_model as ldm
+from . import accel as ca
+from .route_state import RouteState
+
+
+# One stop-to-stop stretch of route: route points 'start' to 'end'
+# (exclusive), their simulated columns, the energy used over them in
+# kWh and the time on route at their last point in seconds.
+RouteSegment = namedtuple(
+    'RouteSegment',
+    ['start', 'end', 'columns', 'energy_kwh', 'time_on_route_s']
+    )
+
+
+class StreamingRouteTrajectory(ldm.RouteTrajectory):
+    """ RouteTrajectory that simulates one stop-to-stop segment at a
+        time instead of the whole route at once.
+
+        The bus is at rest at every stop and signal, so kinematics and
+        the traction power cap restart at each of them. Only the
+        velocity, mass and time on route are carried from one segment
+        to the next. The route state holds the route inputs without
+        the stage columns of RouteTrajectory, so the memory used by
+        the simulation depends on the longest segment, not on the
+        route length. The route coordinate columns are still read
+        whole (memory mapped when cached with 'cache_dir').
+
+        Takes the arguments of RouteTrajectory. Iterate 'segments' for
+        the per-point columns, or call 'summary'. Results equal those
+        of RouteTrajectory, up to rounding of the summed energy. With
+        'resample_tolerance' the segments run over the resampled
+        route points.
+
+        Pass the same 'segment_cache' (a SegmentCache) to trajectories
+        of routes sharing road to simulate each shared segment once.
+        """
+
+    def __init__(self,
+        route_num,
+        shp_filename,
+        a_prof,
+        stop_coords=None,
+        signal_coords=None,
+        mass_array=None,
+        unloaded_bus_mass=12927,
+        charging_power_max=None,
+        aux=None,
+        a_pos=0.4,
+        a_neg=-1.5,
+        cache_dir=None,
+        segment_cache=None,
+        profile=False,
+        profile_hook=None,
+        resample_tolerance=None,
+        stop_pattern=(3, 3),
+        snap_distance=None,
+        stop_index=None
+        ):
+
+        self.segment_cache = segment_cache
+
+        self._initialize_instance_args(
+            route_num,
+            shp_filename,
+            a_prof,
+            stop_coords,
+            signal_coords,
+            mass_array,
+            unloaded_bus_mass,
+            charging_power_max,
+            aux,
+            a_pos,
+            a_neg,
+            cache_dir,
+            profile,
+            profile_hook,
+            resample_tolerance,
+            stop_pattern,
+            snap_distance,
+            stop_index
+            )
+
+        self.route_state = RouteState.from_dataframe(
+            self.build_route_coordinate_df(
+                shp_filename = shp_filename
+                ),
+            stage_columns=False
+            )
+        self._add_stops_to_df(stop_coords, signal_coords, self.route_state)
+        self.route_state = self._resample_route(self.route_state)
+
+    def segments(self):
+        """ Generator of RouteSegment, in route order. """
+
+        route_state = self.route_state
+        num_pts = len(route_state)
+
+        stop_idx = route_state.stop_idx
+        bounds = np.union1d([0, num_pts], stop_idx)
+
+        mass_idx, mass_values = self._mass_changes()
+
+        steps = None
+        if 'steps' in route_state:
+            steps = route_state['steps']
+
+        if self.segment_cache is not None:
+            coords = shapely.get_coordinates(route_state.geometry)
+            bus_stops = set(route_state.bus_stop_idx.tolist())
+            signals = set(route_state.signal_idx.tolist())
+
+        velocity = 0.
+        mass = np.nan
+        time_on_route = 0.
+
+        for start, end in zip(bounds[:-1], bounds[1:]):
+
+            # Mass at each point, from the last stop with a mass
+            changes = slice(
+                np.searchsorted(mass_idx, start),
+                np.searchsorted(mass_idx, end)
+                )
+            segment_mass = np.full(end - start, np.nan)
+            segment_mass[0] = mass
+            segment_mass[mass_idx[changes] - start] = mass_values[changes]
+            last_set = np.where(
+                np.isnan(segment_mass), 0, np.arange(end - start)
+                )
+            np.maximum.accumulate(last_set, out=last_set)
+            segment_mass = segment_mass[last_set]
+
+            if self.segment_cache is None:
+                columns, energy, exit_velocity = self._simulate_segment(
+                    start, end, velocity, segment_mass
+                    )
+            else:
+                # Including the next stop, as for the kinematics
+                window = slice(start, min(end + 1, num_pts))
+                key = self.segment_cache.key(
+                    coords[window],
+                    route_state['grade'][start:end],
+                    route_state['speed_limit'][window],
+                    (
+                        start in bus_stops, start in signals,
+                        end in bus_stops, end in signals
+                        ),
+                    segment_mass,
+                    None if steps is None else steps[window],
+                    velocity,
+                    start == 0,
+                    self._model_params()
+                    )
+                columns, energy, exit_velocity = self.segment_cache.get(
+                    key,
+                    lambda: self._simulate_segment(
+                        start, end, velocity, segment_mass
+                        )
+                    )
+                columns = dict(columns)
+
+            # Time from the second route point on, as in
+            # 'energy_from_route'
+            first = 1 if start == 0 else 0
+            columns['time_on_route'] = np.cumsum(
+                np.append(time_on_route, columns['delta_times'][first:])
+                )[1 - first:]
+
+            velocity = exit_velocity
+            mass = segment_mass[-1]
+            time_on_route = columns['time_on_route'][-1]
+
+            yield RouteSegment(start, end, columns, energy, time_on_route)
+
+    def _simulate_segment(self, start, end, velocity, mass):
+        """ Simulates route points 'start' to 'end' (exclusive) with
+            the speed 'velocity' before them and masses 'mass'.
+            Returns the columns, the energy used and the speed at the
+            last point before the power cap.
+            """
+
+        # Include the next stop, as the kinematics brake for it
+        window_end = min(end + 1, len(self.route_state))
+
+        columns = self._segment_kinematics(start, window_end, velocity)
+        columns = {
+            name: values[:end - start] for name, values in columns.items()
+            }
+
+        # Speed carried to the next segment, before the power cap
+        exit_velocity = columns['velocity'][-1]
+
+        columns['mass'] = mass
+        columns['grade'] = self.route_state['grade'][start:end]
+        (
+            columns['grav_force'],
+            columns['roll_fric']
+            ) = self.calculate_const_forces(columns)
+        (
+            columns['aero_drag'],
+            columns['inertia']
+            ) = self.calculate_forces(
+            columns['mass'],
+            columns['acceleration'],
+            columns['velocity']
+            )
+        columns['power_output'] = self._calculate_batt_power_exert(columns)
+
+        # Energy from the second route point on, as in
+        # 'energy_from_route'
+        first = 1 if start == 0 else 0
+        delta_t = columns['delta_times'][first:]
+        power = columns['power_output'][first:]
+        energy = np.sum(power/1000 * delta_t/3600)
+
+        return columns, energy, exit_velocity
+
+    def _model_params(self):
+        """ Arguments other than the route that segment results depend
+            on.
+            """
+        return (
+            self.a_prof.velocity,
+            self.a_prof.acceleration,
+            self.a_pos,
+            self.a_neg,
+            self.charging_power_max,
+            self.aux,
+            )
+
+    def summary(self):
+        """ Energy used in kWh, time on route in seconds and peak
+            battery power in W, accumulated over the segments.
+            """
+
+        energy = 0.
+        time_on_route = 0.
+        peak_power = -np.inf
+
+        for segment in self.segments():
+            energy += segment.energy_kwh
+            time_on_route = segment.time_on_route_s
+            peak_power = max(
+                peak_power, np.max(segment.columns['power_output'])
+                )
+
+        return {
+            'energy_kwh': energy,
+            'time_on_route_s': time_on_route,
+            'peak_power_w': peak_power,
+            }
+
+    def _mass_changes(self):
+        """ Sorted route point indicies where the mass is set, and the
+            mass there, as in 'calculate_mass'.
+            """
+
+        num_pts = len(self.route_state)
+        mass_array = self._snapped_masses(self.mass_array)
+        order = np.sort(self.stop_nn_indicies.ravel())[:len(mass_array)]
+
+        changes = dict(zip(order, mass_array))
+        changes[0] = self.unloaded_bus_mass
+        changes[num_pts - 1] = self.unloaded_bus_mass
+
+        mass_idx = np.array(sorted(changes), dtype=int)
+        mass_values = np.array([changes[i] for i in mass_idx], dtype=float)
+
+        return mass_idx, mass_values
+
+    def _segment_kinematics(self, start, end, velocity):
+        """ Acceleration, velocity and time step of route points
+            'start' to 'end' (exclusive). 'velocity' is the speed at
+            the point before 'start'.
+            """
+
+        route_state = self.route_state
+        segment = RouteState(end - start)
+        segment['speed_limit'] = route_state['speed_limit'][start:end]
+        if 'steps' in route_state:
+            segment['steps'] = route_state['steps'][start:end]
+        segment.set_stops(
+            route_state.bus_stop_idx[
+                (route_state.bus_stop_idx >= start)
+                & (route_state.bus_stop_idx < end)
+                ] - start,
+            route_state.signal_idx[
+                (route_state.signal_idx >= start)
+                & (route_state.signal_idx < end)
+                ] - start
+            )
+
+        (
+            acceleration,
+            velocities,
+            _,
+            _,
+            delta_times
+            ) = ca.accel_dynamics(segment, self.a_prof, self.a_pos, self.a_neg)
+
+        # The first time step averages with the speed before the
+        # segment, which 'accel_dynamics' takes as zero.
+        first_delta_x = 10.9728
+        if 'steps' in segment:
+            first_delta_x *= segment['steps'][0]
+        with np.errstate(divide='ignore'):
+            first_delta_time = first_delta_x / ((velocities[0] + velocity)/2)
+        if first_delta_time > 1000000:
+            first_delta_time = 0
+        if segment['is_bus_stop'][0] or segment['is_signal'][0]:
+            first_delta_time += ca.DWELL_TIME
+        delta_times[0] = first_delta_time
+
+        return {
+            'acceleration': acceleration,
+            'velocity': velocities,
+            'delta_times': delta_times,
+            }
+
+
+class SegmentCache():
+    """ Simulated stop-to-stop segments shared between routes.
+
+        Segments are keyed by a hash of the coordinates of their
+        route points and of the next stop, their grades, speed limits,
+        stop and signal flags, masses, entry speed and the model
+        parameters, so a hit is only ever a segment simulated with the
+        same inputs. Routes whose shapefiles share the points of a
+        stretch of road between the same stops reuse one simulation.
+        Cached columns are read-only.
+
+        'hits' and 'misses' count lookups; 'stats' summarizes them.
+        """
+
+    def __init__(self, max_entries=100000):
+        """ Args:
+                'max_entries': number of segments kept, least recently
+                    used first out.
+            """
+
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def key(*parts):
+        """ Hash of arrays, scalars and tuples of them """
+
+        digest = hashlib.sha1()
+        for part in parts:
+            if isinstance(part, tuple):
+                digest.update(SegmentCache.key(*part).encode())
+                continue
+            if part is None:
+                digest.update(b'None')
+                continue
+            array = np.ascontiguousarray(part)
+            digest.update(str((array.dtype, array.shape)).encode())
+            digest.update(array.tobytes())
+
+        return digest.hexdigest()
+
+    def get(self, key, simulate):
+        """ Cached result of 'key', calling 'simulate' on a miss. """
+
+        if key in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+        self.misses += 1
+        columns, energy, exit_velocity = simulate()
+        for values in columns.values():
+            values.flags.writeable = False
+
+        self._entries[key] = (columns, energy, exit_velocity)
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+        return self._entries[key]
+
+    @property
+    def stats(self):
+        """ Dict of hits, misses, hit rate and cached segments """
+
+        lookups = self.hits + self.misses
+
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.,
+            'segments': len(self._entries),
+            }
+
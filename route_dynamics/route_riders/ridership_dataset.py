@@ -0,0 +1,219 @@
+"""
+Converts KCM ridership exports ('Trip*.csv', 'Zon*Unsum.csv') into one
+columnar dataset partitioned by route and period, and reads back only
+the partitions and columns a query needs.
+
+The dataset directory holds two tables,
+
+    <dataset_dir>/zones/Route=<route>/Period=<period>/<csv name>-0.parquet
+    <dataset_dir>/trips/SignRt=<route>/Period=<period>/<csv name>-0.parquet
+
+in Parquet or Feather (Arrow IPC) format.
+"""
+import os
+import shutil
+import tempfile
+from os import path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+
+# Column types of the stop-level ridership table ('Zon*Unsum.csv')
+ZONE_SCHEMA = pa.schema([
+    ('Route', pa.int32()),
+    ('Dir', pa.string()),
+    ('Trip_ID', pa.int64()),
+    ('InOut', pa.string()),
+    ('STOP_SEQ', pa.int32()),
+    ('STOP_ID', pa.int64()),
+    ('Period', pa.string()),
+    ('AveOn', pa.float64()),
+    ('AveOff', pa.float64()),
+    ('AveLd', pa.float64()),
+    ('Obs', pa.int32()),
+    ])
+
+# Column types of the trip table ('Trip*.csv')
+TRIP_SCHEMA = pa.schema([
+    ('SignRt', pa.int32()),
+    ('InOut', pa.string()),
+    ('KeyTrip', pa.int64()),
+    ('BusType', pa.string()),
+    ('Seats', pa.int32()),
+    ('Period', pa.string()),
+    ('AnnRides', pa.float64()),
+    ])
+
+# Table name: (schema, partition columns)
+TABLES = {
+    'zones': (ZONE_SCHEMA, ['Route', 'Period']),
+    'trips': (TRIP_SCHEMA, ['SignRt', 'Period']),
+    }
+
+
+def convert_ridership(
+    dataset_dir,
+    zone_csvs=(),
+    trip_csvs=(),
+    format='parquet'
+    ):
+    """
+    Writes KCM ridership CSVs into the partitioned dataset at
+    'dataset_dir', replacing any dataset already there. Each CSV is
+    parsed once. The dataset is written to a temporary directory and
+    renamed into place, so readers never see a partial dataset or
+    partitions left from an earlier conversion.
+
+    Inputs:
+    dataset_dir - directory of the dataset, created if needed
+    zone_csvs - stop-level ridership files ('Zon*Unsum.csv')
+    trip_csvs - trip summary files ('Trip*.csv')
+    format - 'parquet' or 'feather'
+
+    Outputs:
+    num_rows - dict of the number of rows written to each table
+    """
+
+    dataset_dir = path.abspath(dataset_dir)
+    parent = path.dirname(dataset_dir)
+    os.makedirs(parent, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=parent)
+    try:
+        num_rows = _write_tables(tmp_dir, zone_csvs, trip_csvs, format)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    _replace_dir(tmp_dir, dataset_dir)
+
+    return num_rows
+
+
+def _write_tables(dataset_dir, zone_csvs, trip_csvs, format):
+    """ Writes the CSVs into a new dataset directory """
+
+    num_rows = {}
+
+    for table, csvs in (('zones', zone_csvs), ('trips', trip_csvs)):
+        schema, partition_cols = TABLES[table]
+        num_rows[table] = 0
+
+        for number, csv in enumerate(csvs):
+            df = pd.read_csv(
+                csv,
+                usecols=schema.names,
+                dtype={field.name: field.type.to_pandas_dtype()
+                       for field in schema}
+                )
+            data = pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+
+            # Numbered, as CSVs from different directories may share
+            # a name
+            name = '{}-{}'.format(
+                path.splitext(path.basename(csv))[0], number
+                )
+            ds.write_dataset(
+                data,
+                path.join(dataset_dir, table),
+                format=format,
+                partitioning=_partitioning(table),
+                basename_template=name + '-{i}.' + _extension(format),
+                existing_data_behavior='overwrite_or_ignore'
+                )
+
+            num_rows[table] += data.num_rows
+
+    return num_rows
+
+
+def read_table(
+    dataset_dir,
+    table='zones',
+    route=None,
+    period=None,
+    in_out=None,
+    columns=None
+    ):
+    """
+    Reads rows of one route and period from the dataset. Only the
+    matching partitions and the requested columns are read.
+
+    Inputs:
+    dataset_dir - directory written by 'convert_ridership'
+    table - 'zones' or 'trips'
+    route - King County Metro Route Number, or None for all routes
+    period - 'AM', 'MID', 'PM', 'XEV' or 'XNT', or None for all
+    in_out - Inbound 'I', Outbound 'O', or None for both
+    columns - columns to read, all by default
+
+    Outputs:
+    df - pandas DataFrame with typed columns, in file order
+    """
+
+    schema, (route_col, period_col) = TABLES[table]
+    dataset = _dataset(dataset_dir, table)
+
+    conditions = []
+    if route is not None:
+        conditions.append(ds.field(route_col) == route)
+    if period is not None:
+        conditions.append(ds.field(period_col) == period)
+    if in_out is not None:
+        conditions.append(ds.field('InOut') == in_out)
+
+    condition = None
+    for c in conditions:
+        condition = c if condition is None else condition & c
+
+    if columns is None:
+        columns = schema.names
+
+    return dataset.to_table(columns=list(columns), filter=condition).to_pandas()
+
+
+def _replace_dir(new_dir, target):
+    """ Renames 'new_dir' to 'target', removing an existing 'target' """
+
+    old_dir = None
+    if path.exists(target):
+        old_dir = tempfile.mkdtemp(dir=path.dirname(target))
+        os.rename(target, path.join(old_dir, 'old'))
+
+    os.rename(new_dir, target)
+
+    if old_dir is not None:
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def _dataset(dataset_dir, table):
+    table_dir = path.join(dataset_dir, table)
+    files = [
+        f for _, _, names in os.walk(table_dir) for f in names
+        ]
+    if not files:
+        raise FileNotFoundError(
+            "No '{}' table in ridership dataset {}".format(table, dataset_dir)
+            )
+    format = 'feather' if files[0].endswith('.feather') else 'parquet'
+
+    return ds.dataset(
+        table_dir,
+        format=format,
+        partitioning=_partitioning(table)
+        )
+
+
+def _partitioning(table):
+    schema, partition_cols = TABLES[table]
+    return ds.partitioning(
+        pa.schema([schema.field(name) for name in partition_cols]),
+        flavor='hive'
+        )
+
+
+def _extension(format):
+    if format not in ('parquet', 'feather'):
+        raise ValueError("format must be 'parquet' or 'feather'")
+    return format
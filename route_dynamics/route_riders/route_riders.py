@@ -9,17 +9,166 @@ from shapely.geometry import mapping
 
 #sys.path.append(path.abspath('..'))
 import route_dynamics.route_elevation.base_df as base
-dat1 = pd.read_csv("../data/Trip183.csv", usecols = ['SignRt', 'InOut', 'KeyTrip', 'BusType', 'Seats', 
-                     'Period', 'AnnRides']) # KCM Data
-dat2 = pd.read_csv("../data/Zon183Unsum.csv", usecols = ['Route', 'Dir', 'Trip_ID', 'InOut', 'STOP_SEQ', 'STOP_ID',
-                     'Period', 'AveOn', 'AveOff', 'AveLd', 'Obs']) # KCM Data
+from . import ridership_dataset
 
-# Removing all unneeded columns
-trip183 = dat1
-trip183unsum = dat2
+# Directory of the KCM data files, independent of the working directory
+DATA_DIR = path.join(path.dirname(__file__), '..', '..', 'data')
 
+TRIP_COLUMNS = ['SignRt', 'InOut', 'KeyTrip', 'BusType', 'Seats',
+                'Period', 'AnnRides']
+ZONE_COLUMNS = ['Route', 'Dir', 'Trip_ID', 'InOut', 'STOP_SEQ', 'STOP_ID',
+                'Period', 'AveOn', 'AveOff', 'AveLd', 'Obs']
 
-def route_ridership(period, route, empty_bus):
+
+class RidershipStore():
+    """
+    KCM ridership statistics and stop locations, read on first use.
+
+    The stop-level ridership rows are indexed by (Route, Period, InOut)
+    and the stop locations by STOP_ID, so a route and period is
+    selected by index lookup and joined to its stop locations in one
+    step.
+
+    With 'dataset_dir' set, ridership is read from the partitioned
+    dataset written by 'ridership_dataset.convert_ridership' instead of
+    the CSVs, and a query only reads its route and period partitions.
+
+    Inputs:
+    trip_csv - KCM trip summary ('Trip*.csv')
+    zone_csv - KCM stop-level ridership ('Zon*Unsum.csv')
+    stops_shp - KCM transit stop point shapefile
+    dataset_dir - optional partitioned ridership dataset
+    """
+
+    def __init__(self,
+        trip_csv=path.join(DATA_DIR, 'Trip183.csv'),
+        zone_csv=path.join(DATA_DIR, 'Zon183Unsum.csv'),
+        stops_shp=path.join(
+            DATA_DIR, 'Transit_Stops_for_King_County_Metro__transitstop_point.shp'
+            ),
+        dataset_dir=None
+        ):
+
+        self.trip_csv = trip_csv
+        self.zone_csv = zone_csv
+        self.stops_shp = stops_shp
+        self.dataset_dir = dataset_dir
+
+        self._trips = None
+        self._zones = None
+        self._zone_index = None
+        self._zone_directions = None
+        self._stop_geometry = None
+
+    @property
+    def trips(self):
+        """ Trip summary DataFrame """
+        if self._trips is None and self.dataset_dir is not None:
+            self._trips = ridership_dataset.read_table(
+                self.dataset_dir, 'trips'
+                )
+        elif self._trips is None:
+            self._trips = pd.read_csv(self.trip_csv, usecols=TRIP_COLUMNS)
+        return self._trips
+
+    @property
+    def zones(self):
+        """ Stop-level ridership DataFrame """
+        if self._zones is None and self.dataset_dir is not None:
+            self._zones = ridership_dataset.read_table(
+                self.dataset_dir, 'zones'
+                )
+        elif self._zones is None:
+            self._zones = pd.read_csv(self.zone_csv, usecols=ZONE_COLUMNS)
+        return self._zones
+
+    @property
+    def zone_index(self):
+        """ Row positions in 'zones' of each (Route, Period, InOut) """
+        if self._zone_index is None:
+            self._zone_index = self.zones.groupby(
+                ['Route', 'Period', 'InOut'], sort=False
+                ).indices
+        return self._zone_index
+
+    @property
+    def zone_directions(self):
+        """ InOut values in 'zones' """
+        if self._zone_directions is None:
+            self._zone_directions = list(self.zones['InOut'].unique())
+        return self._zone_directions
+
+    @property
+    def stop_geometry(self):
+        """ Stop location Series indexed by STOP_ID, first listing of
+            each stop in the shapefile.
+            """
+        if self._stop_geometry is None:
+            stops = gpd.read_file(self.stops_shp)
+            stops = stops.drop_duplicates('STOP_ID')
+            self._stop_geometry = pd.Series(
+                stops.geometry.values, index=stops['STOP_ID'].values,
+                name='geometry'
+                )
+        return self._stop_geometry
+
+    def zone_rows(self, route, period, in_out=None, columns=None):
+        """
+        Ridership rows of a route in a period, in file order.
+
+        Inputs:
+        route - King County Metro Route Number
+        period - 'AM', 'MID', 'PM', 'XEV' or 'XNT'
+        in_out - Inbound 'I', Outbound 'O', or None for both
+        columns - columns to return, all by default
+        """
+
+        if columns is None:
+            columns = ZONE_COLUMNS
+
+        if self.dataset_dir is not None and self._zones is None:
+            return ridership_dataset.read_table(
+                self.dataset_dir, 'zones', route, period, in_out, columns
+                )
+
+        if in_out is None:
+            directions = self.zone_directions
+        else:
+            directions = [in_out]
+
+        index = self.zone_index
+        positions = [
+            index[(route, period, d)] for d in directions
+            if (route, period, d) in index
+            ]
+
+        if not positions:
+            return self.zones.iloc[:0][columns]
+
+        return self.zones.iloc[np.sort(np.concatenate(positions))][columns]
+
+
+_default_store = None
+
+
+def default_store():
+    """ Shared RidershipStore of the files in DATA_DIR """
+    global _default_store
+    if _default_store is None:
+        _default_store = RidershipStore()
+    return _default_store
+
+
+def __getattr__(name):
+    # The module used to read these tables on import
+    if name in ('dat1', 'trip183'):
+        return default_store().trips
+    if name in ('dat2', 'trip183unsum'):
+        return default_store().zones
+    raise AttributeError(name)
+
+
+def route_ridership(period, route, empty_bus, store=None):
     """
     Calculates ridership mass from King County Metro ridership statistics. An
     average ridership is used and is specific to a specific route, direction,
@@ -27,26 +176,28 @@ def route_ridership(period, route, empty_bus):
 
     Inputs:
     period - A block of time, options are 'AM', 'MID', 'PM', 'XEV', 'XNT'
-    direction - Inbound 'I' or Outbound 'O'
     route - King County Metro Route Number
+    empty_bus - Mass of the bus with no riders
+    store - RidershipStore to read from, the files in DATA_DIR by default
 
     Outputs:
-    final_df - A pandas DataFrame with all raw ridership data
-    riders_kept - A DataFrame with the average ridership in kilograms as it
-        changes between stops with the most common bus type for the specified
-        parameters
-    mode_mass - Mass of the most frequently used bus type for the given
-        parameters with no riders
+    final_df - A pandas DataFrame with the average load, number of observed
+        trips, passenger mass and total mass at each stop in both directions,
+        and the stop location
+        (NaN for stops missing from the stop shapefile)
 
     """
 
-    df = trip183unsum
-    df = df.drop(df[(df.Period != period)].index)
-    #df = df.drop(df[(df.InOut != direction)].index)
-    df = df.drop(df[(df.Route != route)].index)
+    if store is None:
+        store = default_store()
+
+    df = store.zone_rows(
+        route, period,
+        columns=['InOut', 'Trip_ID', 'STOP_SEQ', 'STOP_ID', 'AveLd', 'Obs']
+        )
 
     final_df = df.sort_values(by=['InOut','Trip_ID', 'STOP_SEQ', 'STOP_ID'])
-    final_df = final_df[['InOut','STOP_SEQ', 'STOP_ID', 'AveLd']]
+    final_df = final_df[['InOut','STOP_SEQ', 'STOP_ID', 'AveLd', 'Obs']]
     final_df = final_df.drop_duplicates(subset=['InOut','STOP_SEQ'], keep='first')
     final_df = final_df.sort_values(by=['InOut','STOP_SEQ'])
     final_df = final_df.reset_index()
@@ -54,38 +205,6 @@ def route_ridership(period, route, empty_bus):
     final_df['Pass_Mass'] = final_df['AveLd']*80
     final_df['Total_Mass'] = final_df['Pass_Mass'] + empty_bus
 
-    stop_ids = final_df['STOP_ID'].values
-    stops_riders = pd.DataFrame(stop_ids, columns = ['STOP_ID'])
-
-    routes_shp = '../data/rt' + str(route) + '_pts2.shp'
-    stops_shp = '../data/Transit_Stops_for_King_County_Metro__transitstop_point.shp'
-
-    route_num = route
-
-    stops = gpd.read_file(stops_shp)
-    stops['ROUTE_LIST'].fillna(value=str(0), inplace=True)
-
-    stops_list = pd.DataFrame(columns=stops.columns)
-
-    for i in range(0, len(stops)):
-
-        for j in range(len(stops_riders)):
-            if stops_riders['STOP_ID'][j]==stops['STOP_ID'][i]:
-                row = pd.DataFrame(stops.iloc[i])
-                stops_list = pd.concat([stops_list,row.transpose()])
-            else:
-                 pass
-
-    coord_list_full = stops_list.drop_duplicates('STOP_ID')
-    coord_list = coord_list_full[['STOP_ID', 'geometry']]
-    coord_list = coord_list.reset_index(drop=True)
-
-    filler = np.zeros(len(final_df))
-    final_df = final_df.assign(geometry = filler)
-
-    for i in range(len(final_df)):
-        stopid = final_df['STOP_ID'].iloc[i]
-        copy = coord_list.loc[coord_list['STOP_ID'] == stopid].geometry.values
-        final_df['geometry'].iloc[i] = copy
+    final_df = final_df.join(store.stop_geometry, on='STOP_ID')
 
     return final_df
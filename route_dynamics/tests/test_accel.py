@@ -0,0 +1,116 @@
+""" Tests for route_energy.accel """
+from ..route_energy import accel
+
+import numpy as np
+import pandas as pd
+import pytest
+
+
+def test_stop_distances_matches_loop():
+    """ Vectorized stop distances are identical to the reference loop
+        for random stop patterns, including routes with stops at the
+        ends and routes without stops.
+        """
+    rng = np.random.default_rng(0)
+
+    patterns = [
+        rng.random(300) < 0.05,
+        np.zeros(50, dtype=bool),
+        np.ones(20, dtype=bool),
+        ]
+    ends = np.zeros(40, dtype=bool)
+    ends[[0, -1]] = True
+    patterns.append(ends)
+
+    for is_stop in patterns:
+        x_ns, x_ls = accel.stop_distances(is_stop)
+        x_ns_loop, x_ls_loop = accel._stop_distances_loop(is_stop)
+
+        assert np.array_equal(x_ns, x_ns_loop), "x_ns differs from loop"
+        assert np.array_equal(x_ls, x_ls_loop), "x_ls differs from loop"
+
+
+def test_stop_distances_simple_route():
+    """ Check distances by hand on a short route with one stop. """
+    is_stop = np.array([False, False, True, False])
+
+    x_ns, x_ls = accel.stop_distances(is_stop, delta_x=1.)
+
+    assert np.array_equal(x_ns, [2., 1., 0., 0.])
+    assert np.array_equal(x_ls, [0., 1., 0., 1.])
+
+
+def test_time_stop_distances_reports_agreement():
+    is_stop = np.zeros(100, dtype=bool)
+    is_stop[::10] = True
+
+    timings = accel.time_stop_distances(is_stop)
+
+    assert timings['num_points'] == 100
+    assert timings['num_stops'] == 10
+    assert timings['max_abs_diff'] == 0.
+
+
+def test_point_dynamics_matches_accel_dynamics():
+    """ The vectorized point model is identical to the loop, also with
+        limits beyond the end of the profile, missing limits and limits
+        dropping before a stop.
+        """
+    rng = np.random.default_rng(0)
+    profile = accel.AccelerationProfile.compile(_simple_a_prof())
+    limits = [0., 4.47, 8.94, 11.18, 15.65, profile.velocity[-1] + 3]
+
+    for num_stops in (0, 5, 40):
+        is_stop = np.zeros(1500, dtype=bool)
+        is_stop[rng.choice(1500, num_stops, replace=False)] = True
+        route_df = pd.DataFrame({
+            'is_stop': is_stop,
+            'is_bus_stop': is_stop,
+            'is_signal': np.zeros(1500, dtype=bool),
+            'speed_limit': np.repeat(rng.choice(limits, 50), 30),
+            })
+
+        expected = accel.accel_dynamics(route_df, profile, 0.4, -1.5)
+        result = accel.point_dynamics(route_df, profile, 0.4, -1.5)
+
+        names = ('a', 'v', 'x_ls', 'x_ns', 'delta_times')
+        for name, value, loop_value in zip(names, result, expected):
+            assert np.array_equal(value, loop_value), name
+
+
+def _simple_a_prof():
+    return pd.DataFrame({
+        'time (s)': np.arange(30, dtype=float),
+        'accel. (g)': np.linspace(0.12, 0.03, 30),
+        })
+
+
+def test_acceleration_profile_is_cached_and_read_only():
+    """ Identical profile contents compile to one shared instance whose
+        arrays can not be modified, and the input is left untouched.
+        """
+    a_prof = _simple_a_prof()
+    original = a_prof.copy()
+
+    profile = accel.AccelerationProfile.compile(a_prof)
+
+    assert profile is accel.AccelerationProfile.compile(a_prof.copy())
+    assert profile is accel.AccelerationProfile.compile(profile)
+    pd.testing.assert_frame_equal(a_prof, original)
+
+    with pytest.raises(ValueError):
+        profile.velocity[0] = 1.
+
+
+def test_acceleration_profile_interpolates_grid():
+    profile = accel.AccelerationProfile.compile(_simple_a_prof())
+
+    assert profile.distance[0] == 0. and profile.velocity[0] == 0.
+    assert np.all(np.diff(profile.velocity) > 0), "bus should speed up"
+    assert profile.length == profile.distance[-1]
+
+    mid = (profile.distance[3] + profile.distance[4]) / 2
+    assert np.isclose(
+        profile.velocity_at(mid),
+        (profile.velocity[3] + profile.velocity[4]) / 2
+        )
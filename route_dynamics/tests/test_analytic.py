@@ -0,0 +1,140 @@
+""" Tests for the closed-form segment model, on route 153 from 'data/'
+    """
+from ..route_energy import longi_dynam_model as ldm
+from ..route_energy import analytic
+from ..route_elevation import base_df
+
+import numpy as np
+import pandas as pd
+import pytest
+from os import path
+
+data_dir = path.join(path.dirname(__file__), '..', '..', 'data')
+shp_filename = path.join(data_dir, 'rt153_pts2.shp')
+a_prof = pd.read_csv(
+    path.join(data_dir, 'acceleration.csv'),
+    names=['time (s)', 'accel. (g)']
+    )
+
+# A stop every 40 route points, a signal and no passengers
+route_points = base_df.wrapper(shp_filename, 6, 6).geometry.values
+route_args = dict(
+    stop_coords=[(pt.x, pt.y) for pt in route_points[10::40]],
+    signal_coords=[(-122.2300, 47.3840)],
+    mass_array=[],
+    aux=7000
+    )
+
+
+@pytest.mark.parametrize('extra_args', [
+    {},
+    {'stop_pattern': (1, 1), 'snap_distance': 200.},
+    ])
+def test_analytic_summary_close_to_point_model(extra_args):
+    # A cap the point model never reaches
+    trajectory = ldm.RouteTrajectory(
+        153, shp_filename, a_prof,
+        charging_power_max=1e9, **route_args, **extra_args
+        )
+    solved = analytic.AnalyticRouteTrajectory(
+        153, shp_filename, a_prof, **route_args, **extra_args
+        )
+
+    expected = trajectory.summary()
+    summary = solved.summary()
+    assert np.isclose(
+        summary['energy_kwh'], expected['energy_kwh'], rtol=0.02
+        )
+    assert np.isclose(
+        summary['time_on_route_s'], expected['time_on_route_s'], rtol=0.01
+        )
+    assert np.isclose(summary['peak_power_w'], expected['peak_power_w'])
+
+    phases = solved.phases()
+    num_segments = len(solved.route_state.stop_idx) + 1
+    assert len(phases) == 3*num_segments
+    assert np.all(phases.length_m >= 0)
+    assert np.allclose(
+        phases.groupby('segment').length_m.sum(),
+        np.diff(np.union1d(
+            [0, len(solved.route_state) - 1], solved.route_state.stop_idx
+            )) * analytic.ca.POINT_SPACING
+        )
+    # Braking recovers energy, accelerating costs it
+    assert np.all(phases[phases.phase == 'accelerate'].work_j >= 0)
+    assert np.all(phases[phases.phase == 'brake'].work_j <= 0)
+
+
+@pytest.mark.parametrize('extra_args', [
+    {},
+    {'stop_pattern': (1, 1), 'snap_distance': 200.},
+    ])
+def test_power_cap_matches_point_model(extra_args):
+    args = dict(route_args, charging_power_max=120000, **extra_args)
+    trajectory = ldm.RouteTrajectory(153, shp_filename, a_prof, **args)
+    solved = analytic.AnalyticRouteTrajectory(
+        153, shp_filename, a_prof, **args
+        )
+
+    expected = trajectory.summary()
+    summary = solved.summary()
+    for name in expected:
+        assert np.isclose(summary[name], expected[name], rtol=1e-9), name
+
+    # The cap binds: capped energy is below the uncapped energy
+    uncapped = analytic.AnalyticRouteTrajectory(
+        153, shp_filename, a_prof, **dict(args, charging_power_max=None)
+        )
+    assert summary['energy_kwh'] < uncapped.summary()['energy_kwh']
+
+
+def test_point_columns_on_request():
+    solved = analytic.AnalyticRouteTrajectory(
+        153, shp_filename, a_prof, **route_args
+        )
+    columns = solved.point_columns()
+
+    a, v, _, _, delta_times = analytic.ca.accel_dynamics(
+        solved.route_state, a_prof, solved.a_pos, solved.a_neg
+        )
+    assert np.array_equal(columns['acceleration'], a)
+    assert np.array_equal(columns['velocity'], v)
+    assert np.array_equal(columns['delta_times'], delta_times)
+    assert np.isclose(
+        np.sum(columns['delta_times'][1:]),
+        solved.summary()['time_on_route_s'],
+        rtol=0.01
+        )
+
+
+def test_no_dwell_at_first_point():
+    # As in the point model, a stop at the first point adds no dwell
+    # time
+    args = dict(route_args, stop_pattern=(1, 1), charging_power_max=None)
+    first_stop = dict(args, stop_coords=(
+        [(route_points[0].x, route_points[0].y)] + args['stop_coords']
+        ))
+
+    changes = []
+    for model, extra_args in [
+        (analytic.AnalyticRouteTrajectory, {}),
+        (ldm.RouteTrajectory, {'charging_power_max': 1e9}),
+        ]:
+        summaries = [
+            model(
+                153, shp_filename, a_prof, **dict(kwargs, **extra_args)
+                ).summary()
+            for kwargs in (args, first_stop)
+            ]
+        changes.append({
+            name: summaries[1][name] - summaries[0][name]
+            for name in summaries[0]
+            })
+
+    solved, expected = changes
+    assert np.isclose(
+        solved['time_on_route_s'], expected['time_on_route_s'], atol=0.01
+        )
+    assert np.isclose(
+        solved['energy_kwh'], expected['energy_kwh'], atol=1e-4
+        )
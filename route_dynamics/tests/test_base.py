@@ -48,6 +48,15 @@ def test_distance_measure():
     return
 
 
+def test_distance_measure_matches_geopy():
+    """Test that the vectorized geodesic distances agree with geopy to a millimetre"""
+    distance, cum_distance = base.distance_measure(route_shp)
+    geopy_distance, geopy_cum_distance = base.distance_measure(route_shp, method='geopy')
+    assert np.allclose(distance, geopy_distance, rtol=0, atol=1e-3), 'pyproj and geopy distances differ by more than 1 mm'
+    assert abs(cum_distance[-1] - geopy_cum_distance[-1]) < 1e-3, 'total route length differs by more than 1 mm'
+    return
+
+
 # def test_gradient():
 #     """Test if the elevation data convert to meter metric and gradient data have the right length."""
 #     elevation_meters, route_gradient, route_cum_distance, route_distance = base.gradient(route_shp, rasterfile)
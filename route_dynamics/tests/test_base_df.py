@@ -0,0 +1,70 @@
+""" Tests for route_elevation.base_df on route 153 from 'data/' """
+from ..route_elevation import base_df
+
+import os
+import shutil
+from os import path
+
+import numpy as np
+import geopandas as gpd
+
+data_dir = path.join(path.dirname(__file__), '..', '..', 'data')
+route_shp = path.join(data_dir, 'rt153_pts2')
+
+
+def test_wrapper_cache(tmp_path):
+    """ Cached results match a fresh build and are invalidated when
+        the shapefile changes.
+        """
+    # Work on a copy so its modification time can be changed
+    for ext in ['.shp', '.shx', '.dbf', '.prj']:
+        shutil.copy(route_shp + ext, str(tmp_path / ('route' + ext)))
+    shapefile = str(tmp_path / 'route.shp')
+    cache_dir = str(tmp_path / 'cache')
+
+    fresh = base_df.wrapper(shapefile, 6, 6)
+    first = base_df.wrapper(shapefile, 6, 6, cache_dir=cache_dir)
+    cached = base_df.wrapper(shapefile, 6, 6, cache_dir=cache_dir)
+
+    assert len(os.listdir(cache_dir)) == 1
+    assert cached.equals(fresh) and first.equals(fresh)
+    assert cached.crs == fresh.crs
+
+    # Other settings get their own entry, an edited shapefile replaces
+    # its entry
+    base_df.wrapper(shapefile, 6, 3, cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 2
+
+    stat = os.stat(shapefile)
+    os.utime(shapefile, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    base_df.wrapper(shapefile, 6, 6, cache_dir=cache_dir)
+
+    assert len(os.listdir(cache_dir)) == 2
+
+
+def test_wrapper_cache_tracks_dbf(tmp_path):
+    """ Elevations and speed limits come from the .dbf, so editing it
+        invalidates the cached arrays.
+        """
+    for ext in ['.shp', '.shx', '.dbf', '.prj']:
+        shutil.copy(route_shp + ext, str(tmp_path / ('route' + ext)))
+    shapefile = str(tmp_path / 'route.shp')
+    cache_dir = str(tmp_path / 'cache')
+
+    before = base_df.wrapper(shapefile, 6, 6, cache_dir=cache_dir)
+
+    # Replace only the .dbf
+    route = gpd.read_file(shapefile)
+    route['SPEED_LIM'] = route['SPEED_LIM'] + 10
+    (tmp_path / 'edited').mkdir()
+    route.to_file(str(tmp_path / 'edited' / 'route.shp'))
+    shutil.copy(
+        str(tmp_path / 'edited' / 'route.dbf'), str(tmp_path / 'route.dbf')
+        )
+
+    after = base_df.wrapper(shapefile, 6, 6, cache_dir=cache_dir)
+
+    assert np.allclose(
+        after['speed_limit'], before['speed_limit'] + 10/2.237
+        )
+    assert len(os.listdir(cache_dir)) == 1
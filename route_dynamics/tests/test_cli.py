@@ -0,0 +1,64 @@
+""" Tests for the 'route-dynamics' command, on route 153 from 'data/' """
+from .. import cli
+
+import pandas as pd
+import pytest
+from os import path
+
+data_dir = path.join(path.dirname(__file__), '..', '..', 'data')
+shp_filename = path.join(data_dir, 'rt153_pts2.shp')
+
+
+def test_cli_writes_rows_and_reports_failures(tmpdir, capsys):
+    broken = tmpdir.join('rt1_pts2.shp')
+    broken.write('not a shapefile')
+    output = str(tmpdir.join('results.csv'))
+
+    status = cli.main([
+        shp_filename, str(broken),
+        '-o', output,
+        '-j', '1',
+        '--params', '[{}, {"aux": 0}, {"aux": 0, "a_neg": -1.0}]',
+        ])
+
+    assert status == cli.EXIT_FAILURES
+    results = pd.read_csv(output)
+    assert sorted(results.route_num) == [1, 1, 1, 153, 153, 153]
+    assert results.error.notnull().sum() == 3
+    route_153 = results[results.route_num == 153].sort_values('param_set')
+    assert list(route_153.aux) == [7000, 0, 0]
+    assert route_153.energy_kwh.iloc[1] < route_153.energy_kwh.iloc[0]
+    # A parameter only the last set gives has a column too
+    assert list(route_153.a_neg.isnull()) == [True, True, False]
+    assert '3 failed' in capsys.readouterr().err
+
+
+def test_cli_parquet_and_usage_errors(tmpdir):
+    output = str(tmpdir.join('results.parquet'))
+
+    status = cli.main([
+        path.join(data_dir, 'rt15[3]_pts2.shp'),
+        '-o', output,
+        '-j', '1',
+        '--flush-every', '1',
+        '-q',
+        ])
+
+    assert status == cli.EXIT_OK
+    results = pd.read_parquet(output)
+    assert list(results.route_num) == ['153']
+    assert results.error.isnull().all()
+
+    for argv in [
+        [str(tmpdir.join('missing.shp')), '-o', output],
+        [shp_filename, '-o', 'results.txt'],
+        [shp_filename, '-o', output, '--stops', str(tmpdir.join('no.shp'))],
+        [
+            shp_filename, '-o', output,
+            '--ridership-period', 'AM',
+            '--params', '{"unloaded_bus_mass": 15000}',
+            ],
+        ]:
+        with pytest.raises(SystemExit) as exit_info:
+            cli.main(argv)
+        assert exit_info.value.code == cli.EXIT_USAGE
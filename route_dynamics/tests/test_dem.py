@@ -0,0 +1,91 @@
+""" Tests for route_elevation.dem against rasterstats on a small
+    synthetic raster.
+    """
+from ..route_elevation import dem
+
+import numpy as np
+import geopandas as gpd
+import rasterio
+import rasterstats
+from rasterio.transform import from_origin
+from shapely.geometry import LineString
+
+
+def _write_raster(filename):
+    """ 64x48 tiled float raster with a nodata patch """
+    rng = np.random.default_rng(0)
+    elevation = rng.uniform(0, 100, (64, 48)).astype('float32')
+    elevation[29:32, 20:25] = -9999.
+
+    with rasterio.open(
+        filename, 'w', driver='GTiff', height=64, width=48, count=1,
+        dtype='float32', crs='EPSG:4326', nodata=-9999.,
+        transform=from_origin(-122.5, 47.7, 0.01, 0.01),
+        tiled=True, blockxsize=16, blockysize=16,
+        ) as dst:
+        dst.write(elevation, 1)
+
+
+def _route():
+    """ Route crossing the nodata patch and leaving the raster """
+    rng = np.random.default_rng(1)
+    x = np.linspace(-122.52, -122.0, 300) + rng.normal(0, 0.002, 300)
+    y = np.linspace(47.71, 47.05, 300) + rng.normal(0, 0.002, 300)
+    return gpd.GeoDataFrame(
+        geometry=[LineString(np.column_stack([x, y]))], crs='EPSG:4326'
+        )
+
+
+def test_point_query_matches_rasterstats(tmp_path):
+    rasterfile = str(tmp_path / 'dem.tif')
+    _write_raster(rasterfile)
+    route_shp = _route()
+
+    for interpolate in ['bilinear', 'nearest']:
+        expected = rasterstats.point_query(
+            route_shp, rasterfile, interpolate=interpolate
+            )[0]
+        expected = np.array(
+            [np.nan if v is None else v for v in expected], dtype=float
+            )
+
+        values = dem.point_query(route_shp, rasterfile, interpolate)[0]
+
+        assert np.isnan(expected).any(), "route should leave the raster"
+        assert np.allclose(values, expected, equal_nan=True, rtol=0, atol=1e-9)
+
+
+def test_sampler_reuses_blocks(tmp_path):
+    rasterfile = str(tmp_path / 'dem.tif')
+    _write_raster(rasterfile)
+    x = np.full(20, -122.3)
+    y = np.linspace(47.6, 47.5, 20)
+
+    with dem.RasterSampler(rasterfile) as sampler:
+        first = sampler.sample(x, y)
+        reads = sampler.block_reads
+        second = sampler.sample(x, y)
+
+        # 20 points within one block column only touch a couple of
+        # the 12 blocks, and a second pass reads nothing
+        assert 0 < reads < 12
+        assert sampler.block_reads == reads
+        assert np.array_equal(first, second)
+
+
+def test_open_sampler_reopens_rewritten_raster(tmp_path):
+    rasterfile = str(tmp_path / 'dem.tif')
+    _write_raster(rasterfile)
+    x = np.full(5, -122.3)
+    y = np.linspace(47.6, 47.5, 5)
+
+    sampler = dem.open_sampler(rasterfile)
+    before = sampler.sample(x, y)
+    assert dem.open_sampler(rasterfile) is sampler
+
+    # Same size, new values
+    with rasterio.open(rasterfile, 'r+') as dst:
+        dst.write(dst.read(1) + 1000, 1)
+
+    after = dem.open_sampler(rasterfile).sample(x, y)
+    assert np.allclose(after, before + 1000)
@@ -0,0 +1,87 @@
+""" Tests for the parallel fleet runner, on route 153 from 'data/' """
+from ..route_energy import fleet
+
+import numpy as np
+import pandas as pd
+import os
+from os import path
+
+data_dir = path.join(path.dirname(__file__), '..', '..', 'data')
+a_prof = pd.read_csv(
+    path.join(data_dir, 'acceleration.csv'),
+    names=['time (s)', 'accel. (g)']
+    )
+
+# Stops near a few points along route 153
+stop_coords = {153: [(-122.2330, 47.3850), (-122.2240, 47.3810)]}
+param_sets = [
+    {'charging_power_max': 160000, 'aux': 7000},
+    {'charging_power_max': 160000, 'aux': 0},
+    ]
+
+
+def test_run_fleet_isolates_errors_and_keeps_order():
+    """ A missing route fails on its own, results come back in input
+        order for any number of workers.
+        """
+    serial = fleet.run_fleet(
+        [999, 153],
+        a_prof,
+        stop_coords=stop_coords,
+        param_sets=param_sets,
+        data_dir=data_dir,
+        max_workers=1
+        )
+
+    assert list(serial.route_num) == [999, 999, 153, 153]
+    assert list(serial.param_set) == [0, 1, 0, 1]
+    assert serial.error[:2].notnull().all()
+    assert serial.error[2:].isnull().all()
+    assert list(serial.aux) == [7000, 0, 7000, 0]
+
+    route_153 = serial[serial.route_num == 153]
+    assert np.all(route_153.time_on_route_s > 0)
+    assert route_153.energy_kwh.iloc[1] < route_153.energy_kwh.iloc[0], (
+        "auxiliary load should cost energy"
+        )
+
+    parallel = fleet.run_fleet(
+        [999, 153],
+        a_prof,
+        stop_coords=stop_coords,
+        param_sets=param_sets,
+        data_dir=data_dir,
+        max_workers=2
+        )
+
+    pd.testing.assert_frame_equal(
+        parallel.drop(columns='error'), serial.drop(columns='error')
+        )
+
+
+class _CrashWorker():
+    """ Kills the process that unpickles it, like a segfault would """
+
+    def __reduce__(self):
+        return (os._exit, (1,))
+
+
+def test_run_fleet_survives_crashed_worker():
+    """ Only the task that kills its worker fails, the pool is rebuilt
+        for the others.
+        """
+    shp_filename = path.join(data_dir, 'rt153_pts2.shp')
+    results = fleet.run_fleet(
+        [1, 2, 3],
+        a_prof,
+        stop_coords=lambda route_num: stop_coords[153],
+        mass_arrays={2: _CrashWorker()},
+        param_sets=param_sets[:1],
+        shapefiles=lambda route_num: shp_filename,
+        max_workers=2
+        )
+
+    assert list(results.route_num) == [1, 2, 3]
+    assert 'BrokenProcessPool' in results.error[1]
+    assert results.error[[0, 2]].isnull().all()
+    assert results.energy_kwh[0] == results.energy_kwh[2]
@@ -5,6 +5,8 @@ from ..route_energy import knn
 
 import numpy as np
 import pandas as pd
+import pyproj
+from shapely.geometry import Point
 # from sklearn import model_selection
 
 def test_find_knn():
@@ -51,6 +53,63 @@ def test_find_knn():
 
 
 
+def test_find_knn_batch_and_cutoff():
+    """ Nearest route points to several stops at once, with a stop too
+        far from the route to be snapped.
+        """
+    route_pts = [Point(0, y) for y in range(10)]
+    stops = [(0.4, 6.1), (-0.2, 1.8), (50., 50.)]
+
+    nn_indicies, nn = knn.find_knn(2, route_pts, stops, max_distance=1.)
+
+    assert nn_indicies.shape == (3, 2)
+    assert list(nn_indicies[0]) == [6, 7]
+    assert list(nn_indicies[1]) == [2, 1]
+    assert nn[0, 0] is route_pts[6]
+    assert list(nn_indicies[2]) == [-1, -1] and nn[2, 0] is None
+
+
+def test_snap_to_route():
+    """ Stops projected onto the route line between route points, with
+        a stop too far from the route to be snapped.
+        """
+    # An L shaped route: up the y axis, then along y = 4
+    route_pts = [Point(0, y) for y in range(5)] + [Point(x, 4) for x in (1, 2)]
+    stops = [Point(0.3, 2.25), (1.5, 4.2), (-1., -1.), (50., 50.)]
+
+    positions, distances = knn.snap_to_route(route_pts, stops, max_distance=2.)
+
+    assert np.allclose(positions[:3], [2.25, 5.5, 0.])
+    assert np.allclose(distances[:3], [0.3, 0.2, np.sqrt(2)])
+    assert np.isnan(positions[3]) and np.isnan(distances[3])
+
+    # Without a cutoff every stop is snapped
+    positions, _ = knn.snap_to_route(route_pts, stops)
+    assert positions[3] == 6.
+
+
+def test_snap_to_route_in_metres():
+    """ Geographic coordinates are snapped in metres """
+    # A route north along a meridian, and a stop 0.001 degrees east of
+    # it, about 75 m at this latitude
+    route_pts = [Point(-122.3, 47.6 + 0.001*i) for i in range(5)]
+    stop = [(-122.299, 47.602)]
+    expected = pyproj.Geod(ellps='WGS84').inv(
+        -122.3, 47.602, -122.299, 47.602
+        )[2]
+
+    positions, distances = knn.snap_to_route(
+        route_pts, stop, max_distance=100., crs='EPSG:4326'
+        )
+    assert np.allclose(positions, [2.])
+    assert np.allclose(distances, [expected], rtol=1e-3)
+
+    positions, _ = knn.snap_to_route(
+        route_pts, stop, max_distance=50., crs='EPSG:4326'
+        )
+    assert np.isnan(positions[0])
+
+
 def test_euclidean_distance():
     """ A function that returns the Euclidean distance between a row in the
         intput data to be classified.
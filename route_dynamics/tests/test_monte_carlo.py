@@ -0,0 +1,62 @@
+""" Tests for the Monte Carlo ridership engine, on route 153 from
+    'data/'
+    """
+from ..route_energy import longi_dynam_model as ldm
+from ..route_energy import monte_carlo
+
+import numpy as np
+import pandas as pd
+import pytest
+from os import path
+
+data_dir = path.join(path.dirname(__file__), '..', '..', 'data')
+a_prof = pd.read_csv(
+    path.join(data_dir, 'acceleration.csv'),
+    names=['time (s)', 'accel. (g)']
+    )
+
+
+@pytest.fixture(scope='module')
+def trajectory():
+    return ldm.RouteTrajectory(
+        153,
+        path.join(data_dir, 'rt153_pts2.shp'),
+        a_prof,
+        stop_coords=[(-122.2330, 47.3850), (-122.2240, 47.3810)],
+        signal_coords=[],
+        mass_array=[],
+        charging_power_max=160000,
+        aux=7000
+        )
+
+
+def test_samples_are_reproducible_across_workers(trajectory):
+    kwargs = dict(num_samples=30, seed=4, batch_size=8)
+
+    serial = monte_carlo.sample_energy(
+        trajectory, [20.], [5], max_workers=1, **kwargs
+        )
+    parallel = monte_carlo.sample_energy(
+        trajectory, [20.], [5], max_workers=2, **kwargs
+        )
+
+    assert len(serial) == 30
+    pd.testing.assert_frame_equal(serial, parallel)
+    assert serial.energy_kwh.nunique() > 1
+
+
+def test_percentiles(trajectory):
+    summary = monte_carlo.run_monte_carlo(
+        trajectory, [20.], [5], num_samples=40, seed=1, max_workers=1
+        )
+
+    assert list(summary.index) == [5, 25, 50, 75, 95]
+    assert summary.energy_kwh.is_monotonic_increasing
+
+    # An empty bus uses the energy of the trajectory without riders
+    empty = monte_carlo.run_monte_carlo(
+        trajectory, [0.], [5], num_samples=10, seed=1, max_workers=1
+        )
+    energy, _ = trajectory.energy_from_route()
+    assert np.allclose(empty.energy_kwh, energy)
+    assert np.all(empty.energy_kwh < summary.energy_kwh[5])
@@ -1,8 +1,11 @@
 """ Tests need rasterfile to run, pass locally. Commented out here fore
-    TravisCI
+    TravisCI. The ranking is also tested on a small synthetic raster.
 """
 import matplotlib
 import matplotlib.pyplot as plt
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
 from os import path
 import sys
 sys.path.append(path.abspath('..'))
@@ -13,6 +16,10 @@ from ..route_elevation import multiple_route
 shapefile = '../data/six_routes.shp'
 rasterfile = '../data/seattle_dtm.tif'
 
+six_routes = path.join(
+    path.dirname(__file__), '..', '..', 'data', 'six_routes.shp'
+    )
+
 
 # def test_routes_analysis_ranking():
 #     """
@@ -27,3 +34,43 @@ rasterfile = '../data/seattle_dtm.tif'
 
 
 #     return
+
+
+def _write_raster(filename):
+    """ Synthetic elevation raster covering the six routes """
+    rng = np.random.default_rng(0)
+    elevation = np.cumsum(rng.normal(0, 1, (200, 200)), axis=0) + 100
+
+    with rasterio.open(
+        filename, 'w', driver='GTiff', height=200, width=200, count=1,
+        dtype='float32', crs='EPSG:4326',
+        transform=from_origin(-122.43, 47.73, 0.001, 0.0012),
+        ) as dst:
+        dst.write(elevation.astype('float32'), 1)
+
+
+def test_routes_metrics_match_route_by_route(tmp_path):
+    """
+       Ranking without a plot gives the metrics of each route computed
+       on its own, in the order asked for
+    """
+    dem_file = str(tmp_path / 'dem.tif')
+    _write_raster(dem_file)
+    route_list = [45, 7, 40]
+
+    data = multiple_route.routes_analysis_ranking(
+        route_list, six_routes, dem_file, plot=False, max_workers=1
+        )
+
+    assert list(data['Bus Num']) == route_list
+    for row, route_num in zip(data.itertuples(), route_list):
+        route_shp = base.read_shape(six_routes, route_num)
+        _, expected = base.route_metrics(
+            *base.gradient(route_shp, dem_file), route_num
+            )
+        assert (row.M1, row.M2, row.M3, row.M4) == expected
+
+    parallel = multiple_route.routes_metrics(
+        route_list, six_routes, dem_file, max_workers=2
+        )
+    assert parallel.equals(data)
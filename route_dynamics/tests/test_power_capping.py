@@ -0,0 +1,161 @@
+""" Test the vectorized traction power cap in RouteTrajectory against
+    a point by point reference.
+    """
+from ..route_energy import longi_dynam_model as ldm
+from ..route_energy import accel
+from ..route_energy.route_state import RouteState
+
+import numpy as np
+import pandas as pd
+
+
+def _bare_trajectory(charging_power_max):
+    """ RouteTrajectory with only the attributes the power stage uses """
+    trajectory = object.__new__(ldm.RouteTrajectory)
+    trajectory.a_neg = -1.5
+    trajectory.charging_power_max = charging_power_max
+    trajectory.aux = 7000
+    return trajectory
+
+
+def _random_route_df(trajectory, num_pts, rng):
+    mass = rng.uniform(12000, 16000, num_pts)
+    acce = rng.normal(0, 0.8, num_pts)
+    vels = np.abs(rng.normal(8, 5, num_pts))
+    acce[0] = vels[0] = 0
+    grad_angle = np.arctan(rng.normal(0, 0.08, num_pts))
+
+    aero_drag, inertia = trajectory.calculate_forces(mass, acce, vels)
+
+    return pd.DataFrame({
+        'mass': mass,
+        'acceleration': acce,
+        'velocity': vels,
+        'delta_times': rng.uniform(0.5, 3, num_pts),
+        'grav_force': mass * 9.81 * np.sin(grad_angle),
+        'roll_fric': 0.01 * mass * 9.81 * np.cos(grad_angle),
+        'aero_drag': aero_drag,
+        'inertia': inertia,
+        })
+
+
+def _reference_cap(trajectory, route_df):
+    """ Point by point traction power cap """
+    df = route_df.copy()
+    cap = trajectory.charging_power_max
+    f_traction = (
+        df.inertia.values
+        + (df.grav_force.values + df.roll_fric.values + df.aero_drag.values)
+        )
+    p_traction = f_traction * df.velocity.values
+    cols = {
+        c: df[c].values.copy()
+        for c in ['acceleration', 'velocity', 'delta_times', 'aero_drag',
+            'inertia']
+        }
+
+    def update(i, acce, vels, delta_t):
+        cols['acceleration'][i] = acce
+        cols['velocity'][i] = vels
+        cols['delta_times'][i] = delta_t
+        cols['aero_drag'][i], cols['inertia'][i] = (
+            trajectory.calculate_forces(df.mass.values[i], acce, vels)
+            )
+        f_traction[i] = cols['inertia'][i] + (
+            df.grav_force.values[i]
+            + df.roll_fric.values[i]
+            + cols['aero_drag'][i]
+            )
+        p_traction[i] = f_traction[i] * vels
+
+    for i in range(len(p_traction)):
+        if p_traction[i] < -cap:
+            p_traction[i] = -cap
+        elif p_traction[i] > cap:
+            update(
+                i, 0, cols['velocity'][i-1], cols['delta_times'][i-1]
+                )
+            if p_traction[i] > cap:
+                vels = np.sqrt(-2*accel.POINT_SPACING*trajectory.a_neg)
+                update(
+                    i, trajectory.a_neg, vels, accel.POINT_SPACING/vels
+                    )
+
+    return (
+        cols['acceleration'],
+        cols['velocity'],
+        cols['delta_times'],
+        cols['aero_drag'],
+        cols['inertia'],
+        f_traction,
+        p_traction,
+        )
+
+
+def test_power_cap_matches_reference():
+    rng = np.random.default_rng(1)
+
+    for _ in range(50):
+        trajectory = _bare_trajectory(rng.uniform(1e4, 2e5))
+        route_df = _random_route_df(trajectory, rng.integers(2, 80), rng)
+
+        expected = _reference_cap(trajectory, route_df)
+        capped = trajectory._cap_traction_power(
+            RouteState.from_dataframe(route_df)
+            )
+
+        for exp, got in zip(expected, capped):
+            assert np.array_equal(exp, got)
+
+
+def test_power_cap_of_scenarios_matches_each_scenario():
+    """ (S, N) masses with shared (N,) kinematics give the rows of
+        capping each scenario on its own.
+        """
+    rng = np.random.default_rng(3)
+    trajectory = _bare_trajectory(9e4)
+    route_df = _random_route_df(trajectory, 60, rng)
+
+    masses = rng.uniform(12000, 20000, (4, 60))
+    scenarios = {name: route_df[name].values for name in route_df}
+    scenarios['mass'] = masses
+    for name in ['grav_force', 'roll_fric']:
+        scenarios[name] = masses * (route_df[name] / route_df.mass).values
+    scenarios['inertia'] = trajectory.calculate_forces(
+        masses, route_df.acceleration.values, route_df.velocity.values
+        )[1]
+
+    capped = trajectory._cap_traction_power(scenarios)
+
+    for i in range(len(masses)):
+        scenario = pd.DataFrame({
+            name: values if np.ndim(values) == 1 else values[i]
+            for name, values in scenarios.items()
+            })
+        expected = trajectory._cap_traction_power(scenario)
+        for exp, got in zip(expected, capped):
+            assert got.shape == masses.shape
+            assert np.array_equal(exp, got[i])
+
+
+def test_batt_power_regen_split():
+    """ Battery power includes auxiliary load and recovers only part
+        of the traction power when braking.
+        """
+    rng = np.random.default_rng(2)
+    trajectory = _bare_trajectory(1e9)
+    route_df = RouteState.from_dataframe(
+        _random_route_df(trajectory, 40, rng)
+        )
+
+    p_ess = trajectory._calculate_batt_power_exert(route_df)
+    p_traction = trajectory._cap_traction_power(route_df)[-1]
+
+    aux = trajectory.aux / 0.89
+    driving = p_traction >= 0
+    assert np.allclose(
+        p_ess[driving], p_traction[driving]/(0.916*0.971) + aux
+        )
+    assert np.allclose(
+        p_ess[~driving], 0.6*0.916*0.971*p_traction[~driving] + aux
+        )
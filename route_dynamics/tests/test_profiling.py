@@ -0,0 +1,100 @@
+""" Tests for per-stage profiling of RouteTrajectory, on route 153 from
+    'data/'
+    """
+from ..route_energy import longi_dynam_model as ldm
+from ..route_energy import fleet
+from ..route_energy import profiling
+
+import json
+import tracemalloc
+import numpy as np
+import pandas as pd
+from os import path
+
+data_dir = path.join(path.dirname(__file__), '..', '..', 'data')
+shp_filename = path.join(data_dir, 'rt153_pts2.shp')
+a_prof = pd.read_csv(
+    path.join(data_dir, 'acceleration.csv'),
+    names=['time (s)', 'accel. (g)']
+    )
+route_args = dict(
+    stop_coords=[(-122.2330, 47.3850), (-122.2240, 47.3810)],
+    signal_coords=[],
+    mass_array=[15000., 14000.],
+    charging_power_max=160000,
+    aux=7000
+    )
+
+
+def test_profile_records_each_stage():
+    hook_records = []
+    trajectory = ldm.RouteTrajectory(
+        153, shp_filename, a_prof,
+        profile_hook=lambda route_num, record: hook_records.append(
+            (route_num, record)
+            ),
+        **route_args
+        )
+    plain = ldm.RouteTrajectory(153, shp_filename, a_prof, **route_args)
+
+    assert plain.profile is None
+    assert trajectory.summary() == plain.summary()
+
+    stages = [record.stage for record in trajectory.profile]
+    assert stages[0] == 'build_route_coordinate_df'
+    assert stages[-1] == '_add_power_to_df'
+    assert len(stages) == 10
+    assert hook_records == [(153, r) for r in trajectory.profile]
+
+    for record in trajectory.profile:
+        assert record.wall_s >= 0
+        assert record.peak_memory_bytes >= 0
+        assert record.rows == len(trajectory.route_state)
+
+    exported = json.loads(trajectory.profile.to_json())
+    assert exported['route_num'] == 153
+    assert [s['stage'] for s in exported['stages']] == stages
+
+    # A copy records its own reruns
+    changed = trajectory.with_params(aux=0)
+    assert [r.stage for r in changed.profile] == ['_add_power_to_df']
+    assert len(trajectory.profile) == 10
+
+
+def test_run_fleet_aggregates_stage_costs():
+    costs = profiling.StageCosts()
+    results = fleet.run_fleet(
+        [153, 999],
+        a_prof,
+        param_sets=[{'charging_power_max': 160000, 'aux': 7000}],
+        data_dir=data_dir,
+        max_workers=1,
+        profile_hook=costs
+        )
+
+    assert results.error.notnull().tolist() == [False, True]
+
+    table = costs.table()
+    assert table.index[0] == 'build_route_coordinate_df'
+    assert np.all(table.runs == 1)
+    assert np.all(table.routes == 1)
+    assert np.isclose(table.wall_share.sum(), 1)
+
+
+def test_profile_keeps_callers_tracer_peak():
+    """ A tracer started by the caller keeps its peak """
+    tracemalloc.start()
+    try:
+        block = np.ones(10**6)
+        del block
+        _, peak = tracemalloc.get_traced_memory()
+
+        profile = profiling.RouteProfile()
+        profile.run('small', lambda: [0] * 10)
+        profile.run('large', lambda: np.ones(2 * 10**6))
+
+        assert tracemalloc.get_traced_memory()[1] >= peak
+        assert profile.records[0].peak_memory_bytes is None
+        assert profile.records[1].peak_memory_bytes >= 16 * 10**6
+    finally:
+        tracemalloc.stop()
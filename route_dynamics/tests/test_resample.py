@@ -0,0 +1,76 @@
+""" Tests for resampled route simulations, on route 153 from 'data/'
+    """
+from ..route_energy import longi_dynam_model as ldm
+from ..route_elevation import base_df
+
+import numpy as np
+import pandas as pd
+from os import path
+
+data_dir = path.join(path.dirname(__file__), '..', '..', 'data')
+shp_filename = path.join(data_dir, 'rt153_pts2.shp')
+a_prof = pd.read_csv(
+    path.join(data_dir, 'acceleration.csv'),
+    names=['time (s)', 'accel. (g)']
+    )
+
+# A stop every 100 route points, a signal and no passengers
+route_points = base_df.wrapper(shp_filename, 6, 6).geometry.values
+route_args = dict(
+    stop_coords=[(pt.x, pt.y) for pt in route_points[10::100]],
+    signal_coords=[(-122.2300, 47.3840)],
+    mass_array=[],
+    charging_power_max=1e9,
+    aux=7000
+    )
+
+
+def test_resampled_energy_within_tolerance():
+    full = ldm.RouteTrajectory(153, shp_filename, a_prof, **route_args)
+    resampled = ldm.RouteTrajectory(
+        153, shp_filename, a_prof, resample_tolerance=0.01, **route_args
+        )
+
+    report = resampled.resample_report
+    assert full.resample_report is None
+    assert report['num_points'] == len(full.route_state)
+    assert report['num_resampled'] == len(resampled.route_state)
+    assert report['num_resampled'] < report['num_points'] / 5
+
+    # Every point is accounted for, stops are kept
+    state = resampled.route_state
+    assert np.sum(state['steps']) == len(full.route_state)
+    assert len(state.stop_idx) == len(full.route_state.stop_idx)
+
+    # Kept points move as at full resolution
+    kept = np.cumsum(state['steps']).astype(int) - 1
+    assert np.array_equal(
+        state['velocity'], full.route_state['velocity'][kept]
+        )
+
+    energy = resampled.energy_from_route()[0]
+    expected = full.energy_from_route()[0]
+    assert abs(energy - expected) <= 0.01 * abs(expected)
+    assert np.isclose(
+        abs(energy - expected), report['estimated_error_kwh'], rtol=0.5
+        )
+    assert np.isclose(
+        resampled.summary()['time_on_route_s'],
+        full.summary()['time_on_route_s']
+        )
+
+
+def test_resample_tolerance_with_params():
+    resampled = ldm.RouteTrajectory(
+        153, shp_filename, a_prof, resample_tolerance=0.01, **route_args
+        )
+
+    full = resampled.with_params(resample_tolerance=None)
+    assert full.resample_report is None
+    assert len(full.route_state) == resampled.resample_report['num_points']
+
+    again = full.with_params(resample_tolerance=0.01)
+    assert len(again.route_state) == len(resampled.route_state)
+    assert np.isclose(
+        again.energy_from_route()[0], resampled.energy_from_route()[0]
+        )
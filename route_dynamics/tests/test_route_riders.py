@@ -0,0 +1,118 @@
+""" Tests for the ridership store, on small synthetic KCM files """
+from ..route_riders import route_riders as rr
+from ..route_riders import ridership_dataset
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pytest
+from shapely.geometry import Point
+
+
+@pytest.fixture
+def store(tmp_path):
+    zones = pd.DataFrame({
+        'Route': [45, 45, 45, 45, 7, 45, 45],
+        'Dir': ['N', 'N', 'N', 'N', 'S', 'S', 'N'],
+        'Trip_ID': [2, 1, 1, 2, 1, 3, 1],
+        'InOut': ['I', 'I', 'I', 'I', 'O', 'O', 'I'],
+        'STOP_SEQ': [1, 1, 2, 2, 1, 1, 1],
+        'STOP_ID': [10, 10, 11, 11, 20, 12, 10],
+        'Period': ['AM', 'AM', 'AM', 'AM', 'AM', 'AM', 'PM'],
+        'AveOn': 1.,
+        'AveOff': 1.,
+        'AveLd': [9., 5., 6., 8., 1., 3., 4.],
+        'Obs': 1,
+        })
+    zones.to_csv(tmp_path / 'Zon.csv', index=False)
+
+    gpd.GeoDataFrame(
+        {'STOP_ID': [11, 10, 11]},
+        geometry=[Point(1, 1), Point(0, 0), Point(9, 9)],
+        crs='EPSG:4326'
+        ).to_file(tmp_path / 'stops.shp')
+
+    return rr.RidershipStore(
+        trip_csv=tmp_path / 'Trip.csv',
+        zone_csv=tmp_path / 'Zon.csv',
+        stops_shp=tmp_path / 'stops.shp'
+        )
+
+
+def test_route_ridership(store):
+    riders = rr.route_ridership('AM', 45, 12927, store=store)
+
+    # First trip at each stop of each direction, in stop order
+    assert list(riders.InOut) == ['I', 'I', 'O']
+    assert list(riders.STOP_ID) == [10, 11, 12]
+    assert list(riders.AveLd) == [5., 6., 3.]
+    assert np.allclose(riders.Total_Mass, 12927 + 80*riders.AveLd)
+
+    # First listing of each stop, NaN for unknown stops
+    assert riders.geometry[0].equals(Point(0, 0))
+    assert riders.geometry[1].equals(Point(1, 1))
+    assert pd.isnull(riders.geometry[2])
+
+
+def test_zone_rows_by_direction(store):
+    assert list(store.zone_rows(45, 'AM', 'O').STOP_ID) == [12]
+    assert len(store.zone_rows(45, 'AM')) == 5
+    assert len(store.zone_rows(45, 'XNT')) == 0
+
+
+@pytest.mark.parametrize('format', ['parquet', 'feather'])
+def test_dataset_matches_csv(store, tmp_path, format):
+    dataset_dir = tmp_path / 'ridership'
+    for _ in range(2):
+        num_rows = ridership_dataset.convert_ridership(
+            dataset_dir, zone_csvs=[store.zone_csv], format=format
+            )
+    assert num_rows['zones'] == 7
+
+    partitioned = rr.RidershipStore(
+        stops_shp=store.stops_shp, dataset_dir=dataset_dir
+        )
+    assert len(partitioned.zones) == 7, "reconverting duplicated rows"
+
+    expected = rr.route_ridership('AM', 45, 12927, store=store)
+    riders = rr.route_ridership('AM', 45, 12927, store=partitioned)
+    columns = ['InOut', 'STOP_ID', 'AveLd', 'Total_Mass']
+    assert riders[columns].equals(expected[columns].astype(riders[columns].dtypes))
+
+    rows = ridership_dataset.read_table(
+        dataset_dir, route=45, period='AM', in_out='O', columns=['STOP_ID']
+        )
+    assert list(rows.columns) == ['STOP_ID']
+    assert list(rows.STOP_ID) == [12]
+
+
+def test_reconverting_drops_old_partitions(store, tmp_path):
+    dataset_dir = tmp_path / 'ridership'
+    ridership_dataset.convert_ridership(dataset_dir, zone_csvs=[store.zone_csv])
+
+    # Route 7 is gone from the new export
+    zones = pd.read_csv(store.zone_csv)
+    zones[zones.Route != 7].to_csv(tmp_path / 'Zon.csv', index=False)
+    ridership_dataset.convert_ridership(dataset_dir, zone_csvs=[store.zone_csv])
+
+    assert len(ridership_dataset.read_table(dataset_dir, route=7)) == 0
+    assert len(ridership_dataset.read_table(dataset_dir)) == 6
+    assert [p.name for p in tmp_path.iterdir() if p.is_dir()] == [
+        'ridership'
+        ], "temporary directories left behind"
+
+
+def test_same_named_csvs_both_converted(store, tmp_path):
+    # A second export of the same name, from another directory
+    other_dir = tmp_path / 'other'
+    other_dir.mkdir()
+    zones = pd.read_csv(store.zone_csv)
+    zones.to_csv(other_dir / 'Zon.csv', index=False)
+
+    dataset_dir = tmp_path / 'ridership'
+    num_rows = ridership_dataset.convert_ridership(
+        dataset_dir, zone_csvs=[store.zone_csv, other_dir / 'Zon.csv']
+        )
+
+    assert num_rows['zones'] == 2*len(zones)
+    assert len(ridership_dataset.read_table(dataset_dir)) == 2*len(zones)
@@ -0,0 +1,59 @@
+""" Tests for the columnar RouteState container """
+from ..route_energy.route_state import RouteState
+
+import numpy as np
+import geopandas as gpd
+from shapely.geometry import Point
+
+
+def _simple_route_gdf():
+    return gpd.GeoDataFrame(
+        {
+            'distance': np.arange(5) * 10.,
+            'speed_limit': [10, 10, 15, 15, 10],
+            },
+        geometry=[Point(0, y) for y in range(5)],
+        crs='EPSG:4326'
+        )
+
+
+def test_stage_columns_are_filled_in_place():
+    state = RouteState.from_dataframe(_simple_route_gdf())
+
+    state['velocity'] = np.ones(5)
+    velocity = state['velocity']
+    state['velocity'] = np.arange(5)
+
+    assert velocity is state['velocity'], "column buffer was reallocated"
+    assert state['velocity'].dtype == np.float64
+    assert state['speed_limit'].dtype == np.float64
+
+
+def test_stops_are_index_arrays():
+    state = RouteState.from_dataframe(_simple_route_gdf())
+    state.set_stops([3, 1], [4, 1])
+
+    assert list(state.stop_idx) == [1, 3, 4]
+    assert list(state['is_bus_stop']) == [False, True, False, True, False]
+    assert list(state['is_stop']) == [False, True, False, True, True]
+
+
+def test_geodataframe_round_trip():
+    route_gdf = _simple_route_gdf()
+    state = RouteState.from_dataframe(route_gdf)
+    state.set_stops([2], [])
+    state['mass'] = np.full(5, 12927.)
+
+    gdf = state.to_geodataframe()
+
+    assert list(gdf.columns) == [
+        'geometry', 'distance', 'speed_limit', 'is_bus_stop', 'is_signal',
+        'is_stop', 'mass'
+        ]
+    assert gdf.crs == route_gdf.crs
+    assert gdf.geometry.equals(route_gdf.geometry)
+    assert gdf.is_bus_stop.sum() == 1
+
+    round_trip = RouteState.from_dataframe(gdf)
+    assert list(round_trip.bus_stop_idx) == [2]
+    assert np.array_equal(round_trip['mass'], state['mass'])
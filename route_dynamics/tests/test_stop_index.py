@@ -0,0 +1,111 @@
+""" Tests for the saved stop and signal index, on route 153 from 'data/'
+    """
+from ..route_energy import longi_dynam_model as ldm
+from ..route_energy import stop_index
+from ..route_elevation import base_df
+
+import os
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pytest
+from os import path
+from shapely.geometry import Point
+
+data_dir = path.join(path.dirname(__file__), '..', '..', 'data')
+shp_filename = path.join(data_dir, 'rt153_pts2.shp')
+a_prof = pd.read_csv(
+    path.join(data_dir, 'acceleration.csv'),
+    names=['time (s)', 'accel. (g)']
+    )
+
+route_points = base_df.wrapper(shp_filename, 6, 6).geometry.values
+stop_points = list(route_points[10::60]) + [Point(-122.0, 47.0)]
+signal_points = list(route_points[40::300])
+
+
+def write_points(filename, points):
+    gpd.GeoDataFrame(geometry=points, crs='EPSG:4326').to_file(filename)
+    return filename
+
+
+def make_index(tmp_path, stops=stop_points):
+    return stop_index.StopIndex(
+        str(tmp_path / 'index'),
+        stops_shp=write_points(str(tmp_path / 'stops.shp'), stops),
+        signal_shps=[
+            write_points(str(tmp_path / 'signals.shp'), signal_points)
+            ],
+        snap_distance=100
+        )
+
+
+def test_index_saved_and_invalidated(tmp_path):
+    index = make_index(tmp_path)
+    assert index.build([shp_filename]) == 1
+    assert index.build([shp_filename]) == 0
+
+    indexed = make_index(tmp_path).lookup(shp_filename)
+    assert len(indexed['stop_idx']) == len(stop_points) - 1
+    assert len(indexed['signal_idx']) == len(signal_points)
+    assert np.all(np.diff(indexed['stop_idx']) >= 0)
+    assert np.all(np.diff(indexed['stop_offsets']) >= 0)
+
+    # A changed stop file, also only its .dbf, or other settings, need
+    # a new index
+    dbf = path.splitext(index.stops_shp)[0] + '.dbf'
+    stat = os.stat(dbf)
+    os.utime(dbf, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert not make_index(tmp_path).is_current(shp_filename)
+
+    index = make_index(tmp_path)
+    index.snap_distance = 200
+    assert not index.is_current(shp_filename)
+
+
+@pytest.mark.parametrize('stop_pattern', [(1, 1), (3, 3)])
+def test_trajectory_reads_stops_from_index(tmp_path, stop_pattern):
+    # Stops out of route order, with a mass each
+    order = np.random.default_rng(0).permutation(len(stop_points))
+    stops = [stop_points[i] for i in order]
+    masses = 13000. + 100*np.arange(len(stops))
+    route_args = dict(
+        charging_power_max=160000,
+        aux=7000,
+        stop_pattern=stop_pattern
+        )
+
+    snapped = ldm.RouteTrajectory(
+        153, shp_filename, a_prof,
+        stop_coords=stops,
+        signal_coords=signal_points,
+        snap_distance=100,
+        mass_array=masses,
+        **route_args
+        )
+    # The index holds the snapped stops in route order
+    indexed = ldm.RouteTrajectory(
+        153, shp_filename, a_prof,
+        stop_index=make_index(tmp_path, stops),
+        mass_array=masses[snapped.stop_order],
+        **route_args
+        )
+
+    assert np.array_equal(
+        indexed.route_state.stop_idx, snapped.route_state.stop_idx
+        )
+    assert np.array_equal(
+        indexed.route_state['mass'], snapped.route_state['mass']
+        )
+    assert np.isclose(
+        indexed.summary()['energy_kwh'], snapped.summary()['energy_kwh']
+        )
+
+
+def test_index_needs_mass_for_each_stop(tmp_path):
+    with pytest.raises(ldm.IllegalArgumentError):
+        ldm.RouteTrajectory(
+            153, shp_filename, a_prof,
+            stop_index=make_index(tmp_path),
+            mass_array=13000. + np.arange(len(stop_points))
+            )
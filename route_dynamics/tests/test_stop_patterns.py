@@ -0,0 +1,91 @@
+""" Tests for comparing stop patterns, on route 153 from 'data/' """
+from ..route_energy import longi_dynam_model as ldm
+from ..route_elevation import base_df
+
+import numpy as np
+import pandas as pd
+import pytest
+from os import path
+
+data_dir = path.join(path.dirname(__file__), '..', '..', 'data')
+shp_filename = path.join(data_dir, 'rt153_pts2.shp')
+a_prof = pd.read_csv(
+    path.join(data_dir, 'acceleration.csv'),
+    names=['time (s)', 'accel. (g)']
+    )
+
+route_points = base_df.wrapper(shp_filename, 6, 6).geometry.values
+route_args = dict(
+    stop_coords=[(pt.x, pt.y) for pt in route_points[10::60]],
+    signal_coords=[(pt.x, pt.y) for pt in route_points[40::300]],
+    mass_array=[],
+    charging_power_max=160000,
+    aux=7000
+    )
+patterns = {'all': (1, 1), 'every_other': (2, 1), 'no_signals': (1, 0)}
+
+
+def test_stop_patterns_match_single_runs():
+    trajectory = ldm.RouteTrajectory(153, shp_filename, a_prof, **route_args)
+    results = trajectory.stop_patterns(patterns)
+
+    assert list(results.index) == list(patterns)
+    assert results.loc['no_signals', 'signals'] == 0
+    assert (
+        results.loc['every_other', 'bus_stops']
+        == (results.loc['all', 'bus_stops'] + 1) // 2
+        )
+    # Serving more stops takes longer
+    assert (
+        results.loc['all', 'time_on_route_s']
+        > results.loc['every_other', 'time_on_route_s']
+        )
+
+    for name, pattern in patterns.items():
+        expected = ldm.RouteTrajectory(
+            153, shp_filename, a_prof, stop_pattern=pattern, **route_args
+            ).summary()
+        for column, value in expected.items():
+            assert np.isclose(results.loc[name, column], value)
+
+    # The trajectory keeps its own pattern
+    assert trajectory.stop_pattern == (3, 3)
+
+
+def test_stop_pattern_must_not_be_negative():
+    trajectory = ldm.RouteTrajectory(153, shp_filename, a_prof, **route_args)
+    with pytest.raises(ldm.IllegalArgumentError):
+        trajectory.with_params(stop_pattern=(-1, 1))
+
+
+def test_snap_distance_leaves_out_far_points():
+    stop_coords = route_args['stop_coords'] + [(-122.0, 47.0)]
+    mass_array = np.arange(len(stop_coords)) + 13000.
+    trajectory = ldm.RouteTrajectory(
+        153, shp_filename, a_prof,
+        stop_pattern=(1, 1),
+        snap_distance=100,
+        **dict(
+            route_args,
+            stop_coords=stop_coords,
+            signal_coords=route_args['signal_coords'] + [(-122.0, 47.0)],
+            mass_array=mass_array
+            )
+        )
+
+    assert np.all(trajectory.stop_snapped[:-1])
+    assert not trajectory.stop_snapped[-1]
+    assert np.isnan(trajectory.stop_offsets[-1])
+    assert np.isnan(trajectory.signal_offsets[-1])
+    assert len(trajectory.route_state.signal_idx) == len(
+        route_args['signal_coords']
+        )
+
+    # Offsets of stops on route points are the route distance there
+    distance = trajectory.route_state['distance']
+    assert np.allclose(
+        trajectory.stop_offsets[:-1],
+        distance[trajectory.stop_nn_indicies.ravel()]
+        )
+    # The last snapped stop sets the mass until the route end
+    assert trajectory.route_state['mass'][-2] == mass_array[-2]
@@ -0,0 +1,158 @@
+""" Tests for stop-to-stop streaming of RouteTrajectory, on route 153
+    from 'data/'
+    """
+from ..route_energy import longi_dynam_model as ldm
+from ..route_energy import streaming
+from ..route_energy import fleet
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pytest
+from os import path
+
+data_dir = path.join(path.dirname(__file__), '..', '..', 'data')
+a_prof = pd.read_csv(
+    path.join(data_dir, 'acceleration.csv'),
+    names=['time (s)', 'accel. (g)']
+    )
+
+route_args = dict(
+    stop_coords=[
+        (-122.2330, 47.3850), (-122.2280, 47.3830), (-122.2240, 47.3810)
+        ],
+    signal_coords=[(-122.2300, 47.3840)],
+    mass_array=[15000., 14000., 16000.],
+    charging_power_max=120000,
+    aux=7000
+    )
+
+
+@pytest.mark.parametrize('extra_args', [
+    {},
+    {
+        'stop_pattern': (1, 1),
+        'snap_distance': 200.,
+        'resample_tolerance': 0.01
+        },
+    ])
+def test_segments_match_whole_route(extra_args):
+    shp_filename = path.join(data_dir, 'rt153_pts2.shp')
+    trajectory = ldm.RouteTrajectory(
+        153, shp_filename, a_prof, **route_args, **extra_args
+        )
+    streamed = streaming.StreamingRouteTrajectory(
+        153, shp_filename, a_prof, **route_args, **extra_args
+        )
+
+    # No whole-route stage columns
+    assert not any(
+        name in streamed.route_state for name in ldm.RouteState.COLUMNS
+        )
+
+    segments = list(streamed.segments())
+
+    assert len(segments) > 1
+    assert segments[0].start == 0
+    assert segments[-1].end == len(trajectory.route_state)
+    for name in trajectory.route_state.COLUMNS:
+        assert np.array_equal(
+            np.concatenate([s.columns[name] for s in segments]),
+            trajectory.route_state[name]
+            ), name
+
+    _, time_on_route = trajectory.energy_from_route()
+    assert np.array_equal(
+        np.concatenate([s.columns['time_on_route'] for s in segments]),
+        time_on_route
+        )
+
+    expected = trajectory.summary()
+    summary = streamed.summary()
+    assert np.isclose(summary.pop('energy_kwh'), expected.pop('energy_kwh'))
+    assert summary == expected
+
+
+def test_segment_cache_reuses_segments():
+    cache = streaming.SegmentCache()
+
+    results = fleet.run_fleet(
+        [153, 153],
+        a_prof,
+        stop_coords={153: route_args['stop_coords']},
+        param_sets=[{'charging_power_max': 120000, 'aux': 7000}],
+        data_dir=data_dir,
+        segment_cache=cache
+        )
+
+    # The second run of the route only hits
+    num_segments = len(cache)
+    assert cache.stats['misses'] == num_segments
+    assert cache.stats['hits'] == num_segments
+    assert results.energy_kwh[0] == results.energy_kwh[1]
+
+    uncached = fleet.run_fleet(
+        [153],
+        a_prof,
+        stop_coords={153: route_args['stop_coords']},
+        param_sets=[{'charging_power_max': 120000, 'aux': 7000}],
+        data_dir=data_dir,
+        max_workers=1
+        )
+    assert np.isclose(results.energy_kwh[0], uncached.energy_kwh[0])
+
+
+def test_segment_cache_shares_corridor(tmp_path):
+    """ Two routes along the same road, one starting later, reuse the
+        segments between their shared stops.
+        """
+    route = gpd.read_file(path.join(data_dir, 'rt153_pts2.shp'))
+    route.iloc[:4800].to_file(str(tmp_path / 'rt1_pts2.shp'))
+    route.iloc[600:4800].to_file(str(tmp_path / 'rt2_pts2.shp'))
+
+    stop_points = route.geometry.values[[1500, 2700, 3300, 4200]]
+    stop_coords = [(p.x, p.y) for p in stop_points]
+
+    args = dict(
+        stop_coords={1: stop_coords, 2: stop_coords},
+        param_sets=[{
+            'charging_power_max': 120000,
+            'aux': 7000,
+            'stop_pattern': (1, 1)
+            }],
+        data_dir=str(tmp_path),
+        )
+
+    cache = streaming.SegmentCache()
+    results = fleet.run_fleet([1, 2], a_prof, segment_cache=cache, **args)
+
+    # Segments from the second stop on, where both routes enter at the
+    # same speed, to the shared route end
+    assert cache.stats['hits'] == 3
+
+    uncached = fleet.run_fleet([1, 2], a_prof, max_workers=1, **args)
+    assert np.allclose(results.energy_kwh, uncached.energy_kwh)
+
+
+def test_segment_cache_misses_other_grade():
+    """ Segments on the same points with another grade are simulated
+        again.
+        """
+    cache = streaming.SegmentCache()
+    shp_filename = path.join(data_dir, 'rt153_pts2.shp')
+
+    flat = streaming.StreamingRouteTrajectory(
+        153, shp_filename, a_prof, segment_cache=cache, **route_args
+        )
+    expected = flat.summary()
+    num_segments = cache.stats['misses']
+
+    steep = streaming.StreamingRouteTrajectory(
+        153, shp_filename, a_prof, segment_cache=cache, **route_args
+        )
+    steep.route_state['grade'] = steep.route_state['grade'] + 0.01
+    summary = steep.summary()
+
+    assert cache.stats['hits'] == 0
+    assert cache.stats['misses'] == 2*num_segments
+    assert summary['energy_kwh'] > expected['energy_kwh']
@@ -0,0 +1,98 @@
+""" Tests for incremental parameter changes on RouteTrajectory, on
+    route 153 from 'data/'
+    """
+from ..route_energy import longi_dynam_model as ldm
+
+import numpy as np
+import pandas as pd
+import pytest
+from os import path
+
+data_dir = path.join(path.dirname(__file__), '..', '..', 'data')
+shp_filename = path.join(data_dir, 'rt153_pts2.shp')
+a_prof = pd.read_csv(
+    path.join(data_dir, 'acceleration.csv'),
+    names=['time (s)', 'accel. (g)']
+    )
+
+base_args = {
+    'stop_coords': [(-122.2330, 47.3850), (-122.2240, 47.3810)],
+    'signal_coords': [],
+    'mass_array': [13500.],
+    'charging_power_max': 160000,
+    'aux': 7000,
+    }
+
+
+@pytest.fixture(scope='module')
+def trajectory():
+    return ldm.RouteTrajectory(153, shp_filename, a_prof, **base_args)
+
+
+@pytest.fixture(scope='module')
+def resampled():
+    return ldm.RouteTrajectory(
+        153, shp_filename, a_prof, resample_tolerance=0.01, **base_args
+        )
+
+
+@pytest.mark.parametrize('params', [
+    {'aux': 0},
+    {'charging_power_max': 60000},
+    {'unloaded_bus_mass': 15000},
+    {'a_pos': 0.8, 'aux': 3000},
+    {'a_neg': -1.0, 'charging_power_max': 60000},
+    {'a_neg': -0.7},
+    {'mass_array': [18000.]},
+    ])
+@pytest.mark.parametrize('resample_tolerance', [None, 0.01])
+def test_with_params_matches_new_trajectory(
+    trajectory, resampled, params, resample_tolerance
+    ):
+    if resample_tolerance is not None:
+        trajectory = resampled
+    before = trajectory.summary()
+
+    updated = trajectory.with_params(**params)
+    expected = ldm.RouteTrajectory(
+        153, shp_filename, a_prof,
+        resample_tolerance=resample_tolerance,
+        **dict(base_args, **params)
+        )
+
+    assert len(updated.route_state) == len(expected.route_state)
+    for name in expected.route_state.COLUMNS:
+        assert np.array_equal(
+            updated.route_state[name], expected.route_state[name]
+            ), name
+    assert trajectory.summary() == before, "original trajectory changed"
+
+
+def test_sweep_grid(trajectory):
+    results = trajectory.sweep({
+        'aux': [0, 7000],
+        'a_pos': [0.4, 0.8],
+        })
+
+    # Kinematic arguments vary slowest
+    assert list(results.a_pos) == [0.4, 0.4, 0.8, 0.8]
+    assert list(results.aux) == [0, 7000, 0, 7000]
+    assert results.energy_kwh[1] == trajectory.summary()['energy_kwh']
+
+    with pytest.raises(ldm.IllegalArgumentError):
+        trajectory.sweep([{'route_num': 154}])
+
+
+def test_mass_scenarios_match_with_params(trajectory):
+    mass_matrix = [[13500.], [12927.], [18000.]]
+
+    energy, time_on_route, power = trajectory.mass_scenarios(mass_matrix)
+
+    assert power.shape == (3, len(trajectory.route_state))
+    for i, mass_array in enumerate(mass_matrix):
+        expected = trajectory.with_params(mass_array=mass_array)
+        expected_energy, expected_time = expected.energy_from_route()
+
+        assert energy[i] == expected_energy
+        assert np.array_equal(time_on_route[i], expected_time)
+        assert np.array_equal(power[i], expected.route_state['power_output'])
@@ -1,4 +1,4 @@
-from setuptools import setup
+from setuptools import setup, find_packages
 setup(
         name = 'Route_Dynamics',
         version = '1.0',
@@ -6,6 +6,12 @@ setup(
         author='xxx',  
         author_email='123@uw.edu',  
         url='https://github.com/EricaEgg/Route_Dynamics',     
-        packages=['route_dynamics'],
-        package_dir={"project" : 'route_dynamics'}
+        python_requires='>=3.8',
+        packages=find_packages(include=['route_dynamics', 'route_dynamics.*']),
+        package_dir={"project" : 'route_dynamics'},
+        entry_points={
+            'console_scripts': [
+                'route-dynamics = route_dynamics.cli:main',
+                ],
+            },
 )